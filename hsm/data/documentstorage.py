@@ -1,15 +1,21 @@
-import re
 
 from hsm.data.document import Document
 from hsm.data.prefixmap import PrefixMap
+from hsm.data.regexcache import compile_regex
+from hsm.data.textindex import TextIndex
 
 
 class DocumentStorage(object):
     '''Memory document storage.'''
     
-    def __init__(self):
+    def __init__(self, text_index=False):
+        '''Initialize memory document storage.
+        Keyword arguments:
+        text_index - if True, maintain a positional full-text index, which is used
+                     to narrow down `regex` queries and to answer `search` queries.'''
         self._docmap = dict()
         self._prefixmap = PrefixMap()
+        self._textindex = TextIndex() if text_index else None
     
     def load(self, name):
         '''Load a single document with given `name`.'''
@@ -32,33 +38,63 @@ class DocumentStorage(object):
         regex - if given, then returns only documents matching the regex.
         neg_regx - if given, does not return documents matching the regex.
         limit - if given, returns only number of documents specified by the limit.'''
+        return [self._docmap[name] for name in self.load_names(prefix, limit, regex, neg_regex)]
+    
+    def load_names(self, prefix, limit=None, regex=None, neg_regex=None):
+        '''Load the sorted names of documents matching the same criteria as `load_all`.
+        Unless regexes are given, the documents themselves are not accessed.'''
         assert isinstance(prefix, unicode)
         self._check_kwargs(limit, regex, neg_regex)
+        candidates = None
+        if regex is not None and self._textindex is not None:
+            candidates = self._textindex.candidates(regex, prefix)
         if regex is not None:
-            regex = re.compile(regex, re.UNICODE)
+            regex = compile_regex(regex)
         if neg_regex is not None:
-            neg_regex = re.compile(neg_regex, re.UNICODE)
-        documents = []
-        for name in self._prefixmap.get(prefix):
-            doc = self._docmap[name]
-            # if document does not match regex, then skip it
-            if regex is not None and regex.search(doc.text) is None:
-                continue
-            # if document matches negative regex, then skip it
-            if neg_regex is not None and neg_regex.search(doc.text) is not None:
-                continue
-            documents.append(doc)
-            if limit is not None and len(documents) >= limit:
+            neg_regex = compile_regex(neg_regex)
+        names = []
+        for name in self._prefixmap.names(prefix) if candidates is None else sorted(candidates):
+            if regex is not None or neg_regex is not None:
+                text = self._docmap[name].text
+                # if document does not match regex, then skip it
+                if regex is not None and regex.search(text) is None:
+                    continue
+                # if document matches negative regex, then skip it
+                if neg_regex is not None and neg_regex.search(text) is not None:
+                    continue
+            names.append(name)
+            if limit is not None and len(names) >= limit:
                 break
-        return documents
+        return names
     
     def load_iterator(self, prefix, limit=None, regex=None, neg_regex=None):
         return self._iterator(self.load_all(prefix, limit, regex, neg_regex))
     
+    def count(self, prefix=u''):
+        '''Count the documents with names starting with given `prefix`.'''
+        assert isinstance(prefix, unicode)
+        return sum(1 for _ in self._prefixmap.names(prefix))
+    
     def _iterator(self, iterable):
         for elem in iterable:
             yield elem
     
+    def search(self, terms=None, phrase=None, prefix=u''):
+        '''Search documents containing words.
+        Keyword arguments:
+        terms - a list of words that must all occur in the document.
+        phrase - a string, whose words must occur consecutively in the document.
+        prefix - if given, search only documents with names starting with the prefix.
+        Returns a dictionary mapping document names to sorted lists of (start, end) hit offsets.
+        Without the text index, the documents matching prefix are indexed on the fly.'''
+        assert isinstance(prefix, unicode)
+        index = self._textindex
+        if index is None:
+            index = TextIndex()
+            for document in self.load_iterator(prefix):
+                index.add(document.name, document.text)
+        return index.search(terms, phrase, prefix)
+    
     def save(self, document):
         '''Save the given `document`.'''
         assert isinstance(document, Document)
@@ -66,6 +102,8 @@ class DocumentStorage(object):
             raise self._exists(document.name)
         self._docmap[document.name] = document
         self._prefixmap.add(document.name, document.name)
+        if self._textindex is not None:
+            self._textindex.add(document.name, document.text)
     
     def save_all(self, documents):
         '''Save all given documents.'''
@@ -83,13 +121,15 @@ class DocumentStorage(object):
             raise self._not_exists(name)
         del self._docmap[name]
         self._prefixmap.delete(name, name)
+        if self._textindex is not None:
+            self._textindex.remove(name)
     
     def delete_all(self, prefix):
         '''Delete all documents with name starting with given `prefix`.
         Returns the number of deleted documents.'''
         assert isinstance(prefix, unicode)
         num_deleted = 0
-        for name in self._prefixmap.get(prefix):
+        for name in list(self._prefixmap.names(prefix)):
             self.delete(name)
             num_deleted += 1
         return num_deleted
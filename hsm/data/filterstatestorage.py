@@ -0,0 +1,28 @@
+'''Storage for the per-document state of applied filters.'''
+
+class FilterStateStorage(object):
+    '''Memory storage of document content hashes keyed by filter output names.'''
+    
+    def __init__(self):
+        self._data = dict()
+    
+    def load(self, output_name):
+        '''Load a dictionary mapping document names to the hashes they were last filtered with.'''
+        assert isinstance(output_name, unicode)
+        return dict(self._data.get(output_name, {}))
+    
+    def update(self, output_name, hashes):
+        '''Store the hashes of given dictionary mapping document names to hashes.'''
+        assert isinstance(output_name, unicode)
+        if len(hashes) > 0:
+            self._data.setdefault(output_name, dict()).update(hashes)
+    
+    def delete(self, output_name, doc_names=None):
+        '''Delete the hashes of given documents, or all hashes of the output, if `doc_names` is not given.'''
+        assert isinstance(output_name, unicode)
+        if doc_names is None:
+            self._data.pop(output_name, None)
+        elif output_name in self._data:
+            hashes = self._data[output_name]
+            for doc_name in doc_names:
+                hashes.pop(doc_name, None)
@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+'''
+Module for generating synthetic Estonian clinical texts with planted
+numeric values.
+
+Documents are made of text fragments, some of which contain blood pressures,
+pulses, temperatures, dates, medicine doses, durations and measurements of
+weight and height. The values of each measurement fragment are recorded as
+planted values in the same format as the values returned by the extractors
+of `hsm.tools.numextractor`, including the offsets of the fields in the
+document. Given the same seed, the same documents are generated.
+'''
+
+import random
+import string
+
+PLAIN = [u'Patsient kaebab valu rindkeres.',
+         u'Üldseisund rahuldav, teadvus selge.',
+         u'Kopsudes vesikulaarne hingamine, räginaid ei kuule.',
+         u'Kõht pehme, palpatsioonil valutu.',
+         u'Soovitatud jätkata senist ravi ja pöörduda perearsti vastuvõtule.',
+         u'Anamneesis hüpertooniatõbi ja II tüüpi diabeet.',
+         u'Süda: toonid puhtad, rütm regulaarne.',
+         u'Patsient suunatud kardioloogi konsultatsioonile.']
+
+MONTHS = [u'jaanuar', u'veebruar', u'märts', u'aprill', u'mai', u'juuni',
+          u'juuli', u'august', u'september', u'oktoober', u'november', u'detsember']
+
+MEDICINES = [u'Metoprolol', u'Enalapriil', u'Amlodipiin', u'Metformiin', u'Furosemiid']
+
+
+def integer(low, high):
+    '''Slot of a random integer between `low` and `high`.'''
+    def slot(rnd):
+        value = rnd.randint(low, high)
+        return unicode(value), value
+    return slot
+
+def decimal(low, high):
+    '''Slot of a random number between `low` and `high` with one decimal written after a comma.'''
+    def slot(rnd):
+        value = rnd.randint(low * 10, high * 10)
+        return u'{0},{1}'.format(value // 10, value % 10), value / 10.0
+    return slot
+
+def choice(texts, values=None):
+    '''Slot of a random text from `texts`, whose value is the text or the corresponding item of `values`.'''
+    def slot(rnd):
+        idx = rnd.randrange(len(texts))
+        return texts[idx], texts[idx] if values is None else values[idx]
+    return slot
+
+def floating(slot):
+    '''Slot with the value of given slot as a float.'''
+    def floating_slot(rnd):
+        text, value = slot(rnd)
+        return text, float(value)
+    return floating_slot
+
+
+# fragments with measurements: the text with a slot for each field and
+# the planted values as (extractor, fields) pairs
+TEMPLATES = [
+    (u'RR {systolic}/{diastolic} mmHg, ps {pulse}x min.',
+     {'systolic': integer(100, 180), 'diastolic': integer(60, 99), 'pulse': integer(50, 110)},
+     [('record_bloodpressure', ['systolic', 'diastolic', 'pulse'])]),
+    (u'Vererõhk {systolic} / {diastolic}, pulss {pulse}.',
+     {'systolic': integer(100, 180), 'diastolic': integer(60, 99), 'pulse': integer(50, 110)},
+     [('record_bloodpressure', ['systolic', 'diastolic', 'pulse'])]),
+    (u'RR {systolic_low}-{systolic_high}/{diastolic_low}-{diastolic_high}.',
+     {'systolic_low': integer(100, 139), 'systolic_high': integer(140, 180),
+      'diastolic_low': integer(60, 79), 'diastolic_high': integer(80, 99)},
+     [('record_bloodpressure', ['systolic_low', 'systolic_high', 'diastolic_low', 'diastolic_high'])]),
+    (u'Palavikku ei ole, temp {temperature} kraadi.',
+     {'temperature': decimal(36, 39)},
+     [('record_temperature', ['temperature'])]),
+    (u'Visiit {day}.{month}.{year}.',
+     {'day': integer(10, 28), 'month': integer(10, 12), 'year': integer(2005, 2015)},
+     [('record_date', ['day', 'month', 'year'])]),
+    (u'Kontroll {day}. {month}.',
+     {'day': integer(10, 28), 'month': choice(MONTHS, range(1, 13))},
+     [('record_date', ['day', 'month'])]),
+    (u'Määratud {medicine} {amount} mg x {frequency}.',
+     {'medicine': choice(MEDICINES), 'amount': floating(choice([u'25', u'50', u'100'], [25, 50, 100])),
+      'frequency': integer(1, 3)},
+     [('record_medicine', ['medicine', 'amount', 'frequency'])]),
+    (u'Patsiendi kaal {weight} kg, pikkus {height} cm.',
+     {'weight': floating(integer(50, 120)), 'height': floating(integer(150, 199))},
+     [('record_measurement', ['weight']), ('record_measurement', ['height'])]),
+    (u'Ravi kestnud {value} nädalat.',
+     {'value': floating(integer(2, 12))},
+     [('record_timex', ['value'])])]
+
+
+class PlantedValue(object):
+    '''Measurement planted in a generated document.
+    fields - dictionary of the fields in the format of the extractor values,
+             mapping the field names to dictionaries of value, original, start and end.'''
+
+    def __init__(self, extractor, fields):
+        self.extractor = extractor
+        self.fields = fields
+
+    def found(self, values):
+        '''Check if the extracted `values` of the document, given as the result of `NumExtractor.extract`,
+        contain a match with the planted value and offsets of each planted field.'''
+        for m in values.get(self.extractor, []):
+            if all(name in m and m[name]['value'] == field['value'] and m[name].get('start') == field['start']
+                   for name, field in self.fields.iteritems()):
+                return True
+        return False
+
+
+def fragment(rnd, density, offset):
+    '''Generate a text fragment starting at `offset` of the document.
+    Returns the text and the list of planted values.'''
+    if rnd.random() >= density:
+        return rnd.choice(PLAIN), []
+    template, slots, planted = rnd.choice(TEMPLATES)
+    chunks, fields = [], dict()
+    for literal, name, _, _ in string.Formatter().parse(template):
+        chunks.append(literal)
+        offset += len(literal)
+        if name is None:
+            continue
+        text, value = slots[name](rnd)
+        fields[name] = {'value': value, 'original': text, 'start': offset, 'end': offset + len(text)}
+        chunks.append(text)
+        offset += len(text)
+    values = [PlantedValue(extractor, dict((name, fields[name]) for name in names)) for extractor, names in planted]
+    return u''.join(chunks), values
+
+def generate_document(rnd, fragments=40, density=0.1):
+    '''Generate a document of `fragments` text fragments, of which the share
+    `density` contain measurements. Returns the text and the list of planted values.'''
+    texts, planted, offset = [], [], 0
+    for _ in xrange(fragments):
+        text, values = fragment(rnd, density, offset)
+        texts.append(text)
+        planted.extend(values)
+        offset += len(text) + 1
+    return u' '.join(texts), planted
+
+def generate_documents(count, fragments=40, density=0.1, seed=0):
+    '''Generate a list of `count` documents, see `generate_document`.'''
+    rnd = random.Random(seed)
+    return [generate_document(rnd, fragments, density) for _ in xrange(count)]
@@ -0,0 +1,161 @@
+from bisect import bisect_left, bisect_right
+from heapq import merge
+
+
+class IntervalIndex(object):
+    '''Index of the segments of a single document ordered by their positions.
+
+    Segments are grouped into buckets by length, so that the lengths in a
+    bucket differ at most twofold. Each bucket keeps its segments in an array
+    sorted by start, end and value along with a parallel array of start
+    positions. Since no segment of a bucket is longer than its longest segment,
+    positional queries need to inspect only a range of start positions found
+    with a binary search, and a long segment widens the range only in its own
+    bucket. Besides the results, a query inspects only the segments of a
+    bucket that start within its longest length before the queried range and
+    end before the range, which start within about half of that length. The
+    worst case is many segments of a single bucket ending just before the
+    range, where the query is linear in the size of the bucket.'''
+
+    def __init__(self, segments=None):
+        self._buckets = dict()
+        self._size = 0
+        if segments is not None:
+            self.add(segments)
+
+    def __len__(self):
+        return self._size
+
+    def __iter__(self):
+        return merge(*[iter(segments) for segments, _, _ in self._buckets.itervalues()])
+
+    def __contains__(self, segment):
+        return self._position(segment) is not None
+
+    def add(self, segments):
+        '''Add given segments to the index.
+        Returns the list of segments that were not already indexed.'''
+        new_segments = []
+        seen = set()
+        for segment in segments:
+            if segment in seen or self._position(segment) is not None:
+                continue
+            seen.add(segment)
+            new_segments.append(segment)
+        if len(new_segments) > 0:
+            # build new arrays instead of modifying them in place, so running queries are not affected
+            buckets = dict(self._buckets)
+            for length_class, group in _group_by_length(new_segments).iteritems():
+                group.sort(key=_sort_key)
+                buckets[length_class] = _merge(buckets.get(length_class, ([], [], 0)), group)
+            self._buckets = buckets
+            self._size += len(new_segments)
+        return new_segments
+
+    def remove(self, segments):
+        '''Remove given segments from the index.
+        Returns the list of segments that were removed.'''
+        removed = set(segment for segment in segments if segment in self)
+        if len(removed) > 0:
+            buckets = dict(self._buckets)
+            for length_class in _group_by_length(removed):
+                remaining = [segment for segment in buckets[length_class][0] if segment not in removed]
+                if len(remaining) > 0:
+                    buckets[length_class] = _bucket(remaining)
+                else:
+                    del buckets[length_class]
+            self._buckets = buckets
+            self._size -= len(removed)
+        return list(removed)
+
+    def overlapping(self, start, end):
+        '''Generate segments that share at least one character with range [start, end).'''
+        return merge(*[_overlapping(bucket, start, end) for bucket in self._buckets.itervalues()])
+
+    def contained(self, start, end):
+        '''Generate segments that lie within range [start, end).'''
+        return merge(*[_contained(bucket, start, end) for length_class, bucket in self._buckets.iteritems()
+                       if _min_length(length_class) <= end - start])
+
+    def containing(self, start, end):
+        '''Generate segments that cover the whole range [start, end).'''
+        return merge(*[_containing(bucket, start, end) for bucket in self._buckets.itervalues()
+                       if bucket[2] >= end - start])
+
+    def _position(self, segment):
+        bucket = self._buckets.get(_length_class(segment))
+        if bucket is None:
+            return None
+        segments, starts, _ = bucket
+        lo = bisect_left(starts, segment.start)
+        hi = bisect_right(starts, segment.start)
+        for idx in xrange(lo, hi):
+            if segments[idx] == segment:
+                return idx
+        return None
+
+def _overlapping(bucket, start, end):
+    for segment in _candidates(bucket, start - bucket[2] + 1, end - 1):
+        if segment.end > start:
+            yield segment
+
+def _contained(bucket, start, end):
+    for segment in _candidates(bucket, start, end - 1):
+        if segment.end <= end:
+            yield segment
+
+def _containing(bucket, start, end):
+    for segment in _candidates(bucket, end - bucket[2], start):
+        if segment.end >= end:
+            yield segment
+
+def _candidates(bucket, min_start, max_start):
+    '''Generate segments of the bucket with starting positions in range [min_start, max_start].'''
+    segments, starts, _ = bucket
+    lo = bisect_left(starts, min_start)
+    hi = bisect_right(starts, max_start)
+    for idx in xrange(lo, hi):
+        yield segments[idx]
+
+def _bucket(segments):
+    '''Bucket of sorted segments: the segments, their starts and the length of the longest segment.'''
+    return (segments, [segment.start for segment in segments],
+            max(segment.end - segment.start for segment in segments))
+
+def _merge(bucket, new_segments):
+    '''Merge sorted new segments into a copy of the bucket.
+    Positions of the new segments are found with a binary search and the
+    segments between them are copied in slices.'''
+    segments, starts, max_length = bucket
+    merged_segments, merged_starts = [], []
+    prev = 0
+    for segment in new_segments:
+        pos = bisect_left(starts, segment.start, prev)
+        key = _sort_key(segment)
+        while pos < len(segments) and starts[pos] == segment.start and _sort_key(segments[pos]) < key:
+            pos += 1
+        merged_segments.extend(segments[prev:pos])
+        merged_segments.append(segment)
+        merged_starts.extend(starts[prev:pos])
+        merged_starts.append(segment.start)
+        max_length = max(max_length, segment.end - segment.start)
+        prev = pos
+    merged_segments.extend(segments[prev:])
+    merged_starts.extend(starts[prev:])
+    return (merged_segments, merged_starts, max_length)
+
+def _group_by_length(segments):
+    groups = dict()
+    for segment in segments:
+        groups.setdefault(_length_class(segment), []).append(segment)
+    return groups
+
+def _length_class(segment):
+    '''Segments of lengths in range [2**(k-1), 2**k) belong to class k.'''
+    return (segment.end - segment.start).bit_length()
+
+def _min_length(length_class):
+    return 1 << (length_class - 1)
+
+def _sort_key(segment):
+    return (segment.start, segment.end, segment.value)
@@ -3,6 +3,7 @@ import re
 from hsm.configuration import config
 from hsm.data.document import Document
 from hsm.data.documentstorage import DocumentStorage
+from hsm.data.mongotextindex import MongoTextIndex
 import pymongo as pm
 
 
@@ -13,14 +14,29 @@ def get_mongoclient():
     
 class MongoDocumentStorage(DocumentStorage):
     
-    def __init__(self, dbkey='db'):
+    # largest number of text index candidates sent as a list of names,
+    # keeping the query well below the 16MB document size limit of MongoDB.
+    # With more candidates the prefix and regex query scans the documents.
+    MAX_CANDIDATES = 10000
+    
+    def __init__(self, dbkey='db', text_index=False):
         '''Initialize Mongodb backed document storage.
         Arguments:
-        dbkey - the key to load database name from default configuration.'''
+        dbkey - the key to load database name from default configuration.
+        text_index - if True, maintain a positional full-text index in the `postings` collection.
+                     Documents saved without the index can be indexed with `rebuild_text_index`.'''
         client = get_mongoclient()
         db = client[config.get('mongodb', dbkey)]
         self._documents = db['documents']
         self._documents.ensure_index([('name', pm.ASCENDING)], unique=True)
+        self._textindex = MongoTextIndex(db['postings'], self.MAX_CANDIDATES) if text_index else None
+    
+    def rebuild_text_index(self):
+        '''Index the texts of all stored documents.'''
+        assert self._textindex is not None
+        self._textindex.remove_prefix(u'')
+        for entry in self._documents.find({}, {'name': 1, 'text': 1}):
+            self._textindex.add(entry['name'], entry['text'])
     
     def load(self, name):
         '''Load a single document with given `name`.'''
@@ -39,9 +55,29 @@ class MongoDocumentStorage(DocumentStorage):
         regex - if given, then returns only documents matching the regex.
         neg_regx - if given, does not return documents matching the regex.
         limit - if given, returns only number of documents specified by the limit.'''
+        query = self._query(prefix, limit, regex, neg_regex)
+        if limit is None:
+            return self._iterator(self._documents.find(query))
+        else:
+            return self._iterator(self._documents.find(query).limit(limit))
+    
+    def load_names(self, prefix, limit=None, regex=None, neg_regex=None):
+        '''Load the sorted names of documents matching the same criteria as `load_all`.
+        Only the names are fetched from the database.'''
+        query = self._query(prefix, limit, regex, neg_regex)
+        cursor = self._documents.find(query, {'name': 1, '_id': 0}).sort('name', pm.ASCENDING)
+        if limit is not None:
+            cursor = cursor.limit(limit)
+        return [entry['name'] for entry in cursor]
+    
+    def _query(self, prefix, limit, regex, neg_regex):
         assert isinstance(prefix, unicode)
         self._check_kwargs(limit, regex, neg_regex)
         query = {'name': {'$regex': '^' + prefix}}
+        if regex is not None and self._textindex is not None:
+            candidates = self._textindex.candidates(regex, prefix)
+            if candidates is not None and len(candidates) <= self.MAX_CANDIDATES:
+                query['name'] = {'$in': list(sorted(candidates))}
         regex_query = {}
         if regex is not None:
             regex_query['$regex'] = re.compile(regex, re.UNICODE)
@@ -49,10 +85,12 @@ class MongoDocumentStorage(DocumentStorage):
             regex_query['$not'] = re.compile(neg_regex, re.UNICODE)
         if regex is not None or neg_regex is not None:
             query['text'] = regex_query
-        if limit is None:
-            return self._iterator(self._documents.find(query))
-        else:
-            return self._iterator(self._documents.find(query).limit(limit))
+        return query
+    
+    def count(self, prefix=u''):
+        '''Count the documents with names starting with given `prefix`.'''
+        assert isinstance(prefix, unicode)
+        return self._documents.find({'name': {'$regex': '^' + prefix}}).count()
     
     def _iterator(self, cursor):
         for entry in cursor:
@@ -65,6 +103,8 @@ class MongoDocumentStorage(DocumentStorage):
         if len(existing) > 0:
             raise self._exists(document.name)
         self._documents.insert(Document.to_dict(document))
+        if self._textindex is not None:
+            self._textindex.add(document.name, document.text)
     
     def save_all(self, documents):
         '''Save all given documents.'''
@@ -77,10 +117,14 @@ class MongoDocumentStorage(DocumentStorage):
         if len(list(self._documents.find({'name': name}))) == 0:
             raise self._not_exists(name)
         self._documents.remove({'name': name})
+        if self._textindex is not None:
+            self._textindex.remove(name)
     
     def delete_all(self, prefix):
         '''Delete all documents with name starting with given `prefix`.
         Returns the number of deleted documents.'''
         assert isinstance(prefix, unicode)
         result = self._documents.remove({'name': {'$regex': '^' + prefix}})
+        if self._textindex is not None:
+            self._textindex.remove_prefix(prefix)
         return result['n']
@@ -0,0 +1,37 @@
+import pymongo as pm
+from hsm.configuration import config
+from hsm.data.mongodocumentstorage import get_mongoclient
+from hsm.data.filterstatestorage import FilterStateStorage
+
+
+class MongoFilterStateStorage(FilterStateStorage):
+    
+    def __init__(self, dbkey='db'):
+        '''Initialize Mongodb backed filter state storage.
+        Arguments:
+        dbkey - the key to load database name from default configuration.'''
+        client = get_mongoclient()
+        db = client[config.get('mongodb', dbkey)]
+        self._state = db['filter_state']
+        self._state.ensure_index([('output_name', pm.ASCENDING), ('doc_name', pm.ASCENDING)], unique=True)
+    
+    def load(self, output_name):
+        assert isinstance(output_name, unicode)
+        cursor = self._state.find({'output_name': output_name}, {'doc_name': 1, 'hash': 1})
+        return dict((entry['doc_name'], entry['hash']) for entry in cursor)
+    
+    def update(self, output_name, hashes):
+        assert isinstance(output_name, unicode)
+        for doc_name, digest in hashes.iteritems():
+            self._state.update({'output_name': output_name, 'doc_name': doc_name},
+                               {'$set': {'hash': digest}},
+                               upsert=True)
+    
+    def delete(self, output_name, doc_names=None):
+        assert isinstance(output_name, unicode)
+        if doc_names is None:
+            self._state.remove({'output_name': output_name})
+        else:
+            doc_names = list(doc_names)
+            if len(doc_names) > 0:
+                self._state.remove({'output_name': output_name, 'doc_name': {'$in': doc_names}})
@@ -4,33 +4,67 @@ import pymongo as pm
 from hsm.configuration import config
 from hsm.data.mongodocumentstorage import get_mongoclient
 from hsm.data.segment import Segment
-from hsm.data.segmentstorage import SegmentStorage
+from hsm.data.segmentstorage import SegmentStorage, count_prefixes, is_count_prefix
+from hsm.data.trigramindex import trigram_query, trigrams, AND, OR
+
+# keys of the markers of built derived data in the `segment_state` collection
+COUNTS = u'counts'
+TRIGRAMS = u'trigrams'
 
 
 class MongoSegmentStorage(SegmentStorage):
     '''Mongodb backed segment storage.'''
     
-    def __init__(self, dbkey='db'):
+    def __init__(self, dbkey='db', trigram_index=False):
         '''Initialize segment storage.
         Arguments:
-        dbkey - the key to load database name from default configuration.'''
+        dbkey - the key to load database name from default configuration.
+        trigram_index - if True, store the trigrams of segment values with the segments
+                        and use them to narrow down `value_regex` queries.
+                        Segments saved without the index can be indexed with `rebuild_trigram_index`,
+                        until then the trigrams are not used.'''
+        self._trigram_index = trigram_index
         client = get_mongoclient()
         db = client[config.get('mongodb', dbkey)]
         self._segments = db['segments']
         self._segments.ensure_index([('name', pm.ASCENDING)])
         self._segments.ensure_index([('doc_name', pm.ASCENDING)])
         self._segments.ensure_index([('name', pm.ASCENDING), ('doc_name', pm.ASCENDING)])
+        self._segments.ensure_index([('doc_name', pm.ASCENDING), ('name', pm.ASCENDING), ('start', pm.ASCENDING)])
+        # persisted segment counts for each segment name and document name prefix
+        self._counts = db['segment_counts']
+        self._counts.ensure_index([('name', pm.ASCENDING), ('doc_prefix', pm.ASCENDING)], unique=True)
+        # markers of derived data that is complete for all stored segments
+        self._state = db['segment_state']
+        if not self._is_built(COUNTS):
+            # the database was created before the counts were maintained
+            self.rebuild_counts()
+        if trigram_index:
+            self._segments.ensure_index([('name', pm.ASCENDING), ('trigrams', pm.ASCENDING)])
+            if self._segments.find_one() is None:
+                self._set_built(TRIGRAMS, True)
     
-    def _get_query(self, kwargs):
-        name, name_prefix, doc_name, doc_prefix, value_regex, neg_regex = self._parse_arguments(kwargs)
-        query = {}
+    def _is_built(self, key):
+        return self._state.find_one({'_id': key}) is not None
+    
+    def _set_built(self, key, built):
+        if built:
+            self._state.update({'_id': key}, {'_id': key}, upsert=True)
+        else:
+            self._state.remove({'_id': key})
+    
+    def _name_query(self, name, name_prefix):
         if name_prefix is not None:
             if len(name_prefix) > 0:
-                query['name'] = {'$regex': '^' + name_prefix}
-        elif name is not None:
-            query['name'] = name
-        else:
+                return {'name': {'$regex': '^' + name_prefix}}
+            return {}
+        return {'name': name}
+    
+    def _get_query(self, kwargs):
+        name, name_prefix, doc_name, doc_prefix, value_regex, neg_regex = self._parse_arguments(kwargs)
+        if name_prefix is None and name is None:
             raise Exception('At least `name` or `name_prefix` should be given!')
+        query = self._name_query(name, name_prefix)
         if doc_prefix is not None:
             if len(doc_prefix) > 0:
                 query['doc_name'] = {'$regex': '^' + doc_prefix}
@@ -45,8 +79,67 @@ class MongoSegmentStorage(SegmentStorage):
             regex_query['$not'] = re.compile(neg_regex)
         if value_regex is not None or neg_regex is not None:
             query['value'] = regex_query
+        if value_regex is not None and self._use_trigrams():
+            condition = self._trigram_condition(trigram_query(value_regex))
+            if condition is not None:
+                query = {'$and': [query, condition]}
         return query
     
+    def _use_trigrams(self):
+        '''Are the trigrams stored for all segments.'''
+        return self._trigram_index and self._is_built(TRIGRAMS)
+    
+    def _trigram_condition(self, node):
+        '''Convert a trigram query tree to a Mongodb query on the `trigrams` field.'''
+        if node is None:
+            return None
+        if not isinstance(node, tuple):
+            return {'trigrams': node}
+        kind, children = node
+        if kind == AND and all(not isinstance(child, tuple) for child in children):
+            return {'trigrams': {'$all': children}}
+        conditions = [self._trigram_condition(child) for child in children]
+        if kind == OR:
+            return {'$or': conditions}
+        return {'$and': conditions}
+    
+    def _to_dict(self, segment):
+        entry = Segment.to_dict(segment)
+        if self._trigram_index:
+            entry['trigrams'] = list(sorted(trigrams(segment.value)))
+        return entry
+    
+    def rebuild_trigram_index(self):
+        '''Store the trigrams of all segment values, for example for segments saved before
+        the trigram index was enabled.'''
+        cursor = self._segments.find({}, {'value': 1})
+        for entry in cursor:
+            self._segments.update({'_id': entry['_id']},
+                                  {'$set': {'trigrams': list(sorted(trigrams(entry['value'])))}})
+        self._set_built(TRIGRAMS, True)
+    
+    def regex_selectivity(self, value_regex, name=None, name_prefix=None):
+        '''Report how selective the trigram index is for given `value_regex`.
+        Keyword arguments:
+        name - the name of the segments.
+        name_prefix - if given, overrides `name` and uses all segments matching prefix.
+        Returns a dictionary with the number of `candidates` the regex is run on,
+        the `total` number of segments and their ratio as `selectivity`.'''
+        assert isinstance(value_regex, unicode)
+        if name is None and name_prefix is None:
+            name_prefix = u''
+        query = self._name_query(name, name_prefix)
+        total = sum(self.counts(name=name, name_prefix=name_prefix).values())
+        condition = None
+        if self._use_trigrams():
+            condition = self._trigram_condition(trigram_query(value_regex))
+        if condition is None:
+            return {'candidates': total, 'total': total, 'selectivity': 1.0}
+        candidates = self._segments.find({'$and': [query, condition]}).count()
+        return {'candidates': candidates,
+                'total': total,
+                'selectivity': float(candidates) / max(total, 1)}
+    
     def load(self, **kwargs):
         '''Load segments from the storage.
         Keyword arguments:
@@ -80,6 +173,44 @@ class MongoSegmentStorage(SegmentStorage):
         for entry in cursor:
             yield Segment.from_dict(entry)
     
+    def _positional(self, position_query, doc_name, name, name_prefix):
+        assert isinstance(doc_name, unicode)
+        query = {'doc_name': doc_name}
+        if name_prefix is not None:
+            assert isinstance(name_prefix, unicode)
+            if len(name_prefix) > 0:
+                query['name'] = {'$regex': '^' + name_prefix}
+        elif name is not None:
+            assert isinstance(name, unicode)
+            query['name'] = name
+        query.update(position_query)
+        cursor = self._segments.find(query).sort([('name', pm.ASCENDING),
+                                                  ('start', pm.ASCENDING),
+                                                  ('end', pm.ASCENDING)])
+        for entry in cursor:
+            yield Segment.from_dict(entry)
+    
+    def load_overlapping(self, doc_name, start, end, name=None, name_prefix=None):
+        '''Load segments of document `doc_name` sharing at least one character with range [start, end).
+        Keyword arguments:
+        name - the name of the segments.
+        name_prefix - if given, overrides `name` and loads all segments matching prefix.
+        Returns a generator of segments ordered by segment name, start and end.'''
+        assert start < end
+        return self._positional({'start': {'$lt': end}, 'end': {'$gt': start}}, doc_name, name, name_prefix)
+    
+    def load_contained(self, doc_name, start, end, name=None, name_prefix=None):
+        '''Load segments of document `doc_name` that lie within range [start, end).
+        Takes same arguments as `load_overlapping`.'''
+        assert start < end
+        return self._positional({'start': {'$gte': start}, 'end': {'$lte': end}}, doc_name, name, name_prefix)
+    
+    def load_containing(self, doc_name, start, end, name=None, name_prefix=None):
+        '''Load segments of document `doc_name` that cover the whole range [start, end).
+        Takes same arguments as `load_overlapping`.'''
+        assert start < end
+        return self._positional({'start': {'$lte': start}, 'end': {'$gte': end}}, doc_name, name, name_prefix)
+    
     def save(self, segments):
         '''Save given segments to the storage.'''
         if len(segments) > 0:
@@ -87,7 +218,47 @@ class MongoSegmentStorage(SegmentStorage):
                 if not isinstance(segment, Segment):
                     print type(segment), Segment
                     raise AssertionError(unicode(segment) + u' is not a segment!')
-            self._segments.insert([Segment.to_dict(segment) for segment in segments])
+            if not self._trigram_index:
+                # the new segments have no trigrams
+                self._set_built(TRIGRAMS, False)
+            self._insert([self._to_dict(segment) for segment in segments])
+            self._update_counts(((segment.name, segment.doc_name) for segment in segments), 1)
+    
+    def _insert(self, entries):
+        '''Insert entries with an unordered bulk operation, which lets the server
+        apply the inserts in any order, or with a plain batch insert on older pymongo versions.'''
+        if hasattr(self._segments, 'initialize_unordered_bulk_op'):
+            bulk = self._segments.initialize_unordered_bulk_op()
+            for entry in entries:
+                bulk.insert(entry)
+            bulk.execute()
+        else:
+            self._segments.insert(entries)
+    
+    def _update_counts(self, pairs, sign):
+        '''Update the persisted counts given (segment name, document name) pairs.'''
+        counts = dict()
+        for seg_name, doc_name in pairs:
+            for prefix in count_prefixes(doc_name):
+                key = (seg_name, prefix)
+                counts[key] = counts.get(key, 0) + 1
+        for (seg_name, prefix), count in counts.iteritems():
+            self._counts.update({'name': seg_name, 'doc_prefix': prefix},
+                                {'$inc': {'count': sign * count}},
+                                upsert=True)
+        if sign < 0:
+            self._counts.remove({'count': {'$lte': 0}})
+    
+    def rebuild_counts(self):
+        '''Recompute the persisted counts from scratch, for example for databases
+        created before the counts were maintained. This is done automatically when
+        opening a storage without counts. Until the counts are rebuilt, they are
+        computed from the segments.'''
+        self._set_built(COUNTS, False)
+        self._counts.remove({})
+        cursor = self._segments.find({}, {'name': 1, 'doc_name': 1})
+        self._update_counts(((entry['name'], entry['doc_name']) for entry in cursor), 1)
+        self._set_built(COUNTS, True)
     
     def delete(self, **kwargs):
         '''Delete segments from the storage.
@@ -97,7 +268,14 @@ class MongoSegmentStorage(SegmentStorage):
         doc_name - the name of the document to load segments for.
         doc_prefix - if given, overrides `doc_name` and filters documents by matching their name with the prefix.
         '''
+        name, name_prefix, _, doc_prefix, value_regex, neg_regex = self._parse_arguments(dict(kwargs))
         query = self._get_query(kwargs)
+        if doc_prefix == u'' and value_regex is None and neg_regex is None:
+            # whole segment names are deleted, so are their counts
+            self._counts.remove(self._name_query(name, name_prefix))
+        else:
+            cursor = self._segments.find(query, {'name': 1, 'doc_name': 1})
+            self._update_counts(((entry['name'], entry['doc_name']) for entry in cursor), -1)
         self._segments.remove(query)
 
     def _unpack(self, aggregation):
@@ -105,13 +283,27 @@ class MongoSegmentStorage(SegmentStorage):
         return dict([(entry['_id'], entry['count']) for entry in result])
 
     def counts(self, **kwargs):
+        '''Get the total counts of the segments. Counts for queries without regular
+        expressions and with document prefixes ending with a `:` separator are
+        read from the persisted counts, once they are built.'''
+        name, name_prefix, _, doc_prefix, value_regex, neg_regex = self._parse_arguments(dict(kwargs))
+        if (doc_prefix is not None and is_count_prefix(doc_prefix) and value_regex is None and neg_regex is None and
+                self._is_built(COUNTS)):
+            query = self._name_query(name, name_prefix)
+            query['doc_prefix'] = doc_prefix
+            return dict((entry['name'], entry['count']) for entry in self._counts.find(query))
         query = self._get_query(kwargs)
         counts = self._segments.aggregate([{'$match': query},
                                            {'$group': {'_id': '$name', 'count': {'$sum': 1}}}])
         return self._unpack(counts)
     
     def count(self, key):
-        return self._segments.find({'name': key}).count()
+        if not self._is_built(COUNTS):
+            return self._segments.find({'name': key}).count()
+        entry = self._counts.find_one({'name': key, 'doc_prefix': u''})
+        if entry is None:
+            return 0
+        return entry['count']
     
     def value_counts(self, **kwargs):
         query = self._get_query(kwargs)
@@ -0,0 +1,80 @@
+import re
+
+from hsm.data.textindex import TextIndex, _term_positions
+import pymongo as pm
+
+
+class MongoTextIndex(TextIndex):
+    '''Positional inverted index of document texts persisted in a Mongodb collection.
+    Each entry holds the occurrences of a single term in a single document.
+    The names of the indexed documents are kept in a collection with the `_names` suffix.'''
+
+    def __init__(self, collection, max_candidates=10000):
+        '''Initialize the index.
+        Arguments:
+        collection - the collection of the postings.
+        max_candidates - if more documents contain a term, the term does not narrow down the candidates.'''
+        self._postings = collection
+        self._postings.ensure_index([('term', pm.ASCENDING), ('doc_name', pm.ASCENDING)], unique=True)
+        self._postings.ensure_index([('doc_name', pm.ASCENDING)])
+        self._names = collection.database[collection.name + '_names']
+        self._names.ensure_index([('doc_name', pm.ASCENDING)], unique=True)
+        self._max_candidates = max_candidates
+        if self._names.find_one() is None and self._postings.find_one() is not None:
+            # the postings were indexed before the names were maintained
+            for entry in self._group_names({}):
+                self._names.update({'doc_name': entry['_id']}, {'doc_name': entry['_id']}, upsert=True)
+
+    def __len__(self):
+        return self._names.count()
+
+    def add(self, name, text):
+        '''Index the `text` of document with given `name`.'''
+        assert isinstance(name, unicode)
+        self.remove(name)
+        entries = [{'term': term, 'doc_name': name, 'positions': positions}
+                   for term, positions in _term_positions(text).iteritems()]
+        if len(entries) > 0:
+            self._postings.insert(entries)
+        self._names.update({'doc_name': name}, {'doc_name': name}, upsert=True)
+
+    def remove(self, name):
+        '''Remove the document with given `name` from the index.'''
+        assert isinstance(name, unicode)
+        self._postings.remove({'doc_name': name})
+        self._names.remove({'doc_name': name})
+
+    def remove_prefix(self, prefix):
+        '''Remove all documents with names starting with `prefix` from the index.'''
+        assert isinstance(prefix, unicode)
+        self._postings.remove({'doc_name': {'$regex': '^' + prefix}})
+        self._names.remove({'doc_name': {'$regex': '^' + prefix}})
+
+    def _term_postings(self, term):
+        postings = dict()
+        for entry in self._postings.find({'term': term}):
+            postings[entry['doc_name']] = [tuple(occurrence) for occurrence in entry['positions']]
+        return postings
+
+    def _documents(self, term, prefix):
+        return self._distinct_names({'term': term}, prefix)
+
+    def _prefix_documents(self, term_prefix, prefix):
+        return self._distinct_names({'term': {'$regex': '^' + re.escape(term_prefix)}}, prefix)
+
+    def _distinct_names(self, query, prefix):
+        '''Get the names of documents with postings matching the query, or None if there are more
+        than `max_candidates` of them. The names are grouped with an aggregation read through
+        a cursor, as a list of distinct names could exceed the size limit of a single result.'''
+        if len(prefix) > 0:
+            query['doc_name'] = {'$regex': '^' + prefix}
+        names = set(entry['_id'] for entry in self._group_names(query, self._max_candidates + 1))
+        if len(names) > self._max_candidates:
+            return None
+        return names
+
+    def _group_names(self, query, limit=None):
+        pipeline = [{'$match': query}, {'$group': {'_id': '$doc_name'}}]
+        if limit is not None:
+            pipeline.append({'$limit': limit})
+        return self._postings.aggregate(pipeline, cursor={})
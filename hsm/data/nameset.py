@@ -0,0 +1,25 @@
+'''Compact set of document names.'''
+from bisect import bisect_left
+
+
+class NameSet(object):
+    '''Immutable set of names stored as a sorted array.
+    Membership is tested with binary search, which needs less memory than
+    hashing for the large name sets loaded when filtering by documents.'''
+
+    def __init__(self, names):
+        '''Initialize the set from an iterable of names. Sorted input is not sorted again.'''
+        names = list(names)
+        if any(names[idx] >= names[idx + 1] for idx in xrange(len(names) - 1)):
+            names = sorted(set(names))
+        self._names = tuple(names)
+
+    def __contains__(self, name):
+        idx = bisect_left(self._names, name)
+        return idx < len(self._names) and self._names[idx] == name
+
+    def __len__(self):
+        return len(self._names)
+
+    def __iter__(self):
+        return iter(self._names)
@@ -1,43 +1,114 @@
-from copy import deepcopy
+from bisect import bisect_left
+import sys
+import threading
 
 
 class PrefixMap(object):
-    '''Map designed to store and query unique objects by prefixes.'''
-    
+    '''Map designed to store and query unique objects by prefixes.
+
+    Names are kept in a sorted key array, so that all names matching
+    a prefix form a contiguous range that can be found with a binary search.
+    New names are appended and the array is re-sorted lazily on the next query.
+    Deleted names are left in the array and skipped by the queries, until they
+    make up half of it and are compacted away, so that deleting names one at a
+    time stays cheap. Modifications of the key array are guarded by a lock,
+    so the map can be shared between threads.'''
+
     def __init__(self, othermap=None):
-        '''If `othermap` is none, construct a copy. Otherwise
+        '''If `othermap` is given, construct a copy. Otherwise
         initialize an empty instance.'''
+        self._map = dict()
+        self._keys = []
+        self._sorted = True
+        self._deleted = set()
+        self._lock = threading.Lock()
         if othermap is not None:
             assert isinstance(othermap, PrefixMap)
-            self._map = deepcopy(othermap._map)
-        self._map = dict()
-    
+            for name, values in othermap._map.iteritems():
+                self._map[name] = set(values)
+            self._keys = list(sorted(self._map))
+
     def add(self, name, value):
         '''Add (name, value) pair to the instance.'''
         assert isinstance(name, unicode)
-        for key in prefixes(name):
-            if key not in self._map:
-                self._map[key] = set()
-            self._map[key].add(value)
-    
+        with self._lock:
+            values = self._map.get(name)
+            if values is None:
+                values = set()
+                self._map[name] = values
+                if name in self._deleted:
+                    # the name is still in the key array, just revive it
+                    self._deleted.remove(name)
+                else:
+                    if self._sorted and len(self._keys) > 0 and name < self._keys[-1]:
+                        self._sorted = False
+                    self._keys.append(name)
+            values.add(value)
+
     def get(self, prefix):
-        '''Get a generator for all values matching given `prefix` name.'''
+        '''Get a set of all values matching given `prefix` name.'''
         assert isinstance(prefix, unicode)
         values = set()
-        if prefix in self._map:
-            for value in self._map[prefix]:
-                values.add(value)
+        empty = frozenset()
+        for name in self._range(prefix):
+            values.update(self._map.get(name, empty))
         return values
-        
-    
+
+    def iterator(self, prefix):
+        '''Get a generator for all values matching given `prefix` name.
+        The values are generated in the order of their names.'''
+        assert isinstance(prefix, unicode)
+        for name in self.names(prefix):
+            values = self._map.get(name)
+            if values is not None:
+                for value in list(values):
+                    yield value
+
+    def names(self, prefix):
+        '''Get a generator for all names matching given `prefix` in sorted order.'''
+        assert isinstance(prefix, unicode)
+        # the returned range is a copy of the key array slice,
+        # so the generator can safely outlive concurrent modifications
+        for name in self._range(prefix):
+            if name in self._map:
+                yield name
+
     def delete(self, prefix, value):
         '''Delete a specified value for all elements with name matching given `prefix`.'''
         assert isinstance(prefix, unicode)
-        for key in prefixes(prefix):
-            if key in self._map:
-                self._map[key].remove(value)
-                if len(self._map[key]) == 0:
-                    del self._map[key]
+        names = list(self.names(prefix))
+        with self._lock:
+            for name in names:
+                values = self._map.get(name)
+                if values is not None and value in values:
+                    values.remove(value)
+                    if len(values) == 0:
+                        del self._map[name]
+                        self._deleted.add(name)
+
+    def __len__(self):
+        return len(self._map)
+
+    def _range(self, prefix):
+        with self._lock:
+            keys = self._sorted_keys()
+            lo = bisect_left(keys, prefix)
+            hi = bisect_left(keys, prefix + _MAX_CHAR, lo)
+            # names continuing with the maximal character itself are not covered by the bound
+            while hi < len(keys) and keys[hi].startswith(prefix):
+                hi += 1
+            return keys[lo:hi]
+
+    def _sorted_keys(self):
+        if len(self._deleted) > 0 and 2 * len(self._deleted) >= len(self._keys):
+            self._keys = [key for key in self._keys if key not in self._deleted]
+            self._deleted = set()
+        if not self._sorted:
+            self._keys = sorted(self._keys)
+            self._sorted = True
+        return self._keys
+
+_MAX_CHAR = unichr(sys.maxunicode)
 
 def prefixes(string):
     for n in range(len(string) + 1):
@@ -0,0 +1,18 @@
+'''Cache of compiled regular expressions shared by storages and filters.'''
+import re
+
+
+_CACHE_SIZE = 512
+_cache = dict()
+
+
+def compile_regex(regex, flags=re.UNICODE):
+    '''Compile `regex` with given flags, reusing the previously compiled pattern if available.'''
+    key = (regex, flags)
+    pattern = _cache.get(key)
+    if pattern is None:
+        pattern = re.compile(regex, flags)
+        if len(_cache) >= _CACHE_SIZE:
+            _cache.clear()
+        _cache[key] = pattern
+    return pattern
@@ -1,15 +1,34 @@
-import re
+import heapq
+from itertools import groupby, islice
+import logging
 
+from hsm.data.intervalindex import IntervalIndex
 from hsm.data.prefixmap import PrefixMap
+from hsm.data.regexcache import compile_regex
 from hsm.data.segment import Segment
+from hsm.data.trigramindex import TrigramIndex, trigram_query
 
 
+logger = logging.getLogger('segmentstorage')
+
 class SegmentStorage(object):
     '''Memory segment storage.'''
     
-    def __init__(self):
-        self._segmap = dict()
+    def __init__(self, trigram_index=False):
+        '''Initialize segment storage.
+        Arguments:
+        trigram_index - if True, index segment values by their trigrams to narrow down
+                        the segments `value_regex` and `neg_regex` queries are run on.'''
         self._segprefixmap = PrefixMap()
+        self._docprefixmap = dict()
+        self._intervals = dict()
+        # maintained counters: (name, doc_prefix) -> count and name -> {value: count}
+        self._counts = dict()
+        self._value_counts = dict()
+        # segment name -> TrigramIndex of the segment values
+        self._trigrams = None
+        if trigram_index:
+            self._trigrams = dict()
     
     def _parse_arguments(self, kwargs):
         name = None
@@ -57,10 +76,13 @@ class SegmentStorage(object):
     
     def _parse_limit(self, kwargs):
         if 'limit' in kwargs:
-            limit = int(kwargs['limit'])
+            limit = kwargs['limit']
+            del kwargs['limit']
+            if limit is None:
+                return None
+            limit = int(limit)
             if limit < 1:
                 raise Exception('Limit must be greater than zero!')
-            del kwargs['limit']
             return limit
     
     def _parse_sort(self, kwargs):
@@ -85,69 +107,225 @@ class SegmentStorage(object):
     
     def load_iterator(self, **kwargs):
         '''Same as load, but returns the generator for the returned segments.
+        Segments are generated lazily from the per document indices, so giving a `limit`
+        stops the generation early.
         Additional keyword arguments:
         sort - default False, otherwise sorts the segments by document name, segment name, segment start, segment end.
         '''
         limit = self._parse_limit(kwargs)
         sort = self._parse_sort(kwargs)
         name, name_prefix, doc_name, doc_prefix, value_regex, neg_regex = self._parse_arguments(kwargs)
-        segments = set()
         if name_prefix is not None:
-            for seg_name in self._segprefixmap.get(name_prefix):
-                if seg_name in self._segmap:
-                    segments |= self._segmap[seg_name]
+            names = list(self._segprefixmap.names(name_prefix))
         elif name is not None:
-            if name in self._segmap:
-                segments |= self._segmap[name]
+            names = [name]
         else:
             raise Exception('At least `name` or `name_prefix` should be given!')
+        if doc_prefix is None and doc_name is None:
+            raise Exception('At least `doc_name` or `doc_prefix` should be given!')
+        segments = None
+        if value_regex is not None and self._trigrams is not None:
+            candidates = self._trigram_candidates(names, value_regex)
+            if candidates is not None:
+                segments = self._candidate_iterator(candidates, names, doc_name, doc_prefix, sort)
+        if segments is None:
+            segments = self._index_iterator(names, doc_name, doc_prefix, sort)
         if value_regex is not None:
             segments = self._filter_value_regex(segments, value_regex)
         if neg_regex is not None:
-            segments = self._filter_neg_regex(segments, neg_regex)
+            segments = self._filter_neg_regex(segments, neg_regex, names)
+        return self._limit(segments, limit)
+    
+    def _trigram_candidates(self, names, regex):
+        '''Get the set of segments with given names, whose values may match `regex`.
+        Returns None, if the trigram index cannot narrow down the segments.'''
+        query = trigram_query(regex)
+        if query is None:
+            return None
+        candidates = set()
+        for seg_name in names:
+            index = self._trigrams.get(seg_name)
+            if index is not None:
+                candidates |= index.evaluate(query)
+        if logger.isEnabledFor(logging.DEBUG):
+            total = sum(self.count(seg_name) for seg_name in names)
+            logger.debug(u'Trigram index narrowed regex `{0}` down to {1} of {2} segments'.format(regex, len(candidates), total))
+        return candidates
+    
+    def _candidate_iterator(self, candidates, names, doc_name, doc_prefix, sort):
+        '''Generate the candidate segments in the same order as `_index_iterator`,
+        so that using the trigram index does not change the order of the results.'''
+        groups = dict()
+        for seg in candidates:
+            if (seg.doc_name.startswith(doc_prefix) if doc_prefix is not None else seg.doc_name == doc_name):
+                groups.setdefault((seg.name, seg.doc_name), []).append(seg)
+        if sort:
+            keys = sorted(groups, key=lambda key: (key[1], key[0]))
+        else:
+            order = dict((seg_name, idx) for idx, seg_name in enumerate(names))
+            keys = sorted(groups, key=lambda key: (order[key[0]], key[1]))
+        for key in keys:
+            # the order of the interval index
+            for segment in sorted(groups[key], key=lambda seg: (seg.start, seg.end, seg.value)):
+                yield segment
+    
+    def regex_selectivity(self, value_regex, name=None, name_prefix=None):
+        '''Report how selective the trigram index is for given `value_regex`.
+        Keyword arguments:
+        name - the name of the segments.
+        name_prefix - if given, overrides `name` and uses all segments matching prefix.
+        Returns a dictionary with the number of `candidates` the regex is run on,
+        the `total` number of segments and their ratio as `selectivity`.'''
+        assert isinstance(value_regex, unicode)
+        names = self._names(name, name_prefix)
+        total = sum(self.count(seg_name) for seg_name in names)
+        candidates = None
+        if self._trigrams is not None:
+            candidates = self._trigram_candidates(names, value_regex)
+        if candidates is None:
+            return {'candidates': total, 'total': total, 'selectivity': 1.0}
+        return {'candidates': len(candidates),
+                'total': total,
+                'selectivity': float(len(candidates)) / max(total, 1)}
+    
+    def _document_names(self, seg_name, doc_name, doc_prefix):
+        '''Get the sorted names of documents having segments with name `seg_name`.'''
         if doc_prefix is not None:
-            generator = self._limit(self._filter_prefix(segments, doc_prefix), limit)
-            if sort:
-                return sorted(generator)
-            else:
-                return generator
-        elif doc_name is not None:
-            generator = self._limit(self._filter_name(segments, doc_name), limit)
-            if sort:
-                return sorted(generator)
-            else:
-                return generator
+            docprefixmap = self._docprefixmap.get(seg_name)
+            if docprefixmap is None:
+                return []
+            return docprefixmap.names(doc_prefix)
+        if (seg_name, doc_name) in self._intervals:
+            return [doc_name]
+        return []
+    
+    def _index_iterator(self, names, doc_name, doc_prefix, sort):
+        '''Generate segments from the interval indices in index order.
+        If `sort` is True, the segments of different names are merged
+        to be ordered by document name first.'''
+        if sort and len(names) > 1:
+            names = list(sorted(names))
+            doc_names = heapq.merge(*[self._document_names(seg_name, doc_name, doc_prefix) for seg_name in names])
+            pairs = ((seg_name, name) for name, _ in groupby(doc_names) for seg_name in names)
         else:
-            raise Exception('At least `doc_name` or `doc_prefix` should be given!')
+            pairs = ((seg_name, name) for seg_name in names for name in self._document_names(seg_name, doc_name, doc_prefix))
+        for key in pairs:
+            index = self._intervals.get(key)
+            if index is not None:
+                for segment in index:
+                    yield segment
     
     def _limit(self, segments, limit):
         if limit is not None:
-            return set(list(segments)[:limit])
+            return islice(segments, limit)
         return segments
     
-    def _filter_name(self, segments, doc_name):
-        return set(seg for seg in segments if seg.doc_name == doc_name)
+    def _filter_value_regex(self, segments, value_regex):
+        pattern = compile_regex(value_regex)
+        return (seg for seg in segments if pattern.search(seg.value) is not None)
     
-    def _filter_prefix(self, segments, doc_prefix):
-        return set(seg for seg in segments if seg.doc_name.startswith(doc_prefix))
+    def _filter_neg_regex(self, segments, neg_regex, names):
+        pattern = compile_regex(neg_regex)
+        candidates = None
+        if self._trigrams is not None:
+            candidates = self._trigram_candidates(names, neg_regex)
+        if candidates is None:
+            return (seg for seg in segments if pattern.search(seg.value) is None)
+        # segments outside the candidates cannot match the negative regex
+        return (seg for seg in segments if seg not in candidates or pattern.search(seg.value) is None)
     
-    def _filter_value_regex(self, segments, value_regex):
-        pattern = re.compile(value_regex, re.UNICODE)
-        return set(seg for seg in segments if pattern.search(seg.value) is not None)
+    def _names(self, name, name_prefix):
+        if name_prefix is not None:
+            assert isinstance(name_prefix, unicode)
+            return list(self._segprefixmap.names(name_prefix))
+        elif name is not None:
+            assert isinstance(name, unicode)
+            return [name]
+        return list(self._segprefixmap.names(u''))
+    
+    def _positional(self, query, doc_name, start, end, name, name_prefix):
+        assert isinstance(doc_name, unicode)
+        assert start < end
+        for seg_name in self._names(name, name_prefix):
+            index = self._intervals.get((seg_name, doc_name))
+            if index is not None:
+                for segment in query(index, start, end):
+                    yield segment
+    
+    def load_overlapping(self, doc_name, start, end, name=None, name_prefix=None):
+        '''Load segments of document `doc_name` sharing at least one character with range [start, end).
+        Keyword arguments:
+        name - the name of the segments.
+        name_prefix - if given, overrides `name` and loads all segments matching prefix.
+        Returns a generator of segments ordered by segment name, start and end.'''
+        return self._positional(IntervalIndex.overlapping, doc_name, start, end, name, name_prefix)
+    
+    def load_contained(self, doc_name, start, end, name=None, name_prefix=None):
+        '''Load segments of document `doc_name` that lie within range [start, end).
+        Takes same arguments as `load_overlapping`.'''
+        return self._positional(IntervalIndex.contained, doc_name, start, end, name, name_prefix)
     
-    def _filter_neg_regex(self, segments, neg_regex):
-        pattern = re.compile(neg_regex, re.UNICODE)
-        return set(seg for seg in segments if pattern.search(seg.value) is None)
+    def load_containing(self, doc_name, start, end, name=None, name_prefix=None):
+        '''Load segments of document `doc_name` that cover the whole range [start, end).
+        Takes same arguments as `load_overlapping`.'''
+        return self._positional(IntervalIndex.containing, doc_name, start, end, name, name_prefix)
+    
+    def _group_by_document(self, segments):
+        groups = dict()
+        for segment in segments:
+            key = (segment.name, segment.doc_name)
+            if key not in groups:
+                groups[key] = []
+            groups[key].append(segment)
+        return groups
     
     def save(self, segments):
         '''Save given segments to the storage.'''
         for segment in segments:
             assert isinstance(segment, Segment)
+        for key, group in self._group_by_document(segments).iteritems():
+            seg_name, doc_name = key
+            if key not in self._intervals:
+                if seg_name not in self._docprefixmap:
+                    self._docprefixmap[seg_name] = PrefixMap()
+                    self._segprefixmap.add(seg_name, seg_name)
+                self._docprefixmap[seg_name].add(doc_name, doc_name)
+                self._intervals[key] = IntervalIndex()
+            new_segments = self._intervals[key].add(group)
+            self._update_counts(seg_name, doc_name, new_segments, 1)
+            self._update_trigrams(seg_name, new_segments, 1)
+    
+    def _update_trigrams(self, seg_name, segments, sign):
+        if self._trigrams is None or len(segments) == 0:
+            return
+        index = self._trigrams.setdefault(seg_name, TrigramIndex())
+        for segment in segments:
+            if sign > 0:
+                index.add(segment, segment.value)
+            else:
+                index.remove(segment, segment.value)
+        if len(index) == 0:
+            del self._trigrams[seg_name]
+    
+    def _update_counts(self, seg_name, doc_name, segments, sign):
+        if len(segments) == 0:
+            return
+        for prefix in count_prefixes(doc_name):
+            key = (seg_name, prefix)
+            count = self._counts.get(key, 0) + sign * len(segments)
+            if count == 0:
+                del self._counts[key]
+            else:
+                self._counts[key] = count
+        value_counts = self._value_counts.setdefault(seg_name, dict())
         for segment in segments:
-            segset = self._segmap.get(segment.name, set())
-            segset.add(segment)
-            self._segmap[segment.name] = segset
-            self._segprefixmap.add(segment.name, segment.name)
+            count = value_counts.get(segment.value, 0) + sign
+            if count == 0:
+                del value_counts[segment.value]
+            else:
+                value_counts[segment.value] = count
+        if len(value_counts) == 0:
+            del self._value_counts[seg_name]
     
     def delete(self, **kwargs):
         '''Delete segments from the storage.
@@ -157,24 +335,61 @@ class SegmentStorage(object):
         doc_name - the name of the document to load segments for.
         doc_prefix - if given, overrides `doc_name` and filters documents by matching their name with the prefix.
         '''
-        for segment in self.load(**kwargs):
-            self._segmap[segment.name].remove(segment)
+        segments = self.load(**kwargs)
+        for key, group in self._group_by_document(segments).iteritems():
+            seg_name, doc_name = key
+            index = self._intervals[key]
+            removed = index.remove(group)
+            self._update_counts(seg_name, doc_name, removed, -1)
+            self._update_trigrams(seg_name, removed, -1)
+            if len(index) == 0:
+                del self._intervals[key]
+                docprefixmap = self._docprefixmap[seg_name]
+                docprefixmap.delete(doc_name, doc_name)
+                if len(docprefixmap) == 0:
+                    del self._docprefixmap[seg_name]
+                    self._segprefixmap.delete(seg_name, seg_name)
 
+    def _counted_query(self, kwargs):
+        '''Parse the arguments of a counting query. Returns None, if the query
+        cannot be answered from the maintained counters.'''
+        if 'limit' in kwargs:
+            return None
+        name, name_prefix, doc_name, doc_prefix, value_regex, neg_regex = self._parse_arguments(kwargs)
+        if value_regex is not None or neg_regex is not None:
+            return None
+        if name_prefix is not None:
+            names = list(self._segprefixmap.names(name_prefix))
+        else:
+            names = [name]
+        return names, doc_name, doc_prefix
+    
     def counts(self, **kwargs):
         '''Get the total counts of the segments.
            Method will return a dictionary, where
               key: segment name
               value: total number of segments with that name
         '''
-        segments = self.load(**kwargs)
+        query = self._counted_query(dict(kwargs))
+        if query is None:
+            return self._scan_counts(lambda seg: seg.name, kwargs)
+        names, doc_name, doc_prefix = query
         counts = {}
-        for seg in segments:
-            count = counts.get(seg.name, 0)
-            counts[seg.name] = count + 1
+        for seg_name in names:
+            if doc_prefix is None:
+                count = len(self._intervals.get((seg_name, doc_name), ()))
+            elif is_count_prefix(doc_prefix):
+                count = self._counts.get((seg_name, doc_prefix), 0)
+            else:
+                count = sum(len(self._intervals[(seg_name, name)])
+                            for name in self._document_names(seg_name, None, doc_prefix))
+            if count > 0:
+                counts[seg_name] = count
         return counts
     
     def count(self, key):
-        return self.counts().get(key, 0)
+        '''Get the total number of segments with name `key`.'''
+        return self._counts.get((key, u''), 0)
     
     def value_counts(self, **kwargs):
         '''Get the total number of values.
@@ -182,9 +397,35 @@ class SegmentStorage(object):
             key: value
             value: total number of such value.
         '''
-        segments = self.load(**kwargs)
+        query = self._counted_query(dict(kwargs))
+        if query is None or query[2] != u'':
+            return self._scan_counts(lambda seg: seg.value, kwargs)
+        counts = {}
+        for seg_name in query[0]:
+            for value, count in self._value_counts.get(seg_name, {}).iteritems():
+                counts[value] = counts.get(value, 0) + count
+        return counts
+    
+    def _scan_counts(self, key, kwargs):
         counts = {}
-        for seg in segments:
-            count = counts.get(seg.value, 0)
-            counts[seg.value] = count + 1
+        for seg in self.load_iterator(**kwargs):
+            k = key(seg)
+            counts[k] = counts.get(k, 0) + 1
         return counts
+
+
+COUNT_PREFIX_SEPARATOR = u':'
+
+def count_prefixes(doc_name):
+    '''Get the document name prefixes that segment counts are maintained for.
+    These are the empty prefix and all prefixes ending with a `:` separator,
+    such as `etsa:` and `etsa:anamnesis:` for document `etsa:anamnesis:123`.'''
+    yield u''
+    idx = doc_name.find(COUNT_PREFIX_SEPARATOR)
+    while idx >= 0:
+        yield doc_name[:idx + 1]
+        idx = doc_name.find(COUNT_PREFIX_SEPARATOR, idx + 1)
+
+def is_count_prefix(doc_prefix):
+    '''Check if segment counts are maintained for given document name prefix.'''
+    return len(doc_prefix) == 0 or doc_prefix.endswith(COUNT_PREFIX_SEPARATOR)
@@ -0,0 +1,113 @@
+'''
+Background writer for saving segments while they are still being computed.
+
+Segments are collected into batches, which are handed over to a writer thread
+through a bounded queue. When the storage cannot keep up, the queue fills up
+and the producer blocks until a batch has been saved. An error raised by the
+storage is re-raised in the producing thread on the next write, flush or close.
+'''
+import logging
+from Queue import Queue
+import sys
+import threading
+
+from hsm.data.segment import Segment
+
+
+logger = logging.getLogger('segmentwriter')
+
+_STOP = object()
+
+
+class SegmentWriter(object):
+    '''Saves segments to a segment storage in batches using a background thread.'''
+
+    def __init__(self, segstorage, batch_size=100, queue_size=10):
+        '''Initialize the writer and start the writer thread.
+        Arguments:
+        segstorage - the storage to save the segments to.
+        batch_size - the number of segments saved with a single `save` call.
+        queue_size - the maximum number of batches waiting to be saved.'''
+        assert batch_size > 0
+        assert queue_size > 0
+        self._segstorage = segstorage
+        self._batch_size = batch_size
+        self._queue = Queue(maxsize=queue_size)
+        self._batch = []
+        self._error = None
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name='segmentwriter')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            # do not hide the original error with a possible error of the writer
+            if not self._closed:
+                self._stop()
+
+    def write(self, segment):
+        '''Queue a single segment for saving.'''
+        assert isinstance(segment, Segment)
+        assert not self._closed
+        self._batch.append(segment)
+        if len(self._batch) >= self._batch_size:
+            self._put_batch()
+
+    def write_all(self, segments):
+        '''Queue all given segments for saving.'''
+        for segment in segments:
+            self.write(segment)
+
+    def flush(self):
+        '''Wait until all written segments have been saved.'''
+        assert not self._closed
+        self._put_batch()
+        self._queue.join()
+        self._raise_error()
+
+    def close(self):
+        '''Save all written segments and stop the writer thread.'''
+        if self._closed:
+            return
+        try:
+            self._put_batch()
+        finally:
+            self._stop()
+        self._raise_error()
+
+    def _stop(self):
+        self._closed = True
+        self._queue.put(_STOP)
+        self._thread.join()
+
+    def _put_batch(self):
+        self._raise_error()
+        if len(self._batch) > 0:
+            self._queue.put(self._batch)
+            self._batch = []
+
+    def _raise_error(self):
+        if self._error is not None:
+            exc_type, exc_value, traceback = self._error
+            raise exc_type, exc_value, traceback
+
+    def _run(self):
+        while True:
+            batch = self._queue.get()
+            try:
+                if batch is _STOP:
+                    return
+                # after an error, keep draining the queue so that the producer does not block
+                if self._error is None:
+                    self._segstorage.save(batch)
+            except Exception:
+                logger.exception('Saving a batch of {0} segments failed'.format(len(batch)))
+                self._error = sys.exc_info()
+            finally:
+                self._queue.task_done()
@@ -0,0 +1,203 @@
+'''
+Positional inverted index over document texts.
+
+Texts are split into lowercased word terms and for every term the index
+stores the documents containing it along with the ordinal positions and
+character offsets of its occurrences. The positions allow phrase queries,
+the offsets are returned as search hits.
+
+The index is also used to prefilter regular expression queries. Literal
+strings that every match must contain are found with `required_literals`
+and split into terms. A term surrounded by other characters of the literal
+must occur in the document exactly, a term at the end of the literal may
+continue in the text, so it is queried as a term prefix. A term at the start
+of the literal may be the tail of a longer word and is not used.
+'''
+import re
+
+from hsm.data.prefixmap import PrefixMap
+from hsm.data.trigramindex import required_literals, AND, OR, LITERAL
+
+
+TERM = 'term'
+PREFIX = 'prefix'
+
+_TERM_REGEX = re.compile(r'\w+', re.UNICODE)
+
+
+def tokenize(text):
+    '''Generate (term, start, end) tuples of lowercased word terms in `text`.'''
+    for match in _TERM_REGEX.finditer(text):
+        yield (match.group(0).lower(), match.start(), match.end())
+
+def term_query(regex):
+    '''Convert `regex` to a query tree over terms.
+    The tree consists of tuples (TERM, term), (PREFIX, prefix), (AND, [children]) and (OR, [children]).
+    Returns None, if the query cannot narrow down the candidates.'''
+    return _term_node(required_literals(regex))
+
+def _term_node(node):
+    if node is None:
+        return None
+    kind, value = node
+    if kind == LITERAL:
+        children = []
+        for term, start, end in tokenize(value):
+            if start == 0:
+                continue
+            elif end == len(value):
+                children.append((PREFIX, term))
+            else:
+                children.append((TERM, term))
+    else:
+        children = [_term_node(child) for child in value]
+        if kind == OR and None in children:
+            return None
+        children = [child for child in children if child is not None]
+    if len(children) == 0:
+        return None
+    if len(children) == 1:
+        return children[0]
+    return (OR if kind == OR else AND, children)
+
+
+class TextIndex(object):
+    '''In-memory positional inverted index of document texts.'''
+
+    def __init__(self):
+        self._postings = dict()
+        self._terms = PrefixMap()
+        self._doc_terms = dict()
+
+    def __len__(self):
+        return len(self._doc_terms)
+
+    def add(self, name, text):
+        '''Index the `text` of document with given `name`.'''
+        assert isinstance(name, unicode)
+        if name in self._doc_terms:
+            self.remove(name)
+        term_positions = _term_positions(text)
+        for term, positions in term_positions.iteritems():
+            if term not in self._postings:
+                self._postings[term] = dict()
+                self._terms.add(term, term)
+            self._postings[term][name] = positions
+        self._doc_terms[name] = set(term_positions)
+
+    def remove(self, name):
+        '''Remove the document with given `name` from the index.'''
+        assert isinstance(name, unicode)
+        for term in self._doc_terms.pop(name, ()):
+            documents = self._postings[term]
+            del documents[name]
+            if len(documents) == 0:
+                del self._postings[term]
+                self._terms.delete(term, term)
+
+    def candidates(self, regex, prefix=u''):
+        '''Get the set of names of documents with names starting with `prefix`, whose texts may match `regex`.
+        Returns None, if the index cannot narrow down the candidates.'''
+        return self.evaluate(term_query(regex), prefix)
+
+    def evaluate(self, query, prefix=u''):
+        '''Evaluate a term query tree, see `term_query`, on documents with names starting with `prefix`.
+        Returns None, if the query does not narrow down the documents.'''
+        if query is None:
+            return None
+        kind, value = query
+        if kind == TERM:
+            return self._documents(value, prefix)
+        elif kind == PREFIX:
+            return self._prefix_documents(value, prefix)
+        results = [self.evaluate(child, prefix) for child in value]
+        if kind == OR:
+            if any(result is None for result in results):
+                return None
+            return set().union(*results)
+        results = [result for result in results if result is not None]
+        if len(results) == 0:
+            return None
+        results.sort(key=len)
+        result = set(results[0])
+        for other in results[1:]:
+            if len(result) == 0:
+                break
+            result &= other
+        return result
+
+    def search(self, terms=None, phrase=None, prefix=u''):
+        '''Search documents containing all `terms` and the `phrase`.
+        Keyword arguments:
+        terms - a list of words that must all occur in the document.
+        phrase - a string, whose words must occur consecutively in the document.
+        prefix - if given, search only documents with names starting with the prefix.
+        Returns a dictionary mapping document names to sorted lists of (start, end) hit offsets.'''
+        assert terms is not None or phrase is not None
+        queries = []
+        if terms is not None:
+            for term in terms:
+                assert isinstance(term, unicode)
+                queries.append([term.lower()])
+        if phrase is not None:
+            assert isinstance(phrase, unicode)
+            queries.append([term for term, _, _ in tokenize(phrase)])
+        postings = dict()
+        for query in queries:
+            for term in query:
+                if term not in postings:
+                    postings[term] = self._term_postings(term)
+        names = None
+        for term, documents in postings.iteritems():
+            docnames = set(name for name in documents if name.startswith(prefix))
+            names = docnames if names is None else names & docnames
+        hits = dict()
+        for name in names or ():
+            offsets = set()
+            for query in queries:
+                found = _phrase_offsets([postings[term][name] for term in query])
+                if len(found) == 0:
+                    offsets = None
+                    break
+                offsets.update(found)
+            if offsets is not None:
+                hits[name] = list(sorted(offsets))
+        return hits
+
+    def _term_postings(self, term):
+        '''Get a dictionary mapping document names to (position, start, end) occurrences of `term`.'''
+        return self._postings.get(term, {})
+
+    def _documents(self, term, prefix):
+        return set(name for name in self._postings.get(term, ()) if name.startswith(prefix))
+
+    def _prefix_documents(self, term_prefix, prefix):
+        names = set()
+        for term in self._terms.names(term_prefix):
+            names.update(name for name in self._postings[term] if name.startswith(prefix))
+        return names
+
+def _term_positions(text):
+    '''Group the occurrences of terms in `text` into lists of (position, start, end) tuples.'''
+    positions = dict()
+    for position, (term, start, end) in enumerate(tokenize(text)):
+        if term not in positions:
+            positions[term] = []
+        positions[term].append((position, start, end))
+    return positions
+
+def _phrase_offsets(occurrences):
+    '''Find the offsets of consecutive occurrences of phrase terms.
+    `occurrences` contains (position, start, end) lists for each term of the phrase.'''
+    if len(occurrences) == 0:
+        return []
+    following = [dict((position, end) for position, _, end in terms) for terms in occurrences[1:]]
+    offsets = []
+    for position, start, end in occurrences[0]:
+        for idx, positions in enumerate(following):
+            end = positions.get(position + idx + 1)
+            if end is None:
+                break
+        if end is not None:
+            offsets.append((start, end))
+    return offsets
@@ -0,0 +1,185 @@
+'''
+Trigram index for narrowing regular expression queries down to candidates.
+
+A regular expression is analyzed for literal strings that every match must
+contain. Each such literal requires all of its trigrams to be present in the
+indexed text, so intersecting (and for alternatives uniting) the posting sets
+of these trigrams gives a superset of the texts the expression can match.
+The real regular expression is then run only on these candidates.
+
+All texts and literals are lowercased, so the same index serves both case
+sensitive and case insensitive expressions.
+'''
+import sre_constants
+import sre_parse
+
+
+AND = 'and'
+OR = 'or'
+LITERAL = 'literal'
+
+# zero width opcodes, that do not break a run of literal characters
+_ZERO_WIDTH = frozenset([sre_constants.AT, sre_constants.ASSERT, sre_constants.ASSERT_NOT])
+_REPEATS = frozenset([sre_constants.MAX_REPEAT, sre_constants.MIN_REPEAT])
+
+
+def trigrams(text):
+    '''Get the set of lowercased trigrams of given text.'''
+    text = text.lower()
+    return set(text[idx:idx + 3] for idx in xrange(len(text) - 2))
+
+def required_literals(regex):
+    '''Analyze `regex` and return a query tree of literal strings that every match contains.
+    The tree consists of tuples (LITERAL, string), (AND, [children]) and (OR, [children]).
+    Returns None, if nothing is known about the matches.'''
+    try:
+        parsed = sre_parse.parse(regex)
+    except sre_constants.error:
+        return None
+    return _simplify(_analyze(parsed))
+
+def _analyze(items):
+    nodes = []
+    run = []
+    def flush():
+        if len(run) > 0:
+            nodes.append((LITERAL, u''.join(run)))
+            del run[:]
+    for op, av in items:
+        if op == sre_constants.LITERAL:
+            run.append(unichr(av))
+        elif op in _ZERO_WIDTH:
+            continue
+        elif op == sre_constants.SUBPATTERN:
+            if _is_exact(av[-1]):
+                run.append(_exact(av[-1]))
+            else:
+                flush()
+                nodes.append(_analyze(av[-1]))
+        elif op == sre_constants.BRANCH:
+            flush()
+            nodes.append((OR, [_analyze(branch) for branch in av[1]]))
+        elif op in _REPEATS:
+            flush()
+            if av[0] >= 1:
+                nodes.append(_analyze(av[2]))
+        else:
+            flush()
+    flush()
+    return (AND, nodes)
+
+def _is_exact(items):
+    '''Check if the parsed items match only a single literal string.'''
+    for op, av in items:
+        if op == sre_constants.SUBPATTERN:
+            if not _is_exact(av[-1]):
+                return False
+        elif op != sre_constants.LITERAL:
+            return False
+    return True
+
+def _exact(items):
+    chars = []
+    for op, av in items:
+        if op == sre_constants.SUBPATTERN:
+            chars.append(_exact(av[-1]))
+        else:
+            chars.append(unichr(av))
+    return u''.join(chars)
+
+def _simplify(node):
+    if node is None:
+        return None
+    kind, value = node
+    if kind == LITERAL:
+        return node
+    children = [_simplify(child) for child in value]
+    if kind == OR:
+        if len(children) == 0 or None in children:
+            return None
+    else:
+        children = [child for child in children if child is not None]
+        if len(children) == 0:
+            return None
+    if len(children) == 1:
+        return children[0]
+    return (kind, children)
+
+def trigram_query(regex):
+    '''Convert `regex` to a query tree over trigrams.
+    The tree consists of trigram strings and tuples (AND, [children]) and (OR, [children]).
+    Returns None, if the query cannot narrow down the candidates.'''
+    return _trigram_node(required_literals(regex))
+
+def _trigram_node(node):
+    if node is None:
+        return None
+    kind, value = node
+    if kind == LITERAL:
+        grams = sorted(trigrams(value))
+        if len(grams) == 0:
+            return None
+        if len(grams) == 1:
+            return grams[0]
+        return (AND, grams)
+    children = [_trigram_node(child) for child in value]
+    if kind == OR and None in children:
+        return None
+    children = [child for child in children if child is not None]
+    if len(children) == 0:
+        return None
+    if len(children) == 1:
+        return children[0]
+    return (kind, children)
+
+
+class TrigramIndex(object):
+    '''In-memory inverted index from trigrams to keys of the texts containing them.'''
+
+    def __init__(self):
+        self._postings = dict()
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    def add(self, key, text):
+        '''Index `text` under given `key`.'''
+        for gram in trigrams(text):
+            if gram not in self._postings:
+                self._postings[gram] = set()
+            self._postings[gram].add(key)
+        self._size += 1
+
+    def remove(self, key, text):
+        '''Remove `key` indexed with `text`.'''
+        for gram in trigrams(text):
+            keys = self._postings.get(gram)
+            if keys is not None:
+                keys.discard(key)
+                if len(keys) == 0:
+                    del self._postings[gram]
+        self._size -= 1
+
+    def candidates(self, regex):
+        '''Get the set of keys, whose texts may match `regex`.
+        Returns None, if the index cannot narrow down the candidates.'''
+        return self.evaluate(trigram_query(regex))
+
+    def evaluate(self, query):
+        '''Evaluate a trigram query tree, see `trigram_query`.'''
+        if query is None:
+            return None
+        if not isinstance(query, tuple):
+            return set(self._postings.get(query, ()))
+        kind, children = query
+        results = [self.evaluate(child) for child in children]
+        if kind == OR:
+            return set().union(*results)
+        results.sort(key=len)
+        result = set(results[0])
+        for other in results[1:]:
+            if len(result) == 0:
+                break
+            result &= other
+        return result
@@ -0,0 +1,102 @@
+'''
+Script for comparing the sweep-line ContainerFilter against the previous
+implementation, which compared every segment with the whole container
+collection of its document.
+
+Synthetic documents are split into sentences and tokens. Tokens are used as
+basic segments and sentences as containers, so that all four include and
+keep source modes are exercised. The script checks that both implementations
+yield identical output.
+'''
+
+import argparse
+import random
+import time
+
+from hsm.data.segment import Segment
+from hsm.tools.filter import ContainerFilter
+
+
+class LegacyContainerFilter(ContainerFilter):
+    '''The previous ContainerFilter implementation, kept for comparison.'''
+
+    def _is_matched(self, segments, collection):
+        for segment in segments:
+            for col_segment in collection:
+                if segment.start >= col_segment.start and segment.end <= col_segment.end:
+                    yield segment
+                    break
+
+    def _matches(self, segments, collection):
+        for segment in segments:
+            for col_segment in collection:
+                if segment.start <= col_segment.start and segment.end >= col_segment.end:
+                    yield segment
+                    break
+
+
+def document_segments(doc_name, sentences, rnd):
+    '''Generate sentence and token segments of a synthetic document.
+    Some tokens cross sentence boundaries and some sentences are dropped,
+    so that not every segment matches.'''
+    tokens = []
+    containers = []
+    position = 0
+    # an upper bound of the document length, tokens have at most 40 * 13 characters per sentence
+    doc_len = sentences * (40 * 13 + 4)
+    for _ in xrange(sentences):
+        length = rnd.randint(5, 40)
+        start = position
+        for _ in xrange(length):
+            token_length = rnd.randint(1, 12)
+            tokens.append(Segment(u'token', u'', None, position, position + token_length, doc_name, doc_len))
+            position += token_length + 1
+        if rnd.random() < 0.05:
+            tokens.append(Segment(u'token', u'', None, position - 3, position + 3, doc_name, doc_len))
+        if rnd.random() < 0.9:
+            containers.append(Segment(u'sentence', u'', None, start, position, doc_name, doc_len))
+        position += 1
+    rnd.shuffle(tokens)
+    return tokens, containers
+
+def generate(documents, sentences, seed):
+    rnd = random.Random(seed)
+    tokens, containers = [], []
+    for idx in xrange(documents):
+        doc_tokens, doc_containers = document_segments(u'doc:{0:06d}'.format(idx), sentences, rnd)
+        tokens.extend(doc_tokens)
+        containers.extend(doc_containers)
+    return tokens, containers
+
+def run(cls, basic, container, includes, keep_source):
+    start = time.time()
+    result = list(cls(iter(basic), iter(container), includes, keep_source).get())
+    return result, time.time() - start
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark container filter implementations.')
+    parser.add_argument('--documents', type=int, default=1, help='The number of documents to generate.')
+    parser.add_argument('--sentences', type=int, default=2000, help='The number of sentences per document.')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed for generating documents.')
+    args = parser.parse_args()
+
+    tokens, sentences = generate(args.documents, args.sentences, args.seed)
+    print 'documents: {0}, tokens: {1}, sentences: {2}'.format(args.documents, len(tokens), len(sentences))
+    print '{0:<28} {1:>10} {2:>12} {3:>12} {4:>10}'.format('mode', 'output', 'legacy (s)', 'sweep (s)', 'speedup')
+    modes = [('token in sentence', tokens, sentences, True, True),
+             ('sentence with token', tokens, sentences, True, False),
+             ('sentence covers token', sentences, tokens, False, True),
+             ('token within sentence', sentences, tokens, False, False)]
+    for label, basic, container, includes, keep_source in modes:
+        legacy, legacy_time = run(LegacyContainerFilter, basic, container, includes, keep_source)
+        sweep, sweep_time = run(ContainerFilter, basic, container, includes, keep_source)
+        if legacy != sweep:
+            raise AssertionError('Implementations returned different results for mode: ' + label)
+        print '{0:<28} {1:>10} {2:>12.3f} {3:>12.3f} {4:>9.1f}x'.format(label,
+                                                                       len(sweep),
+                                                                       legacy_time,
+                                                                       sweep_time,
+                                                                       legacy_time / max(sweep_time, 1e-9))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+'''
+Script for benchmarking the numeric value extractors on synthetic clinical texts.
+
+Synthetic documents are generated from clinical text fragments, some of which
+contain blood pressures, pulses, temperatures, dates and other measurements,
+see `hsm.data.generator.clinicaltext`. The `density` option controls the share
+of fragments containing measurements.
+
+First, each extractor is run with the sequential engine, which scans the document
+once per pattern, with the combined engine and with the combined engine behind
+the digit window prefilter. The script checks that all runs yield identical output.
+Then the throughput of each extractor with the default settings is reported in
+documents and megabytes of UTF-8 text per second, together with the share of the
+planted measurements it found. With the `profile` option, the time, raw match count
+and surviving match count of each pattern are reported, timed with the sequential engine.
+'''
+
+import argparse
+import time
+
+from hsm.data.generator.clinicaltext import generate_documents
+from hsm.tools.numextractor import BloodPressure, Temperature, Medicine, Date, Timex, Measurements, \
+    NumExtractor, EXTRACTORS
+
+
+def run(extractor, documents):
+    start = time.time()
+    result = [extractor.extract(document) for document in documents]
+    return result, time.time() - start
+
+def throughput(name, documents, planted, size, workers):
+    extractor = NumExtractor(extractors=[name])
+    start = time.time()
+    values = list(extractor.extract_many(documents, workers))
+    seconds = max(time.time() - start, 1e-9)
+    found = sum(1 for ps, vs in zip(planted, values) for p in ps if p.extractor == name and p.found(vs))
+    total = sum(1 for ps in planted for p in ps if p.extractor == name)
+    print '{0:<22} {1:>10.1f} {2:>8.3f} {3:>8} {4:>8}'.format(name, len(documents) / seconds, size / seconds / 1e6, total,
+                                                            '-' if total == 0 else '{0:.1%}'.format(float(found) / total))
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark numeric value extractors on synthetic clinical texts.')
+    parser.add_argument('--documents', type=int, default=200, help='The number of documents to generate.')
+    parser.add_argument('--fragments', type=int, default=40, help='The number of text fragments per document.')
+    parser.add_argument('--density', type=float, default=0.1, help='The share of fragments containing measurements.')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed for generating documents.')
+    parser.add_argument('--workers', type=int, default=None, help='The number of processes measuring the throughput.')
+    parser.add_argument('--profile', action='store_true', help='Report the time and match counts of each pattern.')
+    args = parser.parse_args()
+
+    generated = generate_documents(args.documents, args.fragments, args.density, args.seed)
+    documents = [text for text, _ in generated]
+    planted = [values for _, values in generated]
+    size = sum(len(document.encode('utf-8')) for document in documents)
+    print 'documents: {0}, characters: {1}, bytes: {2}, planted values: {3}'.format(len(documents),
+                                                                                  sum(len(document) for document in documents),
+                                                                                  size, sum(len(ps) for ps in planted))
+    print '{0:<14} {1:>9} {2:>8} {3:>16} {4:>14} {5:>15} {6:>10}'.format('extractor', 'patterns', 'matches',
+                                                                        'sequential (s)', 'combined (s)',
+                                                                        'prefilter (s)', 'speedup')
+    for cls in [BloodPressure, Temperature, Medicine, Date, Timex, Measurements]:
+        sequential, sequential_time = run(cls(engine='sequential'), documents)
+        combined, combined_time = run(cls(engine='combined'), documents)
+        prefiltered, prefilter_time = run(cls(engine='combined', prefilter=True), documents)
+        if sequential != combined or sequential != prefiltered:
+            raise AssertionError('Engines returned different results for extractor: ' + cls.__name__)
+        best_time = min(combined_time, prefilter_time)
+        print '{0:<14} {1:>9} {2:>8} {3:>16.3f} {4:>14.3f} {5:>15.3f} {6:>9.1f}x'.format(cls.__name__,
+                                                                                    len(cls().patterns),
+                                                                                    sum(len(ms) for ms in combined),
+                                                                                    sequential_time,
+                                                                                    combined_time,
+                                                                                    prefilter_time,
+                                                                                    sequential_time / max(best_time, 1e-9))
+    print
+    print '{0:<22} {1:>10} {2:>8} {3:>8} {4:>8}'.format('extractor', 'docs/s', 'MB/s', 'planted', 'found')
+    for name in sorted(EXTRACTORS):
+        throughput(name, documents, planted, size, args.workers)
+
+    if args.profile:
+        extractor = NumExtractor(extractors=sorted(EXTRACTORS), engine='sequential', profile=True)
+        for document in documents:
+            extractor.extract(document)
+        print
+        for line in extractor.report.profile.summary():
+            print line
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,152 @@
+'''
+Script for comparing memory usage and query latency of the sorted key
+PrefixMap against the previous implementation, which stored each value in a
+set for every prefix of its name.
+'''
+
+import argparse
+import random
+import sys
+import time
+
+from hsm.data.prefixmap import PrefixMap, prefixes
+
+
+class FanoutPrefixMap(object):
+    '''The previous PrefixMap implementation, kept for comparison.'''
+
+    def __init__(self):
+        self._map = dict()
+
+    def add(self, name, value):
+        for key in prefixes(name):
+            if key not in self._map:
+                self._map[key] = set()
+            self._map[key].add(value)
+
+    def get(self, prefix):
+        values = set()
+        if prefix in self._map:
+            for value in self._map[prefix]:
+                values.add(value)
+        return values
+
+    def delete(self, prefix, value):
+        for key in prefixes(prefix):
+            if key in self._map:
+                self._map[key].remove(value)
+                if len(self._map[key]) == 0:
+                    del self._map[key]
+
+
+def deep_size(obj, seen=None):
+    '''Approximate the memory used by `obj` and everything it references.'''
+    if seen is None:
+        seen = set()
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        for key, value in obj.iteritems():
+            size += deep_size(key, seen) + deep_size(value, seen)
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        for value in obj:
+            size += deep_size(value, seen)
+    elif hasattr(obj, '__dict__'):
+        size += deep_size(obj.__dict__, seen)
+    return size
+
+def document_names(n, seed):
+    '''Generate ETSA-like document names such as etsa:anamnesis:123456789.'''
+    rnd = random.Random(seed)
+    fields = [u'anamnesis', u'anamsum', u'diagnosis', u'dcase']
+    names = set()
+    while len(names) < n:
+        names.add(u'etsa:{0}:{1}'.format(rnd.choice(fields), rnd.randint(10 ** 8, 10 ** 9 - 1)))
+    return list(names)
+
+def timed(func, *args):
+    start = time.time()
+    result = func(*args)
+    return result, time.time() - start
+
+def build(cls, names):
+    prefixmap = cls()
+    for name in names:
+        prefixmap.add(name, name)
+    # the sorted key array is built lazily, so include it in the build time
+    prefixmap.get(u'')
+    return prefixmap
+
+def run_queries(prefixmap, queries):
+    total = 0
+    for prefix in queries:
+        total += len(prefixmap.get(prefix))
+    return total
+
+def run_head_queries(prefixmap, queries, n=10):
+    '''Take the first `n` values of each query, as a limited storage query would.'''
+    iterator = getattr(prefixmap, 'iterator', prefixmap.get)
+    total = 0
+    for prefix in queries:
+        for idx, _ in enumerate(iterator(prefix)):
+            if idx + 1 >= n:
+                break
+        total += 1
+    return total
+
+def delete_all(prefixmap, names):
+    '''Delete the names one at a time, as the storages do when deleting documents.'''
+    for name in names:
+        prefixmap.delete(name, name)
+
+def benchmark(cls, names, queries):
+    prefixmap, build_time = timed(build, cls, names)
+    total, query_time = timed(run_queries, prefixmap, queries)
+    _, head_time = timed(run_head_queries, prefixmap, queries)
+    memory = deep_size(prefixmap) - deep_size(names)
+    return {'build': build_time,
+            'query': query_time / len(queries),
+            'head': head_time / len(queries),
+            'memory': memory,
+            'results': total}
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark prefix map implementations.')
+    parser.add_argument('--names', type=int, default=100000, help='The number of document names to add.')
+    parser.add_argument('--queries', type=int, default=1000, help='The number of prefix queries to run.')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed for generating names.')
+    args = parser.parse_args()
+
+    names = document_names(args.names, args.seed)
+    rnd = random.Random(args.seed)
+    queries = [name[:rnd.randint(len(u'etsa:a'), len(name))] for name in rnd.sample(names, args.queries)]
+
+    print 'names: {0}, queries: {1}'.format(len(names), len(queries))
+    print '{0:<16} {1:>10} {2:>14} {3:>14} {4:>14}'.format('implementation', 'build (s)', 'get (ms)',
+                                                           'first 10 (ms)', 'memory (MB)')
+    results = []
+    for cls in [FanoutPrefixMap, PrefixMap]:
+        res = benchmark(cls, names, queries)
+        results.append(res['results'])
+        print '{0:<16} {1:>10.2f} {2:>14.3f} {3:>14.3f} {4:>14.1f}'.format(cls.__name__,
+                                                                        res['build'],
+                                                                        res['query'] * 1000,
+                                                                        res['head'] * 1000,
+                                                                        res['memory'] / 1024.0 / 1024.0)
+    if len(set(results)) != 1:
+        raise AssertionError('Implementations returned different results!')
+
+    # deleting all names one at a time should take time linear in their number
+    print
+    print '{0:<16} {1:>10} {2:>14} {3:>16}'.format('deleting names', 'names', 'total (s)', 'per name (us)')
+    for n in [len(names) // 4, len(names) // 2, len(names)]:
+        prefixmap = build(PrefixMap, names[:n])
+        _, delete_time = timed(delete_all, prefixmap, names[:n])
+        if len(prefixmap) != 0:
+            raise AssertionError('Names were left after deleting all names!')
+        print '{0:<16} {1:>10} {2:>14.3f} {3:>16.2f}'.format('PrefixMap', n, delete_time, delete_time / max(n, 1) * 1e6)
+
+if __name__ == '__main__':
+    main()
@@ -5,6 +5,7 @@ related databases.
 
 import MySQLdb
 import ast
+from itertools import izip, tee
 
 from hsm.tools.numextractor import NumExtractor
 
@@ -76,7 +77,7 @@ class SqlExtractor(object):
                                      db=self._db,
                                      use_unicode=True,
                                      charset='utf8')
-        self._extractor = NumExtractor()
+        self._extractor = _num_extractor(kwargs)
         self._create_tables()
     
     def _create_tables(self):
@@ -122,22 +123,21 @@ class SqlExtractor(object):
     def _insert_kmi(self, epiId, field, values):
         pass
     
-    def process(self, field):
+    def process(self, field, workers=None, chunksize=100):
+        '''Extract the values of given field of all rows.
+        workers - the number of extracting processes, see `NumExtractor.extract_many`.'''
         sql = 'SELECT `epiId`, `' + field + '` FROM ' + self._abs_intable()
         print sql
         cur = self._conn.cursor()
         cur.execute(sql)
         
-        row = cur.fetchone()
-        while row is not None:
-            if row[1] is not None:
-                epiId = long(row[0])
-                document = unicode(row[1])
-                values = self._extractor.extract(document)
-                
-                self._insert_rr(epiId, field, values)
-                #self._insert_temp(epiId, field, values)
-            row = cur.fetchone()
+        rows, documents = tee(row for row in _fetch_rows(cur) if row[1] is not None)
+        documents = (unicode(row[1]) for row in documents)
+        for row, values in izip(rows, self._extractor.extract_many(documents, workers, chunksize)):
+            epiId = long(row[0])
+            self._insert_rr(epiId, field, values)
+            #self._insert_temp(epiId, field, values)
+        _print_report(self._extractor.report)
 
 '''
 CREATE TABLE `bloodpressures_split` (
@@ -168,7 +168,7 @@ class SqlVisitExtractor(object):
                                      db=self._db,
                                      use_unicode=True,
                                      charset='utf8')
-        self._extractor = NumExtractor()
+        self._extractor = _num_extractor(kwargs)
 
     def to_plain(self, json):
         sentences = ast.literal_eval(json)
@@ -192,19 +192,35 @@ class SqlVisitExtractor(object):
             cur.executemany('insert into `' + self._db + '`.`bloodpressures_visits` (visitID, epiId, epiTime, patId, epiType, fieldName, date, systolic, diastolic, pulse) values (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)', tuples)
             cur.execute('commit')
 
-    def process(self):
+    def process(self, workers=None, chunksize=100):
+        '''Extract the bloodpressures of all visits.
+        workers - the number of extracting processes, see `NumExtractor.extract_many`.'''
         sql = 'SELECT id, epiId, epiTime, patId, epiType, fieldName, date, json from `' + self._db + '`.`visits`;'
         print sql
         cur = self._conn.cursor()
         cur.execute(sql)
         
-        row = cur.fetchone()
-        while row is not None:
-            if row[7] is not None:
-                values = self._extractor.extract(self.to_plain(row[7]))
-                self._insert_rr(row, values)
-                #self._insert_temp(epiId, field, values)
-            row = cur.fetchone()
+        rows, documents = tee(row for row in _fetch_rows(cur) if row[7] is not None)
+        documents = (self.to_plain(row[7]) for row in documents)
+        for row, values in izip(rows, self._extractor.extract_many(documents, workers, chunksize)):
+            self._insert_rr(row, values)
+            #self._insert_temp(epiId, field, values)
+        _print_report(self._extractor.report)
+
+def _num_extractor(kwargs):
+    '''Create the extractor with the time budget options among `kwargs`, see `NumExtractor`.'''
+    return NumExtractor(**dict((option, kwargs.get(option)) for option in NumExtractor.options))
+
+def _print_report(report):
+    for line in report.summary():
+        print line.encode('utf-8')
+
+def _fetch_rows(cursor):
+    '''Generate the rows of an executed cursor.'''
+    row = cursor.fetchone()
+    while row is not None:
+        yield row
+        row = cursor.fetchone()
 
 if __name__ == '__main__':
     extr = SqlVisitExtractor(user='etsad', passwd='', host='127.0.0.1', port=3306, db='work')
@@ -6,7 +6,10 @@ from pprint import pprint
 import re
 
 from hsm.server.util import mimetype
-from hsm.tools.filter import Filter, FILTER_NAME
+from hsm.tools.filter import Filter, FILTER_NAME, OUTPUT_NAME, VIRTUAL, \
+    BASIC_STAGE, CONTAINER_STAGE, SPLITTER_STAGE, MIXIN_STAGE, OUTPUT_STAGE
+from hsm.tools.filtergraph import FilterGraph
+from hsm.tools.virtualsegmentstorage import VirtualSegmentStorage
 
 
 NAME_PREFIX = u'filtertool:'
@@ -59,14 +62,6 @@ def segments_html(segs, docstorage, context_size=30):
     htmls = [html.replace('\n', '<br/>') for html in htmls]
     return u'<hr/>'.join(htmls)
 
-def head(iterable, n):
-    elems = []
-    for idx, elem in enumerate(iterable):
-        if idx >= n:
-            return elems
-        elems.append(elem)
-    return elems
-
 
 class FilterServer(object):
     '''Filter service.'''
@@ -75,6 +70,46 @@ class FilterServer(object):
         self._segstorage = segstorage
         self._docstorage= docstorage
         self._setstorage = setstorage
+        # compiled filter plans with the settings they were compiled from
+        self._plans = dict()
+        # computes the outputs of virtual filters on demand, the cache is kept between requests
+        self._virtual = VirtualSegmentStorage(self._segstorage, self._docstorage, self._filters())
+    
+    def _plan(self, name):
+        '''Get the compiled plan of the saved filter with given name, recompiling it if the settings have changed.'''
+        settings = self._setstorage.load(encode_name(name))
+        cached = self._plans.get(name)
+        if cached is None or cached[0] != settings:
+            cached = (settings, Filter(**settings).compile())
+            self._plans[name] = cached
+        return cached[1]
+    
+    def _filters(self):
+        return [Filter(**self._setstorage.load(name)) for name in self._setstorage.list(NAME_PREFIX)]
+    
+    def _virtual_segstorage(self):
+        '''Get the segment storage computing the outputs of virtual filters on demand.'''
+        return self._virtual
+    
+    def _update_virtual(self, previous, settings):
+        '''Update the virtual layers after the settings of a filter have changed from `previous`
+        to `settings`. Either of them is None, if the filter did not exist before or was removed.'''
+        for filt in [previous, settings]:
+            if filt is None:
+                continue
+            name = filt[OUTPUT_NAME]
+            if self._virtual.is_virtual(name):
+                self._virtual.unregister(name)
+            else:
+                # the output layer of the filter is an input of the virtual layers depending on it
+                self._virtual.invalidate(name)
+        if settings is not None and settings.get(VIRTUAL, False):
+            self._virtual.register(settings)
+    
+    def _saved_settings(self, name):
+        if encode_name(name) not in self._setstorage.list(NAME_PREFIX):
+            return None
+        return self._setstorage.load(encode_name(name))
 
     @cherrypy.expose
     @mimetype('application/hsm')
@@ -106,7 +141,9 @@ class FilterServer(object):
     @cherrypy.expose
     def remove(self, name):
         try:
+            previous = self._saved_settings(name)
             self._setstorage.delete(encode_name(name))
+            self._update_virtual(previous, None)
             return json.dumps({'result': 'OK'})
         except Exception, e:
             return json.dumps({'result': 'FAIL', 'error': str(e)})
@@ -122,57 +159,85 @@ class FilterServer(object):
         try:
             filt = Filter(**kwargs)
             settings = dict(filt)
+            previous = self._saved_settings(settings[FILTER_NAME])
             self._setstorage.save(encode_name(settings[FILTER_NAME]), settings)
+            self._update_virtual(previous, filt)
             return json.dumps({'result': 'OK'})
         except Exception, e:
             return json.dumps({'result': 'FAIL', 'error': str(e)})
     
     
     @cherrypy.expose
-    def preview_sample(self, name):
+    def preview_sample(self, name, budget=u'2.0'):
+        '''Preview the filter by running it once for at most `budget` seconds
+        and showing random samples of the segments of each stage.'''
         try:
-            settings = self._setstorage.load(encode_name(name))
-            filt = Filter(**settings)
+            plan = self._plan(name)
             limit = 300
             query_limit=10000
             context_size = 60
             
-            # preview basic
-            basic_segs = head(filt.filter_basic(self._segstorage, self._docstorage, limit=query_limit), limit)
-            basic = segments_html(basic_segs, self._docstorage, context_size)
-            
-            # preview container
-            container_segs = head(filt.filter_container(basic_segs, self._segstorage), limit)
-            container = segments_html(container_segs, self._docstorage, context_size)
-            
-            # preview splitter
-            splitter_segs = head(filt.filter_splitter(container_segs), limit)
-            splitter = segments_html(splitter_segs, self._docstorage, context_size)
-            
-            # preview mixin
-            mixin_segs = head(filt.filter_mixin(splitter_segs, self._segstorage), limit)
-            mixin = segments_html(mixin_segs, self._docstorage, context_size)
-            
-            # preview final output
-            output_segs = head(filt.filter(self._segstorage, self._docstorage), limit)
-            output = segments_html(output_segs, self._docstorage, context_size)
-            
-            data = {'basic': basic,
-                    'container': container,
-                    'mixin': mixin,
-                    'splitter': splitter,
-                    'output': output}
+            preview = plan.preview(self._virtual_segstorage(), self._docstorage,
+                                   sample_size=limit, budget=float(budget), limit=query_limit)
+            data = {'counts': dict(), 'complete': preview['complete']}
+            # stages missing from the filter show the segments of the previous stage
+            previous = BASIC_STAGE
+            for stage in [BASIC_STAGE, CONTAINER_STAGE, SPLITTER_STAGE, MIXIN_STAGE, OUTPUT_STAGE]:
+                if stage in preview:
+                    previous = stage
+                data[stage] = segments_html(preview[previous]['sample'], self._docstorage, context_size)
+                data['counts'][stage] = preview[previous]['count']
             
             return json.dumps({'result': 'OK', 'data': data})
         except Exception, e:
             return json.dumps({'result': 'FAIL', 'error': str(e)})
     
+    @cherrypy.expose
+    @mimetype('application/hsm')
+    def explain_filter(self, name, limit=None):
+        '''Run the filter without saving the output and report the estimated and
+        actual segment counts and the time spent in each stage.'''
+        try:
+            if limit is not None:
+                limit = int(limit)
+            report = self._plan(name).explain(self._virtual_segstorage(), self._docstorage, limit=limit)
+            return json.dumps({'result': 'OK', 'data': report})
+        except Exception, e:
+            return json.dumps({'result': 'FAIL', 'error': str(e)})
+    
     @cherrypy.expose
     def apply_filter(self, name):
         try:
             settings = self._setstorage.load(encode_name(name))
             filt = Filter(**settings)
-            filt.apply(self._segstorage, self._docstorage)
+            if filt.get(VIRTUAL, False):
+                # the output of a virtual filter is computed on demand
+                self._segstorage.delete(name=filt[OUTPUT_NAME])
+            else:
+                # the graph also applies the producers of input layers that were fused away
+                filters = self._filters()
+                FilterGraph(filters).apply(self._segstorage, self._docstorage, changed=[filt[FILTER_NAME]],
+                                           downstream=False)
+                for other in filters:
+                    self._virtual.invalidate(other[OUTPUT_NAME])
+        except Exception, e:
+            return json.dumps({'result': 'FAIL', 'error': str(e)})
+
+    @cherrypy.expose
+    @mimetype('application/hsm')
+    def apply_all(self, changed=None, fuse=u'false'):
+        '''Apply all saved filters in dependency order.
+        If `changed` filter names are given, apply only them and the filters depending on them.'''
+        try:
+            filters = self._filters()
+            if isinstance(changed, basestring):
+                changed = [changed]
+            levels = FilterGraph(filters).apply(self._segstorage, self._docstorage,
+                                                changed=changed, fuse=fuse == u'true')
+            # the layers were written directly to the underlying storage
+            for filt in filters:
+                self._virtual.invalidate(filt[OUTPUT_NAME])
+            return json.dumps({'result': 'OK', 'data': levels})
         except Exception, e:
             return json.dumps({'result': 'FAIL', 'error': str(e)})
 
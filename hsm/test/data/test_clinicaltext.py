@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+import unittest
+
+from hsm.data.generator.clinicaltext import generate_documents, PlantedValue, TEMPLATES
+from hsm.tools.numextractor import NumExtractor, EXTRACTORS
+
+
+class ClinicalTextTest(unittest.TestCase):
+
+    def test_reproducible(self):
+        first = generate_documents(5, density=0.5, seed=3)
+        second = generate_documents(5, density=0.5, seed=3)
+        self.assertEqual([text for text, _ in first], [text for text, _ in second])
+        self.assertNotEqual([text for text, _ in first], [text for text, _ in generate_documents(5, density=0.5, seed=4)])
+
+    def test_offsets(self):
+        for text, planted in generate_documents(20, density=0.5):
+            for value in planted:
+                for field in value.fields.itervalues():
+                    self.assertEqual(text[field['start']:field['end']], field['original'])
+
+    def test_density(self):
+        self.assertEqual(sum(len(planted) for _, planted in generate_documents(10, density=0.0)), 0)
+        self.assertTrue(all(len(planted) > 0 for _, planted in generate_documents(10, fragments=1, density=1.0)))
+
+    def test_found(self):
+        # every template alone is extracted as planted
+        extractor = NumExtractor(extractors=EXTRACTORS.keys())
+        documents = generate_documents(20 * len(TEMPLATES), fragments=1, density=1.0)
+        self.assertEqual(set(value.extractor for _, planted in documents for value in planted), set(EXTRACTORS))
+        for text, planted in documents:
+            values = extractor.extract(text)
+            for value in planted:
+                self.assertTrue(value.found(values), text)
+        value = PlantedValue('record_timex', {'value': {'value': 3.0, 'original': u'3', 'start': 0, 'end': 1}})
+        self.assertTrue(value.found({'record_timex': [{'value': {'value': 3.0, 'start': 0}}]}))
+        self.assertFalse(value.found({'record_timex': [{'value': {'value': 3.0, 'start': 1}}]}))
+        self.assertFalse(value.found({}))
@@ -42,6 +42,53 @@ class DocumentStorageTest(unittest.TestCase):
         texts = set(self.storage().load_all(u'', regex=u'where', neg_regex=u'Mexico'))
         self.assertEqual(texts, set([self.documentC()]))
     
+    def test_load_regex_terms(self):
+        texts = set(self.storage().load_all(u'', regex=u'in the Mex'))
+        self.assertEqual(texts, set([self.documentB()]))
+    
+    def test_load_regex_alternation(self):
+        texts = set(self.storage().load_all(u'', regex=u'the first|in whatever'))
+        self.assertEqual(texts, set([self.documentA(), self.documentC()]))
+    
+    def test_load_regex_case_insensitive(self):
+        texts = set(self.storage().load_all(u'', regex=u'(?i)IN THE MEXICO'))
+        self.assertEqual(texts, set([self.documentB()]))
+    
+    def test_count(self):
+        storage = self.storage()
+        self.assertEqual(storage.count(), 3)
+        self.assertEqual(storage.count(u'DOCUMENT B'), 1)
+        self.assertEqual(storage.count(u'NONE'), 0)
+    
+    def test_load_names(self):
+        storage = self.storage()
+        self.assertEqual(storage.load_names(u''), [u'DOCUMENT A', u'DOCUMENT B', u'DOCUMENT C'])
+        self.assertEqual(storage.load_names(u'DOCUMENT B'), [u'DOCUMENT B'])
+        self.assertEqual(storage.load_names(u'', limit=2), [u'DOCUMENT A', u'DOCUMENT B'])
+    
+    def test_load_names_regex(self):
+        storage = self.storage()
+        self.assertEqual(storage.load_names(u'', regex=u'where'), [u'DOCUMENT B', u'DOCUMENT C'])
+        self.assertEqual(storage.load_names(u'', regex=u'where', neg_regex=u'Mexico'), [u'DOCUMENT C'])
+    
+    def test_search_terms(self):
+        hits = self.storage().search(terms=[u'somewhere', u'In'])
+        self.assertEqual(hits, {u'DOCUMENT B': [(0, 9), (10, 12)],
+                                u'DOCUMENT C': [(0, 9), (18, 20)]})
+    
+    def test_search_phrase(self):
+        hits = self.storage().search(phrase=u'in the')
+        self.assertEqual(hits, {u'DOCUMENT B': [(10, 16)]})
+    
+    def test_search_prefix(self):
+        hits = self.storage().search(terms=[u'somewhere'], prefix=u'DOCUMENT C')
+        self.assertEqual(hits, {u'DOCUMENT C': [(0, 9)]})
+    
+    def test_search_after_delete(self):
+        storage = self.storage()
+        storage.delete(u'DOCUMENT B')
+        self.assertEqual(storage.search(phrase=u'in the'), {})
+    
     def test_load_iterator(self):
         iterator = self.storage().load_iterator(u'')
         expected = self.documents()
@@ -114,3 +161,15 @@ class DocumentStorageTest(unittest.TestCase):
         storage = self.emptystorage()
         storage.save_all(self.documents())
         return storage
+
+
+class TextIndexDocumentStorageTest(DocumentStorageTest):
+    '''Reuse DocumentStorageTest cases with the text index enabled.'''
+    
+    def test_load_regex_after_delete(self):
+        storage = self.storage()
+        storage.delete(u'DOCUMENT B')
+        self.assertEqual(storage.load_all(u'', regex=u'in the Mex'), [])
+    
+    def emptystorage(self):
+        return DocumentStorage(text_index=True)
@@ -0,0 +1,39 @@
+import unittest
+
+import hsm
+from hsm.data.filterstatestorage import FilterStateStorage
+
+
+class FilterStateStorageTest(unittest.TestCase):
+
+    def test_load(self):
+        self.assertEqual(self.storage().load(u'output'), self.hashes())
+    
+    def test_load_nonexistent(self):
+        self.assertEqual(self.storage().load(u'other output'), {})
+    
+    def test_update(self):
+        storage = self.storage()
+        storage.update(u'output', {u'DOC B': u'changed', u'DOC C': u'new'})
+        self.assertEqual(storage.load(u'output'), {u'DOC A': u'a', u'DOC B': u'changed', u'DOC C': u'new'})
+    
+    def test_delete_documents(self):
+        storage = self.storage()
+        storage.delete(u'output', [u'DOC A'])
+        self.assertEqual(storage.load(u'output'), {u'DOC B': u'b'})
+    
+    def test_delete_all(self):
+        storage = self.storage()
+        storage.delete(u'output')
+        self.assertEqual(storage.load(u'output'), {})
+    
+    def hashes(self):
+        return {u'DOC A': u'a', u'DOC B': u'b'}
+    
+    def emptystorage(self):
+        return FilterStateStorage()
+    
+    def storage(self):
+        storage = self.emptystorage()
+        storage.update(u'output', self.hashes())
+        return storage
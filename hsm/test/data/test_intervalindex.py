@@ -0,0 +1,83 @@
+import random
+import unittest
+
+from hsm.data.intervalindex import IntervalIndex
+from hsm.data.segment import Segment
+
+
+class IntervalIndexTest(unittest.TestCase):
+    
+    def test_add_duplicates(self):
+        index = IntervalIndex()
+        self.assertEqual(index.add([self.long(), self.short1()]), [self.long(), self.short1()])
+        self.assertEqual(index.add([self.long(), self.short2()]), [self.short2()])
+        self.assertEqual(list(index), [self.long(), self.short1(), self.short2()])
+    
+    def test_overlapping(self):
+        self.assertEqual(list(self.index().overlapping(9, 10)), [self.long()])
+        self.assertEqual(list(self.index().overlapping(2, 6)), [self.long(), self.short1(), self.short2()])
+        self.assertEqual(list(self.index().overlapping(20, 30)), [])
+    
+    def test_contained(self):
+        self.assertEqual(list(self.index().contained(2, 20)), [self.short1(), self.short2()])
+        self.assertEqual(list(self.index().contained(2, 4)), [self.short1()])
+    
+    def test_containing(self):
+        self.assertEqual(list(self.index().containing(5, 6)), [self.long(), self.short2()])
+        self.assertEqual(list(self.index().containing(0, 15)), [self.long()])
+    
+    def test_remove(self):
+        index = self.index()
+        self.assertEqual(index.remove([self.long(), self.long()]), [self.long()])
+        self.assertEqual(list(index.containing(9, 10)), [])
+        self.assertFalse(self.long() in index)
+    
+    def test_add_batches(self):
+        index = IntervalIndex([self.short2()])
+        index.add([self.short1(), self.short2()])
+        index.add([self.long()])
+        self.assertEqual(list(index), [self.long(), self.short1(), self.short2()])
+        self.assertEqual(len(index), 3)
+    
+    def test_long_segment(self):
+        shorts = [Segment(u'seg', u'', None, start, start + 2, u'DOC', 1000) for start in xrange(0, 1000, 2)]
+        whole = Segment(u'seg', u'', None, 0, 1000, u'DOC', 1000)
+        index = IntervalIndex(shorts + [whole])
+        self.assertEqual(list(index.overlapping(500, 502)), [whole, shorts[250]])
+        self.assertEqual(list(index.contained(500, 504)), shorts[250:252])
+        self.assertEqual(list(index.containing(501, 502)), [whole, shorts[250]])
+    
+    def test_random(self):
+        rnd = random.Random(0)
+        segments = [self.random_segment(rnd) for _ in xrange(300)]
+        index = IntervalIndex()
+        for idx in xrange(0, len(segments), 50):
+            index.add(segments[idx:idx + 50])
+        index.remove(segments[::3])
+        expected = sorted(set(segments) - set(segments[::3]))
+        self.assertEqual(list(index), expected)
+        for _ in xrange(100):
+            start = rnd.randint(0, 200)
+            end = start + rnd.randint(1, 50)
+            self.assertEqual(list(index.overlapping(start, end)),
+                             [s for s in expected if s.start < end and s.end > start])
+            self.assertEqual(list(index.contained(start, end)),
+                             [s for s in expected if s.start >= start and s.end <= end])
+            self.assertEqual(list(index.containing(start, end)),
+                             [s for s in expected if s.start <= start and s.end >= end])
+    
+    def random_segment(self, rnd):
+        start = rnd.randint(0, 200)
+        return Segment(u'seg', u'', None, start, start + rnd.choice([1, 3, 10, 40, 150]), u'DOC', 400)
+    
+    def index(self):
+        return IntervalIndex([self.short2(), self.long(), self.short1()])
+    
+    def long(self):
+        return Segment(u'seg', u'', None, 0, 15, u'DOC', 100)
+    
+    def short1(self):
+        return Segment(u'seg', u'', None, 2, 4, u'DOC', 100)
+    
+    def short2(self):
+        return Segment(u'seg', u'', None, 4, 8, u'DOC', 100)
@@ -1,5 +1,5 @@
 from hsm.data.mongodocumentstorage import MongoDocumentStorage
-from hsm.test.data.test_documentstorage import DocumentStorageTest
+from hsm.test.data.test_documentstorage import DocumentStorageTest, TextIndexDocumentStorageTest
 
 
 class MongoDocumentStorageTest(DocumentStorageTest):
@@ -14,4 +14,33 @@ class MongoDocumentStorageTest(DocumentStorageTest):
     def emptystorage(self):
         storage = MongoDocumentStorage('test_db')
         storage.delete_all(u'')
-        return storage
\ No newline at end of file
+        return storage
+
+
+class MongoTextIndexDocumentStorageTest(TextIndexDocumentStorageTest):
+    
+    def test_rebuild_text_index(self):
+        storage = MongoDocumentStorage('test_db')
+        storage.delete_all(u'')
+        storage.save_all(self.documents())
+        storage = MongoDocumentStorage('test_db', text_index=True)
+        storage.rebuild_text_index()
+        self.assertEqual(storage.load_all(u'', regex=u'in the Mex'), [self.documentB()])
+        self.assertEqual(len(storage._textindex), 3)
+    
+    def test_too_many_candidates(self):
+        storage = self.storage()
+        storage.MAX_CANDIDATES = 0
+        self.assertEqual(storage.load_all(u'', regex=u'in the Mex'), [self.documentB()])
+        self.assertEqual(storage.load_names(u'', regex=u'the'), [self.documentA().name, self.documentB().name])
+    
+    def test_common_term(self):
+        storage = self.storage()
+        storage._textindex._max_candidates = 1
+        self.assertEqual(storage._textindex.candidates(u'in the'), None)
+        self.assertEqual(storage.load_names(u'', regex=u'in the Mex'), [self.documentB().name])
+    
+    def emptystorage(self):
+        storage = MongoDocumentStorage('test_db', text_index=True)
+        storage.delete_all(u'')
+        return storage
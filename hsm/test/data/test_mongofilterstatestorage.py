@@ -0,0 +1,10 @@
+from hsm.data.mongofilterstatestorage import MongoFilterStateStorage
+from hsm.test.data.test_filterstatestorage import FilterStateStorageTest
+
+
+class MongoFilterStateStorageTest(FilterStateStorageTest):
+    
+    def emptystorage(self):
+        storage = MongoFilterStateStorage('test_db')
+        storage._state.remove()
+        return storage
@@ -1,5 +1,6 @@
 from hsm.data.mongosegmentstorage import MongoSegmentStorage
-from hsm.test.data.test_segmentstorage import SegmentStorageTest
+from hsm.data.segment import Segment
+from hsm.test.data.test_segmentstorage import SegmentStorageTest, TrigramSegmentStorageTest
 
 
 class MongoSegmentStorageTest(SegmentStorageTest):
@@ -11,7 +12,49 @@ class MongoSegmentStorageTest(SegmentStorageTest):
         storage = self.storage()
         self.assertIsInstance(storage, MongoSegmentStorage)
     
+    def test_counts_backfilled(self):
+        storage = self.storage()
+        # simulate a database created before the counts were maintained
+        storage._counts.remove({})
+        storage._state.remove({})
+        self.assertEqual(storage.count(u'OTHER SEGMENT'), 2)
+        self.assertEqual(storage.counts(), {u'SOME SEGMENT': 3, u'OTHER SEGMENT': 2})
+        storage = MongoSegmentStorage('test_db')
+        self.assertEqual(storage.count(u'OTHER SEGMENT'), 2)
+        self.assertEqual(storage.counts(doc_prefix=u''), {u'SOME SEGMENT': 3, u'OTHER SEGMENT': 2})
+    
     def emptystorage(self):
         storage = MongoSegmentStorage('test_db')
         storage.delete()
         return storage
+
+
+class MongoTrigramSegmentStorageTest(TrigramSegmentStorageTest):
+    
+    def test_value_regex_order(self):
+        # unsorted segments are returned in the natural order of the collection
+        self.check_value_regex_order([True])
+    
+    def test_rebuild_trigram_index(self):
+        storage = MongoSegmentStorage('test_db')
+        storage.delete()
+        storage.save(self.first_segments())
+        storage.save(self.second_segments())
+        storage = MongoSegmentStorage('test_db', trigram_index=True)
+        self.assertEqual(storage.load(value_regex=u'OTHER'), self.second_segments())
+        self.assertEqual(storage.regex_selectivity(u'OTHER')['selectivity'], 1.0)
+        storage.rebuild_trigram_index()
+        self.assertEqual(storage.load(value_regex=u'OTHER'), self.second_segments())
+        self.assertEqual(storage.regex_selectivity(u'OTHER')['candidates'], 2)
+    
+    def test_save_without_trigrams(self):
+        storage = self.storage()
+        segment = Segment(u'OTHER SEGMENT', u'OTHER NEW', None, 0, 2, u'DOCUMENT C', 10)
+        MongoSegmentStorage('test_db').save([segment])
+        self.assertEqual(storage.load(value_regex=u'OTHER'), self.second_segments() | set([segment]))
+    
+    def emptystorage(self):
+        storage = MongoSegmentStorage('test_db', trigram_index=True)
+        storage.delete()
+        storage.rebuild_trigram_index()
+        return storage
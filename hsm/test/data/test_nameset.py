@@ -0,0 +1,23 @@
+import unittest
+
+from hsm.data.nameset import NameSet
+
+
+class NameSetTest(unittest.TestCase):
+    
+    def test_contains(self):
+        names = NameSet([u'doc:2', u'doc:10', u'doc:1'])
+        self.assertTrue(u'doc:1' in names)
+        self.assertTrue(u'doc:10' in names)
+        self.assertFalse(u'doc:' in names)
+        self.assertFalse(u'doc:3' in names)
+    
+    def test_duplicates(self):
+        names = NameSet([u'b', u'a', u'b'])
+        self.assertEqual(len(names), 2)
+        self.assertEqual(list(names), [u'a', u'b'])
+    
+    def test_empty(self):
+        names = NameSet([])
+        self.assertEqual(len(names), 0)
+        self.assertFalse(u'a' in names)
@@ -47,6 +47,41 @@ class PrefixMapTest(unittest.TestCase):
         expected = set([2])
         self.assertEqual(actual, expected)
     
+    def test_delete_readd(self):
+        m = self.map()
+        m.delete(u'other', 4)
+        self.assertEqual(m.get(u'other'), set())
+        m.add(u'other', 5)
+        self.assertEqual(m.get(u'other'), set([5]))
+        self.assertEqual(list(m.names(u'o')), [u'other'])
+    
+    def test_delete_many(self):
+        m = PrefixMap()
+        names = [u'doc:{0}'.format(idx) for idx in xrange(100)]
+        for name in names:
+            m.add(name, name)
+        for idx, name in enumerate(names):
+            m.delete(name, name)
+            self.assertEqual(len(m), 99 - idx)
+            self.assertEqual(list(m.names(u'doc:')), sorted(names[idx + 1:]))
+            self.assertEqual(m.get(u''), set(names[idx + 1:]))
+        m.add(u'doc:5', 5)
+        self.assertEqual(list(m.iterator(u'doc')), [5])
+    
+    def test_iterator_ordered(self):
+        m = self.map()
+        m.add(u'aaa', 0)
+        self.assertEqual(list(m.iterator(u'')), [0, 3, 1, 2, 4])
+    
+    def test_names_range(self):
+        self.assertEqual(list(self.map().names(u'myv')), [u'myvalue1', u'myvalue2'])
+    
+    def test_copy(self):
+        m = self.map()
+        copy = PrefixMap(m)
+        m.delete(u'my', 3)
+        self.assertEqual(copy.get(u'my'), set([1, 2, 3]))
+    
     def test_invalid_add_key(self):
         self.assertRaises(AssertionError, self.map().add, 'asciikey', 1)
     
@@ -54,6 +54,13 @@ class SegmentStorageTest(unittest.TestCase):
     def test_load_limit(self):
         self.assertEqual(len(self.storage().load(limit=1)), 1)
     
+    def test_load_sorted_limit(self):
+        segments = list(self.storage().load_iterator(sort=True, limit=3))
+        self.assertEqual(segments, [self.segmentB1(), self.segmentB2(), self.segmentA1()])
+    
+    def test_load_none_limit(self):
+        self.assertEqual(len(self.storage().load(limit=None)), 5)
+    
     def test_load_invalid_limit(self):
         self.assertRaises(Exception, self.storage().load, limit=0)
     
@@ -85,6 +92,42 @@ class SegmentStorageTest(unittest.TestCase):
         expected = set([self.segmentB1(), self.segmentB2()])
         self.assertEqual(segments, expected)
     
+    def test_value_regex_alternation(self):
+        segments = self.storage().load(value_regex=u'OTHER V|NONE')
+        expected = self.second_segments()
+        self.assertEqual(segments, expected)
+    
+    def test_value_regex_case_insensitive(self):
+        segments = self.storage().load(value_regex=u'(?i)other value')
+        expected = self.second_segments()
+        self.assertEqual(segments, expected)
+    
+    def test_regex_selectivity(self):
+        selectivity = self.storage().regex_selectivity(u'OTHER')
+        self.assertEqual(selectivity['total'], 5)
+        self.assertTrue(2 <= selectivity['candidates'] <= 5)
+    
+    def test_load_overlapping(self):
+        segments = list(self.storage().load_overlapping(u'DOCUMENT A', 1, 5))
+        self.assertEqual(segments, [self.segmentB1(), self.segmentA1(), self.segmentA2()])
+    
+    def test_load_overlapping_name(self):
+        segments = list(self.storage().load_overlapping(u'DOCUMENT A', 1, 5, name=u'SOME SEGMENT'))
+        self.assertEqual(segments, [self.segmentA1(), self.segmentA2()])
+    
+    def test_load_contained(self):
+        segments = list(self.storage().load_contained(u'DOCUMENT A', 2, 10, name_prefix=u'SOME'))
+        self.assertEqual(segments, [self.segmentA2()])
+    
+    def test_load_containing(self):
+        segments = list(self.storage().load_containing(u'DOCUMENT A', 7, 9))
+        self.assertEqual(segments, [self.segmentB2()])
+    
+    def test_load_positional_after_delete(self):
+        storage = self.storage()
+        storage.delete(name=u'OTHER SEGMENT')
+        self.assertEqual(list(storage.load_containing(u'DOCUMENT A', 7, 9)), [])
+    
     def test_save(self):
         storage = self.emptystorage()
         storage.save([self.segmentA1()])
@@ -130,6 +173,21 @@ class SegmentStorageTest(unittest.TestCase):
         expected = {u'SOME SEGMENT': 3, u'OTHER SEGMENT': 2}
         self.assertEqual(counts, expected)
     
+    def test_count_after_delete(self):
+        storage = self.storage()
+        storage.delete(doc_name=u'DOCUMENT B')
+        self.assertEqual(storage.count(u'SOME SEGMENT'), 2)
+        self.assertEqual(storage.counts(), {u'SOME SEGMENT': 2, u'OTHER SEGMENT': 2})
+        self.assertEqual(storage.value_counts(), {u'SOME VALUE': 2, u'OTHER VALUE': 2})
+    
+    def test_count_separator_prefix(self):
+        storage = self.storage()
+        storage.save([Segment(u'SOME SEGMENT', u'SOME VALUE', None, 0, 2, u'etsa:anamnesis:1', 10),
+                      Segment(u'SOME SEGMENT', u'SOME VALUE', None, 0, 2, u'etsa:diagnosis:1', 10)])
+        self.assertEqual(storage.counts(doc_prefix=u'etsa:'), {u'SOME SEGMENT': 2})
+        self.assertEqual(storage.counts(doc_prefix=u'etsa:anamnesis:'), {u'SOME SEGMENT': 1})
+        self.assertEqual(storage.count(u'SOME SEGMENT'), 5)
+    
     def test_valuecount(self):
         storage = self.storage()
         counts = storage.value_counts()
@@ -178,3 +236,36 @@ class SegmentStorageTest(unittest.TestCase):
     def documentB(self):
         return Document(u'DOCUMENT B', u'Somewhere in the Mexico.')
 
+
+
+class TrigramSegmentStorageTest(SegmentStorageTest):
+    '''Reuse SegmentStorageTest cases with the trigram index enabled.'''
+    
+    def test_regex_selectivity_narrows(self):
+        selectivity = self.storage().regex_selectivity(u'OTHER')
+        self.assertEqual(selectivity['candidates'], 2)
+    
+    def test_regex_selectivity_unknown(self):
+        selectivity = self.storage().regex_selectivity(u'.*')
+        self.assertEqual(selectivity['selectivity'], 1.0)
+    
+    def test_value_regex_order(self):
+        self.check_value_regex_order([False, True])
+    
+    def check_value_regex_order(self, sorts):
+        '''Check that the index does not change the order of the segments.'''
+        storage = self.storage()
+        plain = SegmentStorage()
+        plain.save(storage.load())
+        for sort in sorts:
+            for kwargs in [{}, {'name': u'OTHER SEGMENT'}, {'doc_prefix': u'DOCUMENT'}]:
+                self.assertEqual(list(storage.load_iterator(value_regex=u'VALUE', sort=sort, **kwargs)),
+                                 list(plain.load_iterator(value_regex=u'VALUE', sort=sort, **kwargs)))
+    
+    def test_value_regex_after_delete(self):
+        storage = self.storage()
+        storage.delete(name=u'OTHER SEGMENT')
+        self.assertEqual(storage.load(value_regex=u'OTHER'), set())
+    
+    def emptystorage(self):
+        return SegmentStorage(trigram_index=True)
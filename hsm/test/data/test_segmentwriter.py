@@ -0,0 +1,49 @@
+import unittest
+
+import hsm
+from hsm.data.segment import Segment
+from hsm.data.segmentstorage import SegmentStorage
+from hsm.data.segmentwriter import SegmentWriter
+
+
+class FailingStorage(object):
+    
+    def save(self, segments):
+        raise IOError('storage is unavailable')
+
+
+class SegmentWriterTest(unittest.TestCase):
+    
+    def test_write_close(self):
+        storage = SegmentStorage()
+        writer = SegmentWriter(storage, batch_size=2, queue_size=1)
+        writer.write_all(self.segments())
+        writer.close()
+        self.assertEqual(storage.load(name=u'token'), set(self.segments()))
+    
+    def test_flush(self):
+        storage = SegmentStorage()
+        with SegmentWriter(storage, batch_size=100) as writer:
+            writer.write_all(self.segments()[:3])
+            writer.flush()
+            self.assertEqual(storage.load(name=u'token'), set(self.segments()[:3]))
+    
+    def test_error_propagated(self):
+        writer = SegmentWriter(FailingStorage(), batch_size=2, queue_size=1)
+        def write():
+            writer.write_all(self.segments())
+            writer.close()
+        self.assertRaises(IOError, write)
+    
+    def test_error_on_exit(self):
+        def write():
+            with SegmentWriter(FailingStorage()) as writer:
+                writer.write(self.segments()[0])
+        self.assertRaises(IOError, write)
+    
+    def test_invalid_segment(self):
+        with SegmentWriter(SegmentStorage()) as writer:
+            self.assertRaises(AssertionError, writer.write, u'not a segment')
+    
+    def segments(self):
+        return [Segment(u'token', u'', None, idx, idx + 1, u'DOC A', 100) for idx in range(10)]
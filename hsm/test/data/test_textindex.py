@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+import unittest
+
+from hsm.data.textindex import TextIndex, term_query, tokenize, AND, OR, TERM, PREFIX
+
+
+class TermQueryTest(unittest.TestCase):
+
+    def test_tokenize(self):
+        self.assertEqual(list(tokenize(u'Kaal: 75kg')), [(u'kaal', 0, 4), (u'75kg', 6, 10)])
+
+    def test_interior_and_right_open(self):
+        self.assertEqual(term_query(u'vererõhk on kõrge'), (AND, [(TERM, u'on'), (PREFIX, u'kõrge')]))
+
+    def test_left_open_skipped(self):
+        self.assertEqual(term_query(u'\\d+\\s*kg'), None)
+
+    def test_alternation(self):
+        expected = (OR, [(PREFIX, u'kaal'), (PREFIX, u'pikkus')])
+        self.assertEqual(term_query(u'a kaal|b pikkus'), expected)
+
+
+class CommonTermIndex(TextIndex):
+    '''Text index that cannot narrow down the documents by the terms `kaal` and `kg`.'''
+
+    def _documents(self, term, prefix):
+        if term in [u'kaal', u'kg']:
+            return None
+        return TextIndex._documents(self, term, prefix)
+
+
+class TextIndexTest(unittest.TestCase):
+
+    def test_candidates_prefix(self):
+        self.assertEqual(self.index().candidates(u'patsi kaal \\d+', u'b'), set([u'b']))
+
+    def test_phrase_search(self):
+        self.assertEqual(self.index().search(phrase=u'kaal 75'), {u'a': [(0, 7)]})
+
+    def test_remove(self):
+        index = self.index()
+        index.remove(u'a')
+        self.assertEqual(index.search(terms=[u'kaal']), {u'b': [(6, 10)]})
+        self.assertEqual(len(index), 1)
+
+    def test_unknown_term(self):
+        index = CommonTermIndex()
+        index.add(u'a', u'Kaal 75 kg')
+        index.add(u'b', u'Patsi kaal 80 kg')
+        self.assertEqual(index.evaluate((AND, [(TERM, u'kaal'), (TERM, u'patsi')])), set([u'b']))
+        self.assertEqual(index.evaluate((AND, [(TERM, u'kaal'), (TERM, u'kg')])), None)
+        self.assertEqual(index.evaluate((OR, [(TERM, u'kaal'), (TERM, u'patsi')])), None)
+
+    def index(self):
+        index = TextIndex()
+        index.add(u'a', u'Kaal 75 kg')
+        index.add(u'b', u'Patsi kaal 80 kg')
+        return index
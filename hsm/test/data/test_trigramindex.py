@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+import unittest
+
+from hsm.data.trigramindex import TrigramIndex, required_literals, trigram_query, trigrams, AND, OR, LITERAL
+
+
+class RequiredLiteralsTest(unittest.TestCase):
+
+    def test_trigrams(self):
+        self.assertEqual(trigrams(u'AbCd'), set([u'abc', u'bcd']))
+
+    def test_trigrams_short(self):
+        self.assertEqual(trigrams(u'ab'), set())
+
+    def test_literal(self):
+        self.assertEqual(required_literals(u'vererõhk'), (LITERAL, u'vererõhk'))
+
+    def test_concatenation(self):
+        expected = (AND, [(LITERAL, u'kaal'), (LITERAL, u'kg')])
+        self.assertEqual(required_literals(u'kaal\\s*\\d+\\s*kg'), expected)
+
+    def test_alternation(self):
+        expected = (OR, [(LITERAL, u'pikkus'), (LITERAL, u'kaal')])
+        self.assertEqual(required_literals(u'pikkus|kaal'), expected)
+
+    def test_optional_alternative(self):
+        self.assertEqual(required_literals(u'pikkus|\\d+'), None)
+
+    def test_group(self):
+        self.assertEqual(required_literals(u'(?:ver)(?:e)rõhk'), (LITERAL, u'vererõhk'))
+
+    def test_optional_repeat(self):
+        self.assertEqual(required_literals(u'(kaal)?kg'), (LITERAL, u'kg'))
+
+    def test_invalid(self):
+        self.assertEqual(required_literals(u'(kaal'), None)
+
+    def test_trigram_query_short_literals(self):
+        self.assertEqual(trigram_query(u'a|b'), None)
+
+
+class TrigramIndexTest(unittest.TestCase):
+
+    def test_candidates(self):
+        self.assertEqual(self.index().candidates(u'kaal\\s*\\d+'), set([1, 3]))
+
+    def test_candidates_alternation(self):
+        self.assertEqual(self.index().candidates(u'pikkus|vererõhk'), set([2]))
+
+    def test_candidates_case_insensitive(self):
+        self.assertEqual(self.index().candidates(u'(?i)KAAL'), set([1, 3]))
+
+    def test_candidates_short_alternative(self):
+        self.assertEqual(self.index().candidates(u'pikkus|RR'), None)
+
+    def test_candidates_unknown(self):
+        self.assertEqual(self.index().candidates(u'\\d+'), None)
+
+    def test_remove(self):
+        index = self.index()
+        index.remove(3, u'kaal 80')
+        self.assertEqual(index.candidates(u'kaal'), set([1]))
+        self.assertEqual(len(index), 2)
+
+    def index(self):
+        index = TrigramIndex()
+        index.add(1, u'Kaal 75 kg')
+        index.add(2, u'pikkus 180 cm')
+        index.add(3, u'kaal 80')
+        return index
@@ -2,13 +2,25 @@ import unittest
 
 from hsm.data.document import Document
 from hsm.data.documentstorage import DocumentStorage
+from hsm.data.filterstatestorage import FilterStateStorage
 from hsm.data.segment import Segment
 from hsm.data.segmentstorage import SegmentStorage
 from hsm.tools.filter import SegmentDocumentMatcher, ContainerFilter, Filter, \
     FILTER_NAME, SEGMENT_NAME, OUTPUT_NAME, CONTAINER_NAME, CONTAINER_INCLUDES, \
     SEGMENT_VALUE_REGEX, CREATES_SEGMENT, SEGMENT_NEG_REGEX, DOCUMENT_PREFIX, \
     DOCUMENT_REGEX, DOCUMENT_NEG_REGEX, MIXIN_NAME, SPLITTER_REGEX, SPLITTER_LEFT, \
-    SPLITTER_RIGHT, SPLITTER_NEG_REGEX, CONTAINER_VALUE_REGEX
+    SPLITTER_RIGHT, SPLITTER_NEG_REGEX, CONTAINER_VALUE_REGEX, CONTAINER_KEEP_SOURCE, MIXIN_VALUE_REGEX, \
+    SegmentStreamMerger, overlapping, containing, within, followed_by, union, \
+    intersection, difference, partition_prefixes
+
+
+class UnorderedSegmentStorage(SegmentStorage):
+    '''Storage returning segments in reverse order unless sorting is requested.'''
+    
+    def load_iterator(self, **kwargs):
+        if kwargs.get('sort', False):
+            return SegmentStorage.load_iterator(self, **kwargs)
+        return reversed(list(SegmentStorage.load_iterator(self, **kwargs)))
 
 
 def iterator(iterable):
@@ -72,6 +84,84 @@ class SegmentDocumentMatcherTest(unittest.TestCase):
         return [self.third1(), self.third2()]
 
 
+class PartitionPrefixesTest(unittest.TestCase):
+    
+    def test_empty(self):
+        self.assertEqual(partition_prefixes([], u'etsa:', 4), [u'etsa:'])
+    
+    def test_split(self):
+        names = [u'etsa:a:1', u'etsa:a:2', u'etsa:b:1', u'etsa:c:1']
+        self.assertEqual(partition_prefixes(names, u'', 3), [u'etsa:a', u'etsa:b', u'etsa:c'])
+    
+    def test_split_largest(self):
+        names = [u'etsa:a:1', u'etsa:a:2', u'etsa:b:1']
+        self.assertEqual(partition_prefixes(names, u'etsa:', 3), [u'etsa:a:1', u'etsa:a:2', u'etsa:b'])
+    
+    def test_name_not_split(self):
+        names = [u'doc', u'doc1', u'doc2']
+        self.assertEqual(partition_prefixes(names, u'', 3), [u'doc'])
+
+
+class SegmentStreamMergerTest(unittest.TestCase):
+    
+    def test_outer(self):
+        merger = SegmentStreamMerger(iterator(self.tokens()), iterator(self.phrases()), iterator([]))
+        docs = [(doc_name, [len(segs) for segs in segments]) for doc_name, segments in merger.get()]
+        self.assertEqual(docs, [(u'DOC A', [3, 2, 0]), (u'DOC B', [1, 0, 0]), (u'DOC C', [0, 1, 0])])
+    
+    def test_required(self):
+        merger = SegmentStreamMerger(iterator(self.tokens()), iterator(self.phrases()))
+        self.assertEqual([doc_name for doc_name, _ in merger.get(required=[0, 1])], [u'DOC A'])
+    
+    def test_overlapping(self):
+        result = list(overlapping(iterator(self.tokens()), iterator(self.phrases())))
+        self.assertEqual(result, [self.token(0, 4), self.token(5, 8), self.token(9, 13)])
+    
+    def test_containing(self):
+        result = list(containing(iterator(self.phrases()), iterator(self.tokens())))
+        self.assertEqual(result, [self.phrase(0, 8)])
+    
+    def test_within(self):
+        result = list(within(iterator(self.tokens()), iterator(self.phrases())))
+        self.assertEqual(result, [self.token(0, 4), self.token(5, 8)])
+    
+    def test_followed_by(self):
+        tokens = self.tokens()
+        self.assertEqual(list(followed_by(iterator(tokens), iterator(tokens), 0)), [])
+        self.assertEqual(list(followed_by(iterator(tokens), iterator(tokens), 1)), [self.token(0, 4), self.token(5, 8)])
+    
+    def test_union(self):
+        result = list(union(iterator(self.tokens()), iterator(self.phrases())))
+        self.assertEqual(result, [self.token(0, 4), self.phrase(0, 8), self.token(5, 8), self.phrase(6, 12),
+                                  self.token(9, 13), self.token(0, 2, u'DOC B'), self.phrase(0, 3, u'DOC C')])
+    
+    def test_union_same_span(self):
+        result = list(union(iterator([self.token(0, 8)]), iterator(self.phrases())))
+        self.assertEqual(result, [self.token(0, 8), self.phrase(6, 12), self.phrase(0, 3, u'DOC C')])
+    
+    def test_intersection(self):
+        phrases = [self.phrase(0, 4), self.phrase(9, 13)]
+        self.assertEqual(list(intersection(iterator(self.tokens()), iterator(phrases), iterator(phrases[:1]))),
+                         [self.token(0, 4)])
+    
+    def test_difference(self):
+        phrases = [self.phrase(0, 4), self.phrase(9, 13)]
+        self.assertEqual(list(difference(iterator(self.tokens()), iterator(phrases))),
+                         [self.token(5, 8), self.token(0, 2, u'DOC B')])
+    
+    def token(self, start, end, doc_name=u'DOC A'):
+        return Segment(u'token', u'', None, start, end, doc_name, 100)
+    
+    def phrase(self, start, end, doc_name=u'DOC A'):
+        return Segment(u'phrase', u'', None, start, end, doc_name, 100)
+    
+    def tokens(self):
+        return [self.token(0, 4), self.token(5, 8), self.token(9, 13), self.token(0, 2, u'DOC B')]
+    
+    def phrases(self):
+        return [self.phrase(0, 8), self.phrase(6, 12), self.phrase(0, 3, u'DOC C')]
+
+
 class ContainerFilterTest(unittest.TestCase):
     
     def test_container_contains_keep_source(self):
@@ -90,6 +180,11 @@ class ContainerFilterTest(unittest.TestCase):
         contfilter = ContainerFilter(iterator(self.second_segments()), iterator(self.first_segments()), False, False)
         self.assertEqual(set(contfilter.get()), set([self.first1()]))
     
+    def test_order_preserved(self):
+        segments = [Segment(u'first', u'', None, start, start + 2, u'DOC A', 100) for start in [8, 0, 4, 0]]
+        contfilter = ContainerFilter(iterator(segments), iterator(self.second_segments()), True, True)
+        self.assertEqual(list(contfilter.get()), segments)
+    
     def first1(self):
         return Segment(u'first', u'', None, 0, 10, u'DOC A', 100)
     
@@ -180,6 +275,72 @@ class FilterTest(unittest.TestCase):
         copies = set(segmentstorage.load(name=u'lemma:copy'))
         self.assertEqual(copies, set(self.first_copy_lemmas()) | set(self.second_copy_lemmas()))
     
+    def test_apply_small_batches(self):
+        filt = Filter(**self.basic_kwargs())
+        segmentstorage = self.segmentstorage()
+        filt.apply(segmentstorage, self.documentstorage(), batch_size=1, queue_size=1)
+        copies = set(segmentstorage.load(name=u'lemma:copy'))
+        self.assertEqual(copies, set(self.first_copy_lemmas()) | set(self.second_copy_lemmas()))
+    
+    def test_apply_parallel(self):
+        kwargs = self.basic_kwargs()
+        kwargs[CONTAINER_NAME] = u'sentence'
+        kwargs[CONTAINER_VALUE_REGEX] = u'length'
+        filt = Filter(**kwargs)
+        segmentstorage = self.segmentstorage()
+        filt.apply_parallel(segmentstorage, self.documentstorage(), processes=2)
+        copies = set(segmentstorage.load(name=u'lemma:copy'))
+        self.assertEqual(copies, set(self.second_copy_lemmas()))
+    
+    def test_apply_parallel_creates_segment(self):
+        kwargs = self.basic_kwargs()
+        kwargs[SEGMENT_VALUE_REGEX] = u'\\w+'
+        kwargs[CREATES_SEGMENT] = True
+        segmentstorage = SegmentStorage()
+        Filter(**kwargs).apply(segmentstorage, self.documentstorage())
+        expected = segmentstorage.load(name=u'lemma:copy')
+        segmentstorage = SegmentStorage()
+        Filter(**kwargs).apply_parallel(segmentstorage, self.documentstorage(), processes=2, partitions=2)
+        self.assertEqual(segmentstorage.load(name=u'lemma:copy'), expected)
+        self.assertEqual(len(expected), 7)
+    
+    def test_apply_incremental(self):
+        filt = Filter(**self.basic_kwargs())
+        segmentstorage = self.segmentstorage()
+        documentstorage = self.documentstorage()
+        statestorage = FilterStateStorage()
+        changed = filt.apply_incremental(segmentstorage, documentstorage, statestorage)
+        self.assertEqual(changed, [u'DOCUMENT A', u'DOCUMENT B'])
+        self.assertEqual(filt.apply_incremental(segmentstorage, documentstorage, statestorage), [])
+        copies = set(segmentstorage.load(name=u'lemma:copy'))
+        self.assertEqual(copies, set(self.first_copy_lemmas()) | set(self.second_copy_lemmas()))
+    
+    def test_apply_incremental_changed_layer(self):
+        filt = Filter(**self.basic_kwargs())
+        segmentstorage = self.segmentstorage()
+        documentstorage = self.documentstorage()
+        statestorage = FilterStateStorage()
+        filt.apply_incremental(segmentstorage, documentstorage, statestorage)
+        segmentstorage.delete(name=u'lemma', doc_name=u'DOCUMENT A')
+        segmentstorage.save([self.lemma1()])
+        changed = filt.apply_incremental(segmentstorage, documentstorage, statestorage)
+        self.assertEqual(changed, [u'DOCUMENT A'])
+        copies = set(segmentstorage.load(name=u'lemma:copy'))
+        self.assertEqual(copies, set(self.first_copy_lemmas()[:1]) | set(self.second_copy_lemmas()))
+    
+    def test_apply_incremental_removed_document(self):
+        filt = Filter(**self.basic_kwargs())
+        segmentstorage = self.segmentstorage()
+        documentstorage = self.documentstorage()
+        statestorage = FilterStateStorage()
+        filt.apply_incremental(segmentstorage, documentstorage, statestorage)
+        documentstorage.delete(u'DOCUMENT A')
+        changed = filt.apply_incremental(segmentstorage, documentstorage, statestorage)
+        self.assertEqual(changed, [u'DOCUMENT A'])
+        copies = set(segmentstorage.load(name=u'lemma:copy'))
+        self.assertEqual(copies, set(self.second_copy_lemmas()))
+        self.assertEqual(set(statestorage.load(u'lemma:copy')), set([u'DOCUMENT B']))
+    
     def test_second_apply_removes_previous_segments(self):
         filt = Filter(**self.basic_kwargs())
         segmentstorage = self.segmentstorage()
@@ -234,6 +395,17 @@ class FilterTest(unittest.TestCase):
         outs = set(filt.filter(self.segmentstorage(), self.documentstorage()))
         self.assertEqual(set(outs), set(self.second_copy_lemmas()))
     
+    def test_with_container_keep_container(self):
+        kwargs = self.basic_kwargs()
+        kwargs[CONTAINER_NAME] = u'sentence'
+        kwargs[CONTAINER_VALUE_REGEX] = u'length'
+        kwargs[CONTAINER_KEEP_SOURCE] = False
+        filt = Filter(**kwargs)
+        outs = list(filt.filter(self.segmentstorage(), self.documentstorage()))
+        expected = self.sentence2()
+        expected.name = u'lemma:copy'
+        self.assertEqual(outs, [expected])
+    
     def test_with_mixin(self):
         kwargs = self.basic_kwargs()
         kwargs[MIXIN_NAME] = u'mixin'
@@ -243,6 +415,27 @@ class FilterTest(unittest.TestCase):
         outs = set(filt.filter(segmentstorage, self.documentstorage()))
         self.assertEqual(outs, set(self.first_copy_lemmas()) | set(self.second_copy_lemmas()) | set([self.mixin_copy1()]))
     
+    def test_container_and_mixin_unordered_storage(self):
+        docstorage = DocumentStorage()
+        segments = []
+        for idx in range(50):
+            doc = Document(u'doc:{0}'.format(idx), u'word in sentence of some length')
+            docstorage.save(doc)
+            segments.append(Segment(u'lemma', u'word', doc, 0, 4))
+            segments.append(Segment(u'sentence', doc.text, doc, 0, len(doc.text)))
+            segments.append(Segment(u'mixin', u'length', doc, 25, 31))
+        kwargs = self.basic_kwargs()
+        kwargs[CONTAINER_NAME] = u'sentence'
+        kwargs[CONTAINER_VALUE_REGEX] = u'length'
+        kwargs[MIXIN_NAME] = u'mixin'
+        kwargs[MIXIN_VALUE_REGEX] = u'len'
+        filt = Filter(**kwargs)
+        for segstorage in [SegmentStorage(trigram_index=True), UnorderedSegmentStorage()]:
+            segstorage.save(segments)
+            outs = list(filt.filter(segstorage, docstorage))
+            self.assertEqual(len(outs), 100)
+            self.assertEqual(set(seg.doc_name for seg in outs), set(docstorage.load_names(u'')))
+    
     def test_splitter_full(self):
         kwargs = self.basic_kwargs()
         kwargs[SPLITTER_LEFT] = u'e'
@@ -256,7 +449,52 @@ class FilterTest(unittest.TestCase):
         segmentstorage.save([self.sentence1(), self.sentence2()])
         outs = set(filt.filter(segmentstorage, self.documentstorage()))
         self.assertEqual(outs, set(self.fragments()))
-    
+
+    def test_compile(self):
+        filt = Filter(**self.basic_kwargs())
+        plan = filt.compile()
+        filt[SEGMENT_VALUE_REGEX] = u'sick'
+        segmentstorage = self.segmentstorage()
+        expected = set(self.first_copy_lemmas()) | set(self.second_copy_lemmas())
+        self.assertEqual(set(plan.filter(segmentstorage, self.documentstorage())), expected)
+        self.assertEqual(set(plan.filter(segmentstorage, self.documentstorage())), expected)
+        self.assertEqual(plan.stages, [u'basic'])
+
+    def test_explain(self):
+        kwargs = self.basic_kwargs()
+        kwargs[CONTAINER_NAME] = u'sentence'
+        kwargs[CONTAINER_VALUE_REGEX] = u'length'
+        kwargs[MIXIN_NAME] = u'mixin'
+        segmentstorage = self.segmentstorage()
+        segmentstorage.save([self.mixin1()])
+        report = Filter(**kwargs).compile().explain(segmentstorage, self.documentstorage())
+        self.assertEqual([(row['stage'], row['estimated'], row['actual']) for row in report],
+                         [(u'basic', 7, 7), (u'container', 4, 4), (u'mixin', 5, 5), (u'output', 5, 5)])
+        self.assertTrue(all(row['time'] >= 0 for row in report))
+
+    def test_explain_limit(self):
+        report = Filter(**self.basic_kwargs()).compile().explain(self.segmentstorage(), self.documentstorage(), limit=2)
+        self.assertEqual([row['actual'] for row in report], [2, 2])
+
+    def test_preview(self):
+        kwargs = self.basic_kwargs()
+        kwargs[CONTAINER_NAME] = u'sentence'
+        kwargs[CONTAINER_VALUE_REGEX] = u'length'
+        preview = Filter(**kwargs).compile().preview(self.segmentstorage(), self.documentstorage(), sample_size=2, seed=1)
+        self.assertTrue(preview['complete'])
+        self.assertEqual(preview['basic']['count'], 7)
+        self.assertEqual(preview['output']['count'], 4)
+        self.assertEqual(len(preview['basic']['sample']), 2)
+        outputs = self.second_copy_lemmas()
+        sample = preview['output']['sample']
+        self.assertTrue(set(sample) <= set(outputs))
+        self.assertEqual(sample, sorted(sample, key=outputs.index))
+
+    def test_preview_budget(self):
+        preview = Filter(**self.basic_kwargs()).compile().preview(self.segmentstorage(), self.documentstorage(), budget=0)
+        self.assertFalse(preview['complete'])
+        self.assertEqual(preview['output'], {'count': 0, 'sample': []})
+
     def documentA(self):
         return Document(u'DOCUMENT A', u'Dude was sick!')
     
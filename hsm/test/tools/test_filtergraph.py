@@ -0,0 +1,114 @@
+import unittest
+
+from hsm.data.document import Document
+from hsm.data.documentstorage import DocumentStorage
+from hsm.data.segment import Segment
+from hsm.data.segmentstorage import SegmentStorage
+from hsm.tools.filter import Filter, FILTER_NAME, SEGMENT_NAME, OUTPUT_NAME, \
+    SEGMENT_VALUE_REGEX, CREATES_SEGMENT, CONTAINER_NAME, MIXIN_NAME, VIRTUAL
+from hsm.tools.filtergraph import FilterGraph
+
+
+class FilterGraphTest(unittest.TestCase):
+    
+    def test_levels(self):
+        self.assertEqual(self.graph().levels(), [[u'numbers', u'words'], [u'large'], [u'mixed']])
+    
+    def test_dependencies(self):
+        graph = self.graph()
+        self.assertEqual(graph.dependencies(u'mixed'), set([u'large', u'words']))
+        self.assertEqual(graph.dependents(u'numbers'), set([u'large']))
+    
+    def test_downstream(self):
+        self.assertEqual(self.graph().downstream([u'numbers']), set([u'numbers', u'large', u'mixed']))
+    
+    def test_cycle(self):
+        filters = [self.filter(u'first', u'a', u'b'), self.filter(u'second', u'b', u'a')]
+        self.assertRaises(ValueError, FilterGraph, filters)
+    
+    def test_duplicate_output(self):
+        filters = [self.filter(u'first', u'a', u'b'), self.filter(u'second', u'c', u'b')]
+        self.assertRaises(ValueError, FilterGraph, filters)
+    
+    def test_chains(self):
+        self.assertEqual(self.graph().chains(), [[u'numbers', u'large', u'mixed'], [u'words']])
+        self.assertEqual(self.graph().chains([u'large', u'mixed']), [[u'large', u'mixed']])
+    
+    def test_chains_rewriting_filter(self):
+        graph = FilterGraph([self.filter(u'words', u'word', u'word', **{SEGMENT_VALUE_REGEX: u'[A-Z]\\w+'})])
+        self.assertFalse(graph.is_fusable(u'words'))
+        self.assertEqual(graph.chains(), [[u'words']])
+    
+    def test_apply(self):
+        segstorage = SegmentStorage()
+        levels = self.graph().apply(segstorage, self.documentstorage())
+        self.assertEqual(levels, [[[u'numbers'], [u'words']], [[u'large']], [[u'mixed']]])
+        self.assertEqual(set(seg.value for seg in segstorage.load(name=u'mixed')), set([u'200', u'Dude']))
+    
+    def test_apply_changed(self):
+        segstorage = SegmentStorage()
+        graph = self.graph()
+        graph.apply(segstorage, self.documentstorage())
+        segstorage.delete(name=u'mixed')
+        levels = graph.apply(segstorage, self.documentstorage(), changed=[u'large'])
+        self.assertEqual(levels, [[[u'large']], [[u'mixed']]])
+        self.assertEqual(set(seg.value for seg in segstorage.load(name=u'mixed')), set([u'200', u'Dude']))
+    
+    def test_apply_fused(self):
+        segstorage = SegmentStorage()
+        graph = FilterGraph(self.filters()[:3])
+        levels = graph.apply(segstorage, self.documentstorage(), fuse=True, threads=1)
+        self.assertEqual(levels, [[[u'numbers', u'large'], [u'words']]])
+        self.assertEqual(set(seg.value for seg in segstorage.load(name=u'large')), set([u'200']))
+        self.assertEqual(segstorage.load(name=u'number'), set())
+    
+    def test_apply_changed_after_fused(self):
+        segstorage = SegmentStorage()
+        graph = FilterGraph(self.filters()[:3])
+        graph.apply(segstorage, self.documentstorage(), fuse=True)
+        self.assertEqual(graph.unmaterialized([u'large'], segstorage), set([u'numbers']))
+        levels = graph.apply(segstorage, self.documentstorage(), changed=[u'large'])
+        self.assertEqual(levels, [[[u'numbers']], [[u'large']]])
+        self.assertEqual(set(seg.value for seg in segstorage.load(name=u'large')), set([u'200']))
+        self.assertEqual(graph.unmaterialized([u'large'], segstorage), set())
+    
+    def test_apply_changed_after_fused_chain(self):
+        segstorage = SegmentStorage()
+        graph = self.graph()
+        graph.apply(segstorage, self.documentstorage(), fuse=True)
+        levels = graph.apply(segstorage, self.documentstorage(), changed=[u'mixed'], fuse=True, downstream=False)
+        self.assertEqual(levels, [[[u'numbers', u'large', u'mixed']]])
+        self.assertEqual(set(seg.value for seg in segstorage.load(name=u'mixed')), set([u'200', u'Dude']))
+    
+    def test_apply_fused_waits_for_mixin(self):
+        segstorage = SegmentStorage()
+        levels = self.graph().apply(segstorage, self.documentstorage(), fuse=True)
+        self.assertEqual(levels, [[[u'words']], [[u'numbers', u'large', u'mixed']]])
+        self.assertEqual(set(seg.value for seg in segstorage.load(name=u'mixed')), set([u'200', u'Dude']))
+    
+    def test_apply_virtual(self):
+        segstorage = SegmentStorage()
+        filters = self.filters()
+        filters[1][VIRTUAL] = True
+        levels = FilterGraph(filters).apply(segstorage, self.documentstorage())
+        self.assertEqual(levels, [[[u'numbers'], [u'words']], [[u'mixed']]])
+        self.assertEqual(set(seg.value for seg in segstorage.load(name=u'mixed')), set([u'200', u'Dude']))
+        self.assertEqual(segstorage.load(name=u'large'), set())
+    
+    def filter(self, name, segment_name, output_name, **kwargs):
+        kwargs.update({FILTER_NAME: name, SEGMENT_NAME: segment_name, OUTPUT_NAME: output_name})
+        return Filter(**kwargs)
+    
+    def filters(self):
+        return [self.filter(u'numbers', u'number', u'number', **{SEGMENT_VALUE_REGEX: u'\\d+', CREATES_SEGMENT: True}),
+                self.filter(u'large', u'number', u'large', **{SEGMENT_VALUE_REGEX: u'\\d{3}'}),
+                self.filter(u'words', u'word', u'word', **{SEGMENT_VALUE_REGEX: u'[A-Z]\\w+', CREATES_SEGMENT: True}),
+                self.filter(u'mixed', u'large', u'mixed', **{MIXIN_NAME: u'word'})]
+    
+    def graph(self):
+        return FilterGraph(self.filters())
+    
+    def documentstorage(self):
+        storage = DocumentStorage()
+        storage.save_all([Document(u'DOCUMENT A', u'Dude was 20'), Document(u'DOCUMENT B', u'it was 200')])
+        return storage
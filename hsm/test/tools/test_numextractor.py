@@ -0,0 +1,441 @@
+# -*- coding: utf-8 -*-
+import json
+import logging
+import os
+import random
+import re
+import sqlite3
+import subprocess
+import sys
+import time
+import unittest
+
+from hsm.tools.numextractor import BloodPressure, Temperature, Medicine, Date, Timex, Measurements, \
+    PatternSet, CombinedPatternSet, Prefilter, get_matches, remove_submatches, \
+    Match, Field, remove_submatches_batch, cast_batch, correct_low_high_batch, avg_estimates_batch, in_range_batch, \
+    cast_fields, correct_low_high, avg_estimates, in_range, dict_from_matchobject, _digit_reach, \
+    NumExtractor, create_bp_table, extractor_patterns, extractor_pattern_set, Extractor, EXTRACTORS, \
+    MatchGuard, BudgetExceeded, ExtractionReport, PatternProfile, _init_extractor, _extract_chunk
+
+
+DOCUMENTS = [u'',
+             u'Kaebusi ei ole.',
+             u'RR 120/80 mmHg, ps 72x min. Temp 37,2 kraadi.',
+             u'Vererõhk 130-140/85-90, pulss 64-70. Kontroll 12.03.2014 ja 5. mail.',
+             u'Metoprolol 50 mg x 2, n 30. Kaal 82 kg, pikkus 180 cm.',
+             u'RR 150 / 95 p 88 RR140/ 90 ps 60-70x 17.11.13 36,6 kraadi 3 nädalat',
+             u'fr 90 RR: 110&70 Ps 55; t 38.2 C pärast 2 päeva']
+
+
+class CombinedPatternSetTest(unittest.TestCase):
+
+    def test_extractors(self):
+        for cls in [BloodPressure, Temperature, Medicine, Date, Timex, Measurements]:
+            sequential = cls(engine='sequential')
+            combined = cls(engine='combined')
+            for document in DOCUMENTS:
+                self.assertEqual(sequential.extract(document), combined.extract(document))
+
+    def test_overlapping_matches(self):
+        patterns = [re.compile(u'(?P<a>[0-9]{2})', re.UNICODE),
+                    re.compile(u'(?P<b>[0-9]{3})x', re.UNICODE),
+                    re.compile(u'(a)(?P<c>[0-9])', re.UNICODE),
+                    re.compile(u'(?P<d>[0-9])\\1', re.UNICODE)] * 3
+        document = u'a12345x 1 22 a9 [0-9]'
+        self.assertEqual(dicts(CombinedPatternSet(patterns).matches(document)), get_matches(document, patterns))
+        self.assertEqual(dicts(PatternSet(patterns).matches(document)), get_matches(document, patterns))
+
+    def test_many_groups(self):
+        patterns = [re.compile(u'(?P<a{0}>[0-9]{{2}})(?P<b{0}>[0-9]{{2}})(?P<c{0}>[a-z])?'.format(idx), re.UNICODE)
+                    for idx in xrange(60)]
+        document = u'1234a 56 7890 12345678b'
+        self.assertEqual(dicts(CombinedPatternSet(patterns).matches(document)), get_matches(document, patterns))
+
+    def test_digit_reach(self):
+        self.assertEqual(_digit_reach(u'[0-9]{2,3}'), 0)
+        self.assertEqual(_digit_reach(u'[rR][rR]\\D{0,3}?(?P<systolic>[0-9]{2,3})'), 5)
+        self.assertEqual(_digit_reach(u'(ab|c)\\d'), 2)
+        self.assertEqual(_digit_reach(u'(ab|c)?x\\d'), 3)
+        self.assertEqual(_digit_reach(u'a.*\\d'), None)
+        self.assertEqual(_digit_reach(u'[0-9a]'), None)
+        self.assertEqual(_digit_reach(u'(\\d)?a'), None)
+
+    def test_bloodpressure(self):
+        ms = BloodPressure().extract(u'Patsiendi RR 120/80 mmHg, ps 72x min.')
+        self.assertEqual(len(ms), 1)
+        self.assertEqual(ms[0]['systolic']['value'], 120)
+        self.assertEqual(ms[0]['diastolic']['value'], 80)
+        self.assertEqual(ms[0]['pulse']['value'], 72)
+
+    def test_window_matches(self):
+        patterns = BloodPressure().patterns
+        for document in DOCUMENTS:
+            self.assertEqual(map(dicts, CombinedPatternSet(patterns).pattern_matches(document, 10, 40)),
+                             map(dicts, PatternSet(patterns).pattern_matches(document, 10, 40)))
+
+
+class MatchRecordTest(unittest.TestCase):
+
+    def test_as_dict(self):
+        pattern = re.compile(u'(?P<systolic_low>[0-9]+)-(?P<systolic_high>[0-9]+)(?P<unit>mm)?', re.UNICODE)
+        m = pattern.search(u'RR 140-120')
+        self.assertEqual(Match.from_matchobject(m).as_dict(), dict_from_matchobject(m))
+
+    def test_batch_steps(self):
+        pattern = re.compile(u'(?P<low>[0-9]+(,[0-9])?)-(?P<high>[0-9]+)', re.UNICODE)
+        document = u'38,5-37 36-39 1-45'
+        ds = [dict_from_matchobject(m) for m in pattern.finditer(document)]
+        ds = [cast_fields(d, ['low', 'high'], float) for d in ds]
+        ds = [correct_low_high(d, ['low'], ['high']) for d in ds]
+        ds = [avg_estimates(d, ['value'], ['low'], ['high']) for d in ds]
+        ds = [d for d in ds if in_range(d, ['value', 'low'], {'value': 30, 'low': 30}, {'value': 40, 'low': 40})]
+        ms = [Match.from_matchobject(m) for m in pattern.finditer(document)]
+        cast_batch(ms, ['low', 'high'], float)
+        correct_low_high_batch(ms, ['low'], ['high'])
+        avg_estimates_batch(ms, ['value'], ['low'], ['high'])
+        ms = in_range_batch(ms, ['value', 'low'], {'value': 30, 'low': 30}, {'value': 40, 'low': 40})
+        self.assertEqual(dicts(ms), ds)
+        self.assertEqual(len(ms), 2)
+
+
+class ExtractManyTest(unittest.TestCase):
+
+    def test_serial(self):
+        extractor = NumExtractor()
+        self.assertEqual(list(extractor.extract_many(DOCUMENTS)), map(extractor.extract, DOCUMENTS))
+
+    def test_workers(self):
+        extractor = NumExtractor()
+        documents = DOCUMENTS * 5
+        self.assertEqual(list(extractor.extract_many(iter(documents), workers=2, chunksize=3, queue_size=1)),
+                         map(extractor.extract, documents))
+
+    def test_close(self):
+        extractor = NumExtractor()
+        results = extractor.extract_many(DOCUMENTS * 100, workers=2, chunksize=2)
+        self.assertEqual(results.next(), extractor.extract(DOCUMENTS[0]))
+        results.close()
+
+    def test_create_bp_table(self):
+        conn = sqlite3.connect(':memory:')
+        create_bp_table(conn, enumerate(DOCUMENTS), workers=2)
+        rows = conn.execute('select vid, systolic, diastolic, pulse from tm_misplus_rr order by id').fetchall()
+        self.assertEqual(rows[0], (2, 120, 80, 72))
+        self.assertEqual(sorted(set(vid for vid, _, _, _ in rows)), [2, 3, 5, 6])
+
+
+class RegistryTest(unittest.TestCase):
+
+    def test_shared(self):
+        self.assertIs(BloodPressure().patterns, BloodPressure(prefilter=True).patterns)
+        self.assertIs(Date().pattern_set, extractor_pattern_set(Date))
+        self.assertIsNot(Date().pattern_set, Date(engine='sequential').pattern_set)
+
+    def test_lazy(self):
+        extractor = CountingExtractor()
+        self.assertEqual(CountingExtractor.compiled, 0)
+        self.assertEqual(len(extractor.extract(u'1 2 3')), 3)
+        self.assertEqual(len(CountingExtractor().extract(u'4 5')), 2)
+        self.assertEqual(CountingExtractor.compiled, 1)
+        self.assertIs(extractor_patterns(CountingExtractor), extractor.patterns)
+
+    def test_enable(self):
+        extractor = NumExtractor(extractors=[u'record_date'])
+        self.assertEqual(extractor.extract(DOCUMENTS[3]).keys(), [u'record_date'])
+        extractor.enable(u'record_temperature')
+        extractor.disable(u'record_date')
+        self.assertEqual(extractor.extract(DOCUMENTS[2]).keys(), [u'record_temperature'])
+        self.assertEqual(list(extractor.extract_many(DOCUMENTS, workers=2)), map(extractor.extract, DOCUMENTS))
+        self.assertRaises(ValueError, extractor.enable, u'record_unknown')
+
+
+class AnnotateTest(unittest.TestCase):
+
+    def test_annotate(self):
+        extractor = NumExtractor(extractors=EXTRACTORS.keys())
+        for document in DOCUMENTS:
+            self.assertEqual(extractor.annotate(document), splice_annotate(extractor, document))
+
+    def test_annotate_values(self):
+        extractor = NumExtractor()
+        document = DOCUMENTS[2]
+        values = extractor.extract(document)
+        self.assertEqual(extractor.annotate(document, values), extractor.annotate(document))
+        self.assertTrue(extractor.annotate(document).startswith(u'<span class="record_bloodpressure" '))
+
+    def test_cli(self):
+        text = u'\n'.join(DOCUMENTS[2:] * 3).encode('utf-8')
+        extractor = NumExtractor(extractors=[u'record_bloodpressure', u'record_date'])
+        lines = text.decode('utf-8').splitlines(True)
+        html = self.run_cli(text, '--workers', '2', '--chunksize', '2',
+                            '--extractors', 'record_bloodpressure', 'record_date')
+        self.assertEqual(html.count(u'<p>'), len(lines))
+        self.assertIn(u'<p>' + extractor.annotate(lines[4]) + u'</p>', html)
+        jsonl = self.run_cli(text, '--format', 'jsonl', '--workers', '2', '--chunksize', '2',
+                             '--extractors', 'record_bloodpressure', 'record_date')
+        records = [json.loads(line) for line in jsonl.splitlines()]
+        self.assertEqual([record['text'] for record in records], [line.rstrip(u'\n') for line in lines])
+        self.assertEqual(records[0]['values'], extractor.extract(lines[0]))
+
+    def run_cli(self, text, *args):
+        root = os.path.dirname(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+        process = subprocess.Popen([sys.executable, '-m', 'hsm.tools.numextractor'] + list(args), cwd=root,
+                                   stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        output, _ = process.communicate(text)
+        self.assertEqual(process.returncode, 0)
+        return output.decode('utf-8')
+
+def splice_annotate(extractor, document):
+    '''The original annotation inserting the tags into a list of characters.'''
+    values = extractor.extract(document)
+    annots = []
+    for title in values:
+        for m in values[title]:
+            annots.extend(extractor._annots(title, m))
+    annots.sort(key=lambda x: x[0], reverse=True)
+    annotated = list(document)
+    for _, idx, annot in annots:
+        annotated[idx:idx] = annot
+    return u''.join(annotated)
+
+
+class CountingExtractor(Extractor):
+    
+    compiled = 0
+    
+    @staticmethod
+    def compile_patterns():
+        CountingExtractor.compiled += 1
+        return [re.compile(u'(?P<value>[0-9])', re.UNICODE)]
+    
+    def extract_records(self, document, guard=None):
+        return self.pattern_set.matches(document, guard)
+
+
+class SlowExtractor(Extractor):
+    '''Extractor with a pattern backtracking exponentially on runs of x.'''
+    
+    @staticmethod
+    def compile_patterns():
+        return [re.compile(u'(x+x+)+y|(?P<value>[0-9])', re.UNICODE),
+                re.compile(u'(?P<value>[0-9])', re.UNICODE)]
+    
+    def extract_records(self, document, guard=None):
+        return self.pattern_set.matches(document, guard)
+
+SLOW_DOCUMENT = u'1 ' + u'x' * 20 + u' 2'
+
+
+class RecordingHandler(logging.Handler):
+    '''Log handler collecting the messages.'''
+    
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.messages = []
+    
+    def emit(self, record):
+        self.messages.append(record.getMessage())
+
+
+class BudgetTest(unittest.TestCase):
+
+    def setUp(self):
+        EXTRACTORS['record_slow'] = SlowExtractor
+
+    def tearDown(self):
+        del EXTRACTORS['record_slow']
+
+    def test_pathological(self):
+        documents = [u'12' + u' ' * 5000 + u'x', u'1' * 5000, u'Metoprolol 1' + u' ' * 5000 + u'x',
+                     u'12 . ' * 1000 + u'kuu', u'RR ' + u'1.' * 2500, u'kaal 1' + u' ' * 5000 + u'x']
+        for name, cls in EXTRACTORS.iteritems():
+            for document in documents:
+                start = time.time()
+                cls().extract(document)
+                self.assertLess(time.time() - start, 5.0, name)
+
+    def test_pattern_budget(self):
+        guard = MatchGuard(pattern_budget=0.01)
+        self.assertEqual([m.original for m in SlowExtractor().extract_records(SLOW_DOCUMENT, guard)], [u'1', u'1', u'2'])
+        self.assertEqual(guard.stopped, [(None, 0)])
+        self.assertEqual(guard.slowest(), (None, 0))
+
+    def test_pattern_budget_windows(self):
+        guard = MatchGuard(pattern_budget=0.01)
+        pattern = SlowExtractor.compile_patterns()[0]
+        self.assertEqual([m.group() for m in guard.finditer(0, pattern, SLOW_DOCUMENT, 0, len(SLOW_DOCUMENT))], [u'1'])
+        self.assertEqual(list(guard.finditer(0, pattern, SLOW_DOCUMENT, 2, len(SLOW_DOCUMENT))), [])
+        self.assertEqual(guard.stopped, [(None, 0)])
+        report = ExtractionReport()
+        guard.stopped.append((None, 0))
+        report.add_patterns(guard)
+        self.assertEqual(report.slow_patterns[(None, 0)], [1, guard.times[(None, 0)]])
+
+    def test_budget(self):
+        self.assertRaises(BudgetExceeded, SlowExtractor().extract, SLOW_DOCUMENT, MatchGuard(budget=0.01))
+        self.assertEqual(len(SlowExtractor().extract(SLOW_DOCUMENT, MatchGuard(budget=60))), 4)
+
+    def test_skip(self):
+        extractor = NumExtractor(extractors=['record_slow', 'record_bloodpressure'], budget=0.01)
+        self.assertEqual(extractor.extract(SLOW_DOCUMENT), {'record_slow': [], 'record_bloodpressure': []})
+        self.assertEqual(len(extractor.extract(u'1 2')['record_slow']), 4)
+        self.assertEqual([entry[:2] + entry[3:5] for entry in extractor.report.slow_documents],
+                         [(0, len(SLOW_DOCUMENT), 'skipped', ('record_slow', 0))])
+        self.assertEqual(extractor.report.documents, 2)
+
+    def test_max_length(self):
+        extractor = NumExtractor(max_length=9, slow=0.0)
+        self.assertEqual(extractor.extract(DOCUMENTS[2]), extractor.extract(DOCUMENTS[2][:9]))
+        self.assertEqual([(entry[0], entry[3]) for entry in extractor.report.slow_documents],
+                         [(0, 'truncated'), (1, 'extracted')])
+        self.assertEqual(extractor.report.slow_documents[0][5], DOCUMENTS[2][:9])
+
+    def test_workers(self):
+        extractor = NumExtractor(extractors=['record_slow'], pattern_budget=0.01)
+        documents = [u'1 2', SLOW_DOCUMENT] * 3
+        self.assertEqual(list(extractor.extract_many(documents, workers=2, chunksize=1)),
+                         map(NumExtractor(extractors=['record_slow'], pattern_budget=0.01).extract, documents))
+        self.assertEqual(extractor.report.documents, 6)
+        self.assertEqual(extractor.report.slow_patterns.keys(), [('record_slow', 0)])
+        self.assertEqual(extractor.report.slow_patterns[('record_slow', 0)][0], 3)
+
+    def test_chunk_log_offset(self):
+        handler = RecordingHandler()
+        logger = logging.getLogger('numextractor')
+        logger.addHandler(handler)
+        try:
+            _init_extractor({'max_length': 3})
+            _, report = _extract_chunk([u'1', u'1 2 3'], 10)
+        finally:
+            logger.removeHandler(handler)
+        self.assertEqual(handler.messages, [u'Truncated document 11 of 5 characters'])
+        self.assertEqual([entry[0] for entry in report.slow_documents], [1])
+
+    def test_report(self):
+        first, second = ExtractionReport(), ExtractionReport()
+        first.documents = 3
+        second.add_document(10, 1.5, 'skipped', text=u'abc')
+        second.documents = 2
+        first.update(second)
+        self.assertEqual(first.documents, 5)
+        self.assertEqual(first.slow_documents, [(3, 10, 1.5, 'skipped', None, u'abc')])
+        self.assertEqual(len(first.summary()), 2)
+
+
+class ProfileTest(unittest.TestCase):
+
+    def test_counts(self):
+        profile = PatternProfile()
+        extractor = Temperature(engine='sequential')
+        values = extractor.extract(u'temp 37,2 ja t 38', MatchGuard(profile=profile))
+        self.assertEqual(values, extractor.extract(u'temp 37,2 ja t 38'))
+        self.assertEqual(sorted(profile.times), [(None, idx) for idx in xrange(4)])
+        self.assertEqual(profile.raw, {(None, 0): 0, (None, 1): 2, (None, 2): 0, (None, 3): 0})
+        self.assertEqual(profile.surviving, {(None, 1): 2})
+        self.assertEqual([row[3:] for row in profile.rows() if row[1] == 1], [(2, 2)])
+
+    def test_engines(self):
+        profiles = []
+        for engine in ['sequential', 'combined']:
+            extractor = NumExtractor(extractors=EXTRACTORS.keys(), engine=engine, profile=True)
+            for document in DOCUMENTS:
+                extractor.extract(document)
+            profiles.append(extractor.report.profile)
+        self.assertEqual(profiles[0].raw, profiles[1].raw)
+        self.assertEqual(profiles[0].surviving, profiles[1].surviving)
+        self.assertIn(('record_bloodpressure', tuple(xrange(15))), profiles[1].times)
+
+    def test_workers(self):
+        extractor = NumExtractor(profile=True)
+        documents = DOCUMENTS * 3
+        list(extractor.extract_many(documents, workers=2, chunksize=2))
+        serial = NumExtractor(profile=True)
+        for document in documents:
+            serial.extract(document)
+        self.assertEqual(extractor.report.profile.raw, serial.report.profile.raw)
+        self.assertEqual(extractor.report.profile.surviving, serial.report.profile.surviving)
+        self.assertEqual(len(extractor.reset_report().summary()), len(serial.report.summary()))
+        self.assertEqual(extractor.report.profile.raw, {})
+
+
+def dicts(ms):
+    return [m.as_dict() for m in ms]
+
+
+class PrefilterTest(unittest.TestCase):
+
+    def test_extractors(self):
+        for cls in [BloodPressure, Temperature, Medicine, Date, Timex, Measurements]:
+            extractor = cls()
+            prefiltered = cls(prefilter=True)
+            for document in DOCUMENTS:
+                self.assertEqual(extractor.extract(document), prefiltered.extract(document))
+
+    def test_windows(self):
+        prefilter = Prefilter(PatternSet([]), margin=5)
+        document = u'Kaebusi ei ole. RR 120/80 ja ps 72. ' + u'Patsient kaebab valu. ' * 3 + u'Temp 37'
+        self.assertEqual(prefilter.windows(u'Kaebusi ei ole.'), [])
+        self.assertEqual(prefilter.windows(document), [(11, 44), (102, 109)])
+
+    def test_keywords(self):
+        prefilter = Prefilter(PatternSet([]), keywords=[u'kaal'], margin=5)
+        self.assertEqual(prefilter.windows(u'RR 120/80. Patsient kaebab valu. kaal 82 kg'), [(33, 43)])
+
+    def test_skip_document(self):
+        prefilter = Prefilter(PatternSet(BloodPressure().patterns))
+        self.assertEqual(prefilter.matches(u'RR ja pulss mõõtmata.'), [])
+
+
+class RemoveSubmatchesTest(unittest.TestCase):
+
+    def test_remove_submatches(self):
+        ds = [self.match(0, 5), self.match(1, 3), self.match(0, 5, u'a'), self.match(4, 8), self.match(0, 5, u'b')]
+        self.assertEqual(remove_submatches(ds), [ds[3], ds[4]])
+
+    def test_compare_pairwise(self):
+        rnd = random.Random(0)
+        for _ in xrange(500):
+            ds = []
+            for _ in xrange(rnd.randint(0, 30)):
+                start = rnd.randint(0, 20)
+                fields = rnd.sample([u'a', u'b', u'c'], rnd.randint(0, 2))
+                ds.append(self.match(start, start + rnd.randint(0, 8), *fields))
+                # distinguish the matches to check which of the equal ones are kept
+                ds[-1]['original'] = unicode(len(ds))
+            self.assertEqual(remove_submatches(ds), pairwise_remove_submatches(ds))
+
+    def test_batch(self):
+        ds = [self.match(0, 5), self.match(1, 3), self.match(0, 5, u'a'), self.match(4, 8), self.match(0, 5, u'b')]
+        ms = [Match(d['start'], d['end'], d['original'], dict((field, Field(None)) for field in d if field in u'ab'))
+              for d in ds]
+        self.assertEqual(remove_submatches_batch(ms), [ms[3], ms[4]])
+
+    def match(self, start, end, *fields):
+        d = {'start': start, 'end': end, 'original': u''}
+        for field in fields:
+            d[field] = {'value': u''}
+        return d
+
+def pairwise_remove_submatches(ds):
+    '''The original quadratic implementation of remove_submatches.'''
+    n = len(ds)
+    ok = [True]*n
+    for i in range(n):
+        A = ds[i]
+        for j in range(i+1, n):
+            B = ds[j]
+            if A['start'] == B['start'] and A['end'] == B['end']:
+                if len(A) > len(B):
+                    ok[j] = False
+                    continue
+                elif len(A) < len(B):
+                    ok[i] = False
+                    continue
+            if A['start'] >= B['start'] and A['end'] <= B['end']:
+                ok[i] = False
+            elif A['start'] <= B['start'] and A['end'] >= B['end']:
+                ok[j] = False
+    return [ds[i] for i in range(n) if ok[i]]
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,122 @@
+import unittest
+
+from hsm.data.document import Document
+from hsm.data.documentstorage import DocumentStorage
+from hsm.data.segment import Segment
+from hsm.data.segmentstorage import SegmentStorage
+from hsm.tools.filter import Filter, FILTER_NAME, SEGMENT_NAME, OUTPUT_NAME, \
+    SEGMENT_VALUE_REGEX, CREATES_SEGMENT, MIXIN_NAME, VIRTUAL
+from hsm.tools.virtualsegmentstorage import VirtualSegmentStorage
+
+
+class RecordingSegmentStorage(SegmentStorage):
+    '''Segment storage recording the arguments of the queries.'''
+    
+    def __init__(self):
+        SegmentStorage.__init__(self)
+        self.queries = []
+    
+    def load_iterator(self, **kwargs):
+        self.queries.append(dict(kwargs))
+        return SegmentStorage.load_iterator(self, **kwargs)
+
+
+class VirtualSegmentStorageTest(unittest.TestCase):
+    
+    def test_load(self):
+        storage = self.storage()
+        self.assertEqual(storage.load(name=u'large'), frozenset([self.large()]))
+        self.assertEqual(storage.load(name=u'number'), frozenset([self.number(u'20', 9, 11, self.documentA()),
+                                                                  self.number(u'200', 7, 10, self.documentB())]))
+    
+    def test_load_document(self):
+        storage = self.storage()
+        self.assertEqual(list(storage.load_iterator(name=u'large', doc_name=u'DOCUMENT A')), [])
+        self.assertEqual(list(storage.load_iterator(name=u'large', doc_name=u'DOCUMENT B')), [self.large()])
+        self.assertEqual(list(storage.load_iterator(name=u'large', doc_prefix=u'DOCUMENT B')), [self.large()])
+    
+    def test_load_regex_and_limit(self):
+        storage = self.storage()
+        self.assertEqual(list(storage.load_iterator(name=u'large', neg_regex=u'2')), [])
+        self.assertEqual(list(storage.load_iterator(name=u'mixed', limit=2)),
+                         [Segment(u'mixed', u'Dude', self.documentA(), 0, 4),
+                          Segment(u'mixed', u'200', self.documentB(), 7, 10)])
+    
+    def test_nested(self):
+        self.assertEqual(self.storage().counts(name=u'mixed'), {u'mixed': 2})
+    
+    def test_positional(self):
+        storage = self.storage()
+        self.assertEqual(list(storage.load_overlapping(u'DOCUMENT B', 8, 9, name=u'large')), [self.large()])
+        self.assertEqual(list(storage.load_contained(u'DOCUMENT B', 0, 8, name=u'large')), [])
+    
+    def test_save_invalidates_cache(self):
+        storage = self.storage()
+        self.assertEqual(storage.load(name=u'mixed'), frozenset(self.mixed()))
+        storage.save([self.number(u'was', 5, 8, self.documentA())])
+        self.assertEqual(len(storage.load(name=u'mixed')), 3)
+        storage.delete(name=u'number', doc_name=u'DOCUMENT B')
+        self.assertEqual(len(storage.load(name=u'mixed')), 2)
+    
+    def test_exact_document(self):
+        segstorage = RecordingSegmentStorage()
+        segstorage.save(self.segmentstorage().load())
+        other = Document(u'DOCUMENT B2', u'it was 300')
+        segstorage.save([self.number(u'300', 7, 10, other)])
+        docstorage = self.documentstorage()
+        docstorage.save(other)
+        storage = VirtualSegmentStorage(segstorage, docstorage, self.filters())
+        self.assertEqual(list(storage.load_iterator(name=u'mixed', doc_name=u'DOCUMENT B')),
+                         [Segment(u'mixed', u'200', self.documentB(), 7, 10)])
+        self.assertEqual(set(kwargs.get('doc_name') for kwargs in segstorage.queries), set([u'DOCUMENT B']))
+        self.assertFalse(any('doc_prefix' in kwargs for kwargs in segstorage.queries))
+    
+    def test_cache_size(self):
+        storage = self.storage(cache_size=1)
+        self.assertEqual(storage.load(name=u'large'), frozenset([self.large()]))
+        self.assertEqual(storage.load(name=u'large'), frozenset([self.large()]))
+    
+    def test_not_virtual(self):
+        filters = self.filters()
+        del filters[1][VIRTUAL]
+        storage = VirtualSegmentStorage(self.segmentstorage(), self.documentstorage(), filters)
+        self.assertEqual(storage.virtual_names(), [u'mixed'])
+        self.assertEqual(storage.load(name=u'large'), frozenset())
+    
+    def number(self, value, start, end, document):
+        return Segment(u'number', value, document, start, end)
+    
+    def large(self):
+        return Segment(u'large', u'200', self.documentB(), 7, 10)
+    
+    def mixed(self):
+        return [Segment(u'mixed', u'Dude', self.documentA(), 0, 4),
+                Segment(u'mixed', u'200', self.documentB(), 7, 10)]
+    
+    def filters(self):
+        return [Filter(**{FILTER_NAME: u'words', SEGMENT_NAME: u'word', OUTPUT_NAME: u'word',
+                          SEGMENT_VALUE_REGEX: u'[A-Z]\\w+', CREATES_SEGMENT: True}),
+                Filter(**{FILTER_NAME: u'large', SEGMENT_NAME: u'number', OUTPUT_NAME: u'large',
+                          SEGMENT_VALUE_REGEX: u'\\w{3}', VIRTUAL: True}),
+                Filter(**{FILTER_NAME: u'mixed', SEGMENT_NAME: u'large', OUTPUT_NAME: u'mixed',
+                          MIXIN_NAME: u'word', VIRTUAL: True})]
+    
+    def storage(self, cache_size=1000):
+        return VirtualSegmentStorage(self.segmentstorage(), self.documentstorage(), self.filters(), cache_size)
+    
+    def segmentstorage(self):
+        storage = SegmentStorage()
+        storage.save([self.number(u'20', 9, 11, self.documentA()), self.number(u'200', 7, 10, self.documentB())])
+        storage.save([Segment(u'word', u'Dude', self.documentA(), 0, 4)])
+        return storage
+    
+    def documentA(self):
+        return Document(u'DOCUMENT A', u'Dude was 20')
+    
+    def documentB(self):
+        return Document(u'DOCUMENT B', u'it was 200')
+    
+    def documentstorage(self):
+        storage = DocumentStorage()
+        storage.save_all([self.documentA(), self.documentB()])
+        return storage
@@ -7,10 +7,24 @@ Features:
 - can create initial segments directly from documents
 - can filter segments containing/contained by other types of segments
 - can join or mix in segments of other types as a result.
+- can combine document sorted segment streams with span operators
+  (overlapping, containing, within, followed_by, union, intersection, difference).
 '''
+from bisect import bisect_left, bisect_right
+import heapq
+import hashlib
+from itertools import groupby, islice
+import json
+import multiprocessing
+import random
 import re
+import time
 
+from hsm.data.documentstorage import DocumentNotExistsException
+from hsm.data.nameset import NameSet
+from hsm.data.regexcache import compile_regex
 from hsm.data.segment import Segment
+from hsm.data.segmentwriter import SegmentWriter
 
 
 FILTER_NAME = 'filter_name'
@@ -40,6 +54,14 @@ MIXIN_NAME = 'mixin_name'
 MIXIN_VALUE_REGEX = 'mixin_value_regex'
 MIXIN_NEG_REGEX = 'mixin_neg_regex'
 
+VIRTUAL = 'virtual'
+
+BASIC_STAGE = 'basic'
+CONTAINER_STAGE = 'container'
+SPLITTER_STAGE = 'splitter'
+MIXIN_STAGE = 'mixin'
+OUTPUT_STAGE = 'output'
+
 class Filter(dict):
     # filter key names and types
     ALLOWED_KEYWORDS = frozenset([FILTER_NAME,
@@ -47,9 +69,10 @@ class Filter(dict):
                                   DOCUMENT_PREFIX, DOCUMENT_REGEX, DOCUMENT_NEG_REGEX,
                                   CONTAINER_NAME, CONTAINER_VALUE_REGEX, CONTAINER_NEG_REGEX, CONTAINER_INCLUDES, CONTAINER_KEEP_SOURCE,
                                   SPLITTER_LEFT, SPLITTER_REGEX, SPLITTER_RIGHT, SPLITTER_NEG_REGEX,
-                                  MIXIN_NAME, MIXIN_VALUE_REGEX, MIXIN_NEG_REGEX])
+                                  MIXIN_NAME, MIXIN_VALUE_REGEX, MIXIN_NEG_REGEX,
+                                  VIRTUAL])
     MANDATORY_KEYWORDS = frozenset([FILTER_NAME, SEGMENT_NAME, OUTPUT_NAME])
-    BOOLEAN_KEYWORDS = frozenset([CREATES_SEGMENT, CONTAINER_INCLUDES, CONTAINER_KEEP_SOURCE])
+    BOOLEAN_KEYWORDS = frozenset([CREATES_SEGMENT, CONTAINER_INCLUDES, CONTAINER_KEEP_SOURCE, VIRTUAL])
     
     def __init__(self, *args, **kwargs):
         dict.__init__(self, *args, **kwargs)
@@ -93,55 +116,460 @@ class Filter(dict):
                                         regex=self.get(DOCUMENT_REGEX, None),
                                         neg_regex=self.get(DOCUMENT_NEG_REGEX, None))
         
-    def _filtered_doc_names(self, docstorage, limit):
+    def _filtered_doc_names(self, docstorage, limit=None):
         if DOCUMENT_REGEX in self or DOCUMENT_NEG_REGEX in self:
-            return frozenset([doc.name for doc in self._doc_iterator(docstorage, limit)])
+            return NameSet(docstorage.load_names(self.get(DOCUMENT_PREFIX, u''),
+                                                 limit=limit,
+                                                 regex=self.get(DOCUMENT_REGEX, None),
+                                                 neg_regex=self.get(DOCUMENT_NEG_REGEX, None)))
+    
+    def compile(self, doc_name=None):
+        '''Compile the filter into a reusable FilterPlan.
+        doc_name - if given, the plan is evaluated only on the document with exactly this name.'''
+        return FilterPlan(self, doc_name)
+    
+    def filter_basic(self, segstorage, docstorage, limit=None, source=None):
+        return self.compile().basic(segstorage, docstorage, limit, source)
+
+    def filter_container(self, basic_segments, segstorage):
+        return self.compile().container(basic_segments, segstorage)
+    
+    def filter_splitter(self, container_segments):
+        return self.compile().splitter(container_segments)
+    
+    def filter_mixin(self, splitter_segments, segstorage):
+        return self.compile().mixin(splitter_segments, segstorage)
+    
+    def filter(self, segstorage, docstorage, source=None):
+        '''Generate the output segments of the filter.
+        If `source` is given, it is used in place of the basic segments loaded from `segstorage`,
+        which allows streaming the output of another filter without storing it.'''
+        return self.compile().filter(segstorage, docstorage, source)
+    
+    def apply(self, segstorage, docstorage, batch_size=100, queue_size=10):
+        '''Compute the output segments and replace the output layer with them.
+        The segments are saved by a background SegmentWriter while the filter is running.
+        Keyword arguments:
+        batch_size - the number of segments saved at once.
+        queue_size - the maximum number of batches waiting to be saved.'''
+        segstorage.delete(name=self[OUTPUT_NAME])
+        with SegmentWriter(segstorage, batch_size, queue_size) as writer:
+            writer.write_all(self.filter(segstorage, docstorage))
+    
+    def apply_incremental(self, segstorage, docstorage, statestorage, batch_size=100, queue_size=10, full_ratio=0.5):
+        '''Recompute the output segments only for documents that changed since the last incremental apply.
+        A document is changed, if the hash of the filter settings, the document text
+        and the segments of the input layers in the document differs from the hash stored
+        in `statestorage`. The output of changed and removed documents is deleted and
+        the changed documents are filtered again.
+        Keyword arguments:
+        full_ratio - if more than this ratio of documents has changed, or there is no stored state,
+                     the whole output layer is recomputed with `apply` instead.
+        Returns the sorted list of names of documents, whose output was recomputed or deleted.'''
+        outname = self[OUTPUT_NAME]
+        hashes = self.document_hashes(segstorage, docstorage)
+        previous = statestorage.load(outname)
+        changed = [name for name, digest in hashes.iteritems() if previous.get(name) != digest]
+        removed = [name for name in previous if name not in hashes]
+        if len(previous) == 0 or len(changed) > full_ratio * len(hashes):
+            self.apply(segstorage, docstorage, batch_size, queue_size)
+            statestorage.delete(outname)
+            statestorage.update(outname, hashes)
+            return list(sorted(set(hashes) | set(previous)))
+        for doc_name in changed + removed:
+            segstorage.delete(name=outname, doc_name=doc_name)
+        with SegmentWriter(segstorage, batch_size, queue_size) as writer:
+            for doc_name in sorted(changed):
+                for segment in self.compile(doc_name).filter(segstorage, docstorage):
+                    writer.write(segment)
+        statestorage.delete(outname, removed)
+        statestorage.update(outname, dict((name, hashes[name]) for name in changed))
+        return list(sorted(changed + removed))
+    
+    def document_hashes(self, segstorage, docstorage):
+        '''Compute a sha1 hash for each document matching the document prefix from
+        the filter settings, the document text and the input layer segments of the document.'''
+        prefix = self.get(DOCUMENT_PREFIX, u'')
+        settings = json.dumps(dict(self), sort_keys=True)
+        digests = dict()
+        for doc in docstorage.load_iterator(prefix):
+            digest = hashlib.sha1(settings)
+            digest.update(doc.text.encode('utf-8'))
+            digests[doc.name] = digest
+        layers = [segstorage.load_iterator(name=name, doc_prefix=prefix, sort=True) for name in self.input_names()]
+        for doc_name, segments in SegmentStreamMerger(*layers).get():
+            digest = digests.get(doc_name)
+            if digest is None:
+                continue
+            for idx, segs in enumerate(segments):
+                digest.update('\0layer{0}'.format(idx))
+                for start, end, value in sorted((seg.start, seg.end, seg.value) for seg in segs):
+                    digest.update(u'\0{0}:{1}:{2}'.format(start, end, value).encode('utf-8'))
+        return dict((name, unicode(digest.hexdigest())) for name, digest in digests.iteritems())
+    
+    def input_names(self):
+        '''Get the names of segment layers the output of the filter depends on.'''
+        names = []
+        if not self.get(CREATES_SEGMENT, False):
+            names.append(self[SEGMENT_NAME])
+        for key in [CONTAINER_NAME, MIXIN_NAME]:
+            if key in self:
+                names.append(self[key])
+        return names
+    
+    def apply_parallel(self, segstorage, docstorage, processes=None, partitions=None, storages=None,
+                       batch_size=100, queue_size=10):
+        '''Compute the output segments in a pool of worker processes and replace the output layer with them.
+        The document name space is split into disjoint prefixes, each of which is filtered
+        by a worker and the results are saved by the calling process.
+        Note that the partitions are determined by the names of stored documents, so
+        segments referring to documents missing from `docstorage` are not filtered.
+        Keyword arguments:
+        processes - the number of worker processes, by default the number of CPUs.
+        partitions - the number of partitions to split the documents into, by default 4 per process.
+        storages - a function returning a (segstorage, docstorage) tuple, called once in each worker.
+                   Required for database backed storages, whose connections must not be shared
+                   between processes. By default the workers use forked copies of given storages.
+        batch_size - the number of segments saved at once.
+        queue_size - the maximum number of batches waiting to be saved.'''
+        global _worker_storages
+        if processes is None:
+            processes = multiprocessing.cpu_count()
+        if partitions is None:
+            partitions = processes * 4
+        segstorage.delete(name=self[OUTPUT_NAME])
+        prefix = self.get(DOCUMENT_PREFIX, u'')
+        prefixes = partition_prefixes(self._document_names(docstorage, prefix), prefix, partitions)
+        # the storages are inherited by forked workers, so they must be set before creating the pool
+        _worker_storages = (segstorage, docstorage)
+        pool = multiprocessing.Pool(processes, _init_worker, (storages,))
+        try:
+            kwargs = dict(self)
+            jobs = [(kwargs, partition) for partition in prefixes]
+            with SegmentWriter(segstorage, batch_size, queue_size) as writer:
+                for segments in pool.imap_unordered(_filter_partition, jobs):
+                    for segment in segments:
+                        writer.write(Segment.from_dict(segment))
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+            _worker_storages = None
+    
+    def _document_names(self, docstorage, prefix):
+        return docstorage.load_names(prefix)
+
+
+class FilterPlan(object):
+    '''Compiled execution plan of a filter.
+    
+    The regular expressions of the filter are compiled once, so that the plan can be
+    reused for repeated runs and previews. The pipeline consists of the basic stage
+    followed by those of the container, splitter and mixin stages that are configured
+    in the filter, and the output stage renaming the segments.
+    If `doc_name` is given, all stages load the segments and documents of only
+    the document with exactly this name.'''
+    
+    def __init__(self, filt, doc_name=None):
+        self._filter = Filter(**filt)
+        self.doc_name = doc_name
+        self.value_regex = self._compile(SEGMENT_VALUE_REGEX)
+        self.neg_regex = self._compile(SEGMENT_NEG_REGEX)
+        self.document_regex = self._compile(DOCUMENT_REGEX)
+        self.document_neg_regex = self._compile(DOCUMENT_NEG_REGEX)
+        self.splitter_pattern = None
+        self.splitter_neg_pattern = None
+        if SPLITTER_REGEX in filt:
+            regex = filt.get(SPLITTER_LEFT, u'') + u'(?P<splitter>' + filt[SPLITTER_REGEX] + u')' + filt.get(SPLITTER_RIGHT, u'')
+            self.splitter_pattern = compile_regex(regex, re.UNICODE | re.MULTILINE)
+            self.splitter_neg_pattern = self._compile(SPLITTER_NEG_REGEX, re.UNICODE | re.MULTILINE)
+        self.stages = [BASIC_STAGE]
+        for key, stage in [(CONTAINER_NAME, CONTAINER_STAGE), (SPLITTER_REGEX, SPLITTER_STAGE), (MIXIN_NAME, MIXIN_STAGE)]:
+            if key in filt:
+                self.stages.append(stage)
+    
+    def _compile(self, key, flags=re.UNICODE):
+        if key in self._filter:
+            return compile_regex(self._filter[key], flags)
+    
+    @property
+    def settings(self):
+        '''The settings of the compiled filter.'''
+        return Filter(**self._filter)
+    
+    def basic(self, segstorage, docstorage, limit=None, source=None):
+        '''Load or create the basic segments of the filter.
+        If `source` is given, it is used in place of the segments loaded from `segstorage`.'''
+        creates_segment = self._filter.get(CREATES_SEGMENT, False)
+        if source is not None:
+            assert not creates_segment
+            return self._source_segment_iterator(source, docstorage, limit=limit)
+        elif creates_segment:
+            return self._basic_segmentcreator_iterator(docstorage, limit=limit)
+        else:
+            sort = CONTAINER_NAME in self._filter
+            return self._basic_segment_iterator(segstorage, docstorage, sort, limit=limit)
+    
+    def container(self, basic_segments, segstorage):
+        if CONTAINER_NAME in self._filter:
+            return ContainerFilter(basic_segments,
+                                   self._container_segments(segstorage),
+                                   self._filter.get(CONTAINER_INCLUDES, True),
+                                   self._filter.get(CONTAINER_KEEP_SOURCE, True)).get()
+        return basic_segments
+    
+    def splitter(self, container_segments):
+        '''Split the segments with the splitter pattern. Without a splitter, the segments are passed through.'''
+        if self.splitter_pattern is None:
+            return container_segments
+        return self._split_all(container_segments)
+    
+    def mixin(self, splitter_segments, segstorage):
+        if MIXIN_NAME in self._filter:
+            for seg in self._mixin_segments(segstorage):
+                yield seg
+        for seg in splitter_segments:
+            yield seg
+    
+    def output(self, mixin_segments):
+        outname = self._filter[OUTPUT_NAME]
+        for seg in mixin_segments:
+            # yield renamed copies, as memory storages return the stored segment instances
+            yield Segment(outname, seg.value, None, seg.start, seg.end, seg.doc_name, seg.doc_len)
+    
+    def filter(self, segstorage, docstorage, source=None):
+        '''Generate the output segments of the filter.'''
+        return self.pipeline(segstorage, docstorage, source)
+    
+    def pipeline(self, segstorage, docstorage, source=None, tap=None, limit=None):
+        '''Build the generator of the output segments.
+        Keyword arguments:
+        source - an iterable to use in place of the basic segments loaded from `segstorage`.
+        tap - a function called with the name and the iterable of each stage, including
+              the final OUTPUT_STAGE. The returned iterable is passed on to the next stage.
+        limit - the maximum number of basic segments.'''
+        if tap is None:
+            tap = lambda stage, iterable: iterable
+        segments = tap(BASIC_STAGE, self.basic(segstorage, docstorage, limit, source))
+        if CONTAINER_STAGE in self.stages:
+            segments = tap(CONTAINER_STAGE, self.container(segments, segstorage))
+        if SPLITTER_STAGE in self.stages:
+            segments = tap(SPLITTER_STAGE, self.splitter(segments))
+        if MIXIN_STAGE in self.stages:
+            segments = tap(MIXIN_STAGE, self.mixin(segments, segstorage))
+        return tap(OUTPUT_STAGE, self.output(segments))
+    
+    def estimate(self, segstorage, docstorage, sample_size=100):
+        '''Estimate the number of segments produced by each stage.
+        The segment and document counts of the storages are scaled by the
+        selectivity of the stages, measured on samples of `sample_size` items.
+        Returns a dictionary mapping the stage names to the estimated counts.'''
+        filt = self._filter
+        prefix = filt.get(DOCUMENT_PREFIX, u'')
+        docs = list(docstorage.load_iterator(prefix, limit=sample_size))
+        doc_fraction = _ratio(len([doc for doc in docs if self._document_matches(doc.text)]), len(docs))
+        if filt.get(CREATES_SEGMENT, False):
+            matches = sum(1 for doc in docs if self._document_matches(doc.text) for _ in self._create(doc))
+            estimate = _ratio(matches, len(docs)) * docstorage.count(prefix)
+        else:
+            name = filt[SEGMENT_NAME]
+            total = segstorage.counts(name=name, doc_prefix=prefix).get(name, 0)
+            sample = list(segstorage.load_iterator(name=name, doc_prefix=prefix, limit=sample_size))
+            passed = len([seg for seg in sample if self._matches(seg.value)])
+            estimate = _ratio(passed, len(sample)) * total * doc_fraction
+        estimates = {BASIC_STAGE: estimate}
+        sample = list(self.basic(segstorage, docstorage, limit=sample_size))
+        if CONTAINER_STAGE in self.stages:
+            contained = []
+            for doc_name, segments in groupby(sorted(sample, key=lambda seg: seg.doc_name), key=lambda seg: seg.doc_name):
+                containers = segstorage.load_iterator(name=filt[CONTAINER_NAME],
+                                                      value_regex=filt.get(CONTAINER_VALUE_REGEX, None),
+                                                      neg_regex=filt.get(CONTAINER_NEG_REGEX, None),
+                                                      doc_name=doc_name)
+                contained.extend(ContainerFilter(list(segments), containers,
+                                                filt.get(CONTAINER_INCLUDES, True),
+                                                filt.get(CONTAINER_KEEP_SOURCE, True)).get())
+            estimate *= _ratio(len(contained), len(sample))
+            estimates[CONTAINER_STAGE] = estimate
+            sample = contained
+        if SPLITTER_STAGE in self.stages:
+            estimate *= _ratio(len(list(self.splitter(sample))), len(sample))
+            estimates[SPLITTER_STAGE] = estimate
+        if MIXIN_STAGE in self.stages:
+            name = filt[MIXIN_NAME]
+            total = segstorage.counts(name=name, doc_prefix=prefix).get(name, 0)
+            if MIXIN_VALUE_REGEX in filt or MIXIN_NEG_REGEX in filt:
+                mixins = len(list(segstorage.load_iterator(name=name, doc_prefix=prefix, limit=sample_size)))
+                passed = len(list(segstorage.load_iterator(name=name, doc_prefix=prefix, limit=sample_size,
+                                                           value_regex=filt.get(MIXIN_VALUE_REGEX, None),
+                                                           neg_regex=filt.get(MIXIN_NEG_REGEX, None))))
+                total *= min(1.0, _ratio(passed, mixins))
+            estimate += total
+            estimates[MIXIN_STAGE] = estimate
+        estimates[OUTPUT_STAGE] = estimate
+        return dict((stage, int(round(value))) for stage, value in estimates.iteritems())
+    
+    def explain(self, segstorage, docstorage, sample_size=100, limit=None):
+        '''Run the filter without saving the output and report the estimated and actual
+        number of segments and the time spent in each stage.
+        Keyword arguments:
+        sample_size - the number of items sampled for the estimates.
+        limit - if given, stop after this many output segments.
+        Returns a list of dictionaries with keys `stage`, `estimated`, `actual` and `time`.'''
+        estimates = self.estimate(segstorage, docstorage, sample_size)
+        taps = dict()
+        def tap(stage, iterable):
+            taps[stage] = StageTap(iterable)
+            return taps[stage]
+        for _ in islice(self.pipeline(segstorage, docstorage, tap=tap), limit):
+            pass
+        report = []
+        upstream = 0.0
+        for stage in self.stages + [OUTPUT_STAGE]:
+            # the time measured by a tap includes pulling the segments of the previous stages
+            report.append({'stage': stage,
+                           'estimated': estimates[stage],
+                           'actual': taps[stage].count,
+                           'time': max(0.0, taps[stage].elapsed - upstream)})
+            upstream = taps[stage].elapsed
+        return report
+    
+    def preview(self, segstorage, docstorage, sample_size=300, budget=None, limit=None, seed=None):
+        '''Run the filter once without saving the output, sampling the segments of each stage.
+        Keyword arguments:
+        sample_size - the maximum number of segments sampled uniformly from each stage.
+        budget - if given, stop the run after this many seconds of wall-clock time.
+        limit - the maximum number of basic segments.
+        seed - the seed of the random sampling.
+        Returns a dictionary mapping the stage names to dictionaries with keys
+        `count` (the number of segments seen) and `sample` (the sampled segments in stream order),
+        and key `complete`, which is False if the run was stopped by the budget.'''
+        rnd = random.Random(seed)
+        deadline = None if budget is None else time.time() + budget
+        taps = dict()
+        def tap(stage, iterable):
+            taps[stage] = PreviewTap(iterable, sample_size, rnd, deadline)
+            return taps[stage]
+        for _ in self.pipeline(segstorage, docstorage, tap=tap, limit=limit):
+            pass
+        result = dict((stage, {'count': stage_tap.count, 'sample': stage_tap.sample()})
+                      for stage, stage_tap in taps.iteritems())
+        result['complete'] = not any(stage_tap.expired for stage_tap in taps.itervalues())
+        return result
+    
+    def _doc_selector(self):
+        '''Get the keyword arguments of segment storage queries selecting the documents of the plan.'''
+        if self.doc_name is not None:
+            return {'doc_name': self.doc_name}
+        return {'doc_prefix': self._filter.get(DOCUMENT_PREFIX, None)}
+    
+    def _selected_document(self, docstorage):
+        '''Get the list of the document `doc_name`, if it exists and passes the document regexes.'''
+        try:
+            doc = docstorage.load(self.doc_name)
+        except DocumentNotExistsException:
+            return []
+        return [doc] if self._document_matches(doc.text) else []
+    
+    def _filtered_doc_names(self, docstorage):
+        if self.doc_name is None:
+            return self._filter._filtered_doc_names(docstorage)
+        if self.document_regex is None and self.document_neg_regex is None:
+            return None
+        return NameSet(doc.name for doc in self._selected_document(docstorage))
+    
+    def _matches(self, value):
+        if self.value_regex is not None and self.value_regex.search(value) is None:
+            return False
+        if self.neg_regex is not None and self.neg_regex.search(value) is not None:
+            return False
+        return True
+    
+    def _document_matches(self, text):
+        if self.document_regex is not None and self.document_regex.search(text) is None:
+            return False
+        if self.document_neg_regex is not None and self.document_neg_regex.search(text) is not None:
+            return False
+        return True
     
     def _basic_segment_iterator(self, segstorage, docstorage, sort=False, limit=None):
-        '''Method that loads the baseic segments of the filter.'''
-        iterator = segstorage.load_iterator(name=self.get(SEGMENT_NAME),
-                                            value_regex=self.get(SEGMENT_VALUE_REGEX, None),
-                                            neg_regex=self.get(SEGMENT_NEG_REGEX, None),
-                                            doc_prefix=self.get(DOCUMENT_PREFIX, None),
+        '''Method that loads the basic segments of the filter.'''
+        filt = self._filter
+        iterator = segstorage.load_iterator(name=filt.get(SEGMENT_NAME),
+                                            value_regex=filt.get(SEGMENT_VALUE_REGEX, None),
+                                            neg_regex=filt.get(SEGMENT_NEG_REGEX, None),
                                             sort=sort,
-                                            limit=limit)
+                                            limit=limit,
+                                            **self._doc_selector())
         docnames = self._filtered_doc_names(docstorage)
         for segment in iterator:
             if docnames is not None and segment.doc_name not in docnames:
                 continue
             yield segment
     
+    def _source_segment_iterator(self, source, docstorage, limit=None):
+        '''Method that filters the basic segments given by an iterable, as they would be filtered when loaded from storage.'''
+        prefix = self._filter.get(DOCUMENT_PREFIX, u'')
+        docnames = self._filtered_doc_names(docstorage)
+        num_segments = 0
+        for segment in source:
+            if limit is not None and num_segments >= limit:
+                break
+            if not segment.doc_name.startswith(prefix):
+                continue
+            if self.doc_name is not None and segment.doc_name != self.doc_name:
+                continue
+            if docnames is not None and segment.doc_name not in docnames:
+                continue
+            if not self._matches(segment.value):
+                continue
+            num_segments += 1
+            yield segment
+    
     def _basic_segmentcreator_iterator(self, docstorage, limit=None):
         '''Method that creates basic segments from raw documents.'''
-        # compile value and negative regexes as necessary
-        value_regex = re.compile(self[SEGMENT_VALUE_REGEX], re.UNICODE)
-        neg_regex = None
-        if SEGMENT_NEG_REGEX in self:
-            neg_regex = re.compile(self[SEGMENT_NEG_REGEX], re.UNICODE)
-        # iterate all matching documents to find matching segments
-        seg_name = self[SEGMENT_NAME]
-        for doc in self._doc_iterator(docstorage, limit):
-            text = doc.text
-            for mo in value_regex.finditer(text):
-                value = mo.group(0)
-                # skip this item, if the negative regex matches it
-                if neg_regex is not None and neg_regex.search(value) is not None:
-                    continue
-                yield Segment(seg_name, value, doc, mo.start(0), mo.end(0))
-
+        if self.doc_name is not None:
+            docs = self._selected_document(docstorage)
+        else:
+            docs = self._filter._doc_iterator(docstorage, limit)
+        for doc in docs:
+            for segment in self._create(doc):
+                yield segment
+    
+    def _create(self, doc):
+        seg_name = self._filter[SEGMENT_NAME]
+        neg_regex = self.neg_regex
+        for mo in self.value_regex.finditer(doc.text):
+            value = mo.group(0)
+            # skip this item, if the negative regex matches it
+            if neg_regex is not None and neg_regex.search(value) is not None:
+                continue
+            yield Segment(seg_name, value, doc, mo.start(0), mo.end(0))
+    
     def _container_segments(self, segstorage):
-        return segstorage.load_iterator(name=self.get(CONTAINER_NAME),
-                                        value_regex=self.get(CONTAINER_VALUE_REGEX, None),
-                                        neg_regex=self.get(CONTAINER_NEG_REGEX, None),
-                                        doc_prefix=self.get(DOCUMENT_PREFIX, None))
-
-
+        # the merger and span operators need the segments in document name order
+        filt = self._filter
+        return segstorage.load_iterator(name=filt.get(CONTAINER_NAME),
+                                        value_regex=filt.get(CONTAINER_VALUE_REGEX, None),
+                                        neg_regex=filt.get(CONTAINER_NEG_REGEX, None),
+                                        sort=True,
+                                        **self._doc_selector())
+    
     def _mixin_segments(self, segstorage):
-        return segstorage.load_iterator(name=self.get(MIXIN_NAME),
-                                        value_regex=self.get(MIXIN_VALUE_REGEX, None),
-                                        neg_regex=self.get(MIXIN_NEG_REGEX, None),
-                                        doc_prefix=self.get(DOCUMENT_PREFIX, None))
-
+        filt = self._filter
+        return segstorage.load_iterator(name=filt.get(MIXIN_NAME),
+                                        value_regex=filt.get(MIXIN_VALUE_REGEX, None),
+                                        neg_regex=filt.get(MIXIN_NEG_REGEX, None),
+                                        sort=True,
+                                        **self._doc_selector())
+    
+    def _split_all(self, container_segments):
+        for cont_seg in container_segments:
+            for seg in self._split(cont_seg, self.splitter_pattern, self.splitter_neg_pattern):
+                yield seg
+    
     def _split(self, segment, pattern, neg_pattern):
         if segment.end - segment.start != len(segment.value):
             raise AssertionError('Splitter requires that the segment value would be same length as referenced document text.')
@@ -168,64 +596,106 @@ class Filter(dict):
             offset_end = end + segment.start
             yield Segment(segment.name, segment.value[start:end], None, offset_start, offset_end, segment.doc_name, segment.doc_len)
 
-    def filter_basic(self, segstorage, docstorage, limit=None):
-        creates_segment = self.get(CREATES_SEGMENT, False)
-        if creates_segment:
-            return self._basic_segmentcreator_iterator(docstorage, limit=limit)
-        else:
-            sort = False
-            if CONTAINER_NAME in self:
-                sort = True
-            return self._basic_segment_iterator(segstorage, docstorage, sort, limit=limit)
 
-    def filter_container(self, basic_segments, segstorage):
-        if CONTAINER_NAME in self:
-            return ContainerFilter(basic_segments, self._container_segments(segstorage)).get()
-        return basic_segments
+class StageTap(object):
+    '''Iterator counting the items of a pipeline stage and the time spent producing them.'''
     
-    def filter_splitter(self, container_segments):
-        if SPLITTER_REGEX in self:
-            regex = self.get(SPLITTER_LEFT, u'') + u'(?P<splitter>' + self.get(SPLITTER_REGEX, u'') + u')' + self.get(SPLITTER_RIGHT, u'')
-            pattern = re.compile(regex, re.UNICODE | re.MULTILINE)
-            neg_pattern = None
-            if SPLITTER_NEG_REGEX in self:
-                neg_pattern = re.compile(self[SPLITTER_NEG_REGEX], re.UNICODE | re.MULTILINE)
-            for cont_seg in container_segments:
-                for seg in self._split(cont_seg, pattern, neg_pattern):
-                    yield seg
-        for seg in container_segments:
-            yield seg
+    def __init__(self, iterable):
+        self._iterator = iter(iterable)
+        self.count = 0
+        self.elapsed = 0.0
     
-    def filter_mixin(self, splitter_segments, segstorage):
-        if MIXIN_NAME in self:
-            for seg in self._mixin_segments(segstorage):
-                yield seg
-        for seg in splitter_segments:
-            yield seg
+    def __iter__(self):
+        return self
     
-    def filter(self, segstorage, docstorage):
-        basic = self.filter_basic(segstorage, docstorage)
-        container = self.filter_container(basic, segstorage)
-        splitter = self.filter_splitter(container)
-        mixin = self.filter_mixin(splitter, segstorage)
-        outname = self[OUTPUT_NAME]
-        for seg in mixin:
-            seg.name = outname
-            yield seg
+    def next(self):
+        start = time.time()
+        try:
+            item = self._iterator.next()
+        finally:
+            self.elapsed += time.time() - start
+        self.count += 1
+        return item
+
+class PreviewTap(StageTap):
+    '''Stage tap keeping a uniform reservoir sample of the items and stopping the stage after a deadline.'''
     
-    def apply(self, segstorage, docstorage):
-        segstorage.delete(name=self[OUTPUT_NAME])
-        batch_size = 100
-        segs = []
-        for seg in self.filter(segstorage, docstorage):
-            segs.append(seg)
-            if len(segs) > batch_size:
-                segstorage.save(segs)
-                segs = []
-        segstorage.save(segs)
+    def __init__(self, iterable, sample_size, rnd, deadline=None):
+        StageTap.__init__(self, iterable)
+        self._sample_size = sample_size
+        self._rnd = rnd
+        self._deadline = deadline
+        self._reservoir = []
+        self.expired = False
+    
+    def next(self):
+        if self._deadline is not None and time.time() >= self._deadline:
+            self.expired = True
+            raise StopIteration
+        item = StageTap.next(self)
+        if len(self._reservoir) < self._sample_size:
+            self._reservoir.append((self.count, item))
+        else:
+            idx = self._rnd.randint(0, self.count - 1)
+            if idx < self._sample_size:
+                self._reservoir[idx] = (self.count, item)
+        return item
+    
+    def sample(self):
+        '''Get the sampled items in the order they were generated.'''
+        return [item for _, item in sorted(self._reservoir, key=lambda entry: entry[0])]
+
+def _ratio(numerator, denominator):
+    if denominator == 0:
+        return 0.0
+    return float(numerator) / denominator
+
+_worker_storages = None
+
+def _init_worker(storages):
+    global _worker_storages
+    if storages is not None:
+        _worker_storages = storages()
+
+def _filter_partition(args):
+    '''Run the filter on a single partition in a worker process.
+    The segments are returned as dictionaries to keep the results cheap to pickle.'''
+    kwargs, prefix = args
+    segstorage, docstorage = _worker_storages
+    filt = Filter(**kwargs)
+    filt[DOCUMENT_PREFIX] = prefix
+    return [Segment.to_dict(segment) for segment in filt.filter(segstorage, docstorage)]
+
+def partition_prefixes(names, prefix, partitions):
+    '''Split the name space under `prefix` into disjoint prefixes covering all given `names`.
+    The prefix with most names is split repeatedly by the next character of the names,
+    until there are at least `partitions` prefixes or no prefix can be split.
+    A prefix that is itself one of the names is not split.'''
+    assert isinstance(prefix, unicode)
+    assert partitions > 0
+    names = sorted(names)
+    if len(names) == 0:
+        return [prefix]
+    heap = [(-len(names), prefix, names)]
+    done = []
+    while len(heap) > 0 and len(heap) + len(done) < partitions:
+        _, current, group = heapq.heappop(heap)
+        if len(group) == 1 or group[0] == current:
+            done.append(current)
+            continue
+        depth = len(current) + 1
+        for child, members in groupby(group, key=lambda name: name[:depth]):
+            members = list(members)
+            heapq.heappush(heap, (-len(members), child, members))
+    return list(sorted(done + [current for _, current, _ in heap]))
 
 
 class ContainerFilter(object):
+    '''Filter segments by containment between basic and container segments.
+
+    For each document the segments of the other collection are put in a SpanIndex,
+    so that whether a segment is contained by (or contains) any of them is answered
+    with a binary search. The matching segments are yielded in their original order.'''
     
     def __init__(self, basic_segments, container_segments, container_includes=True, keep_source=True):
         self._basic = basic_segments
@@ -235,38 +705,119 @@ class ContainerFilter(object):
     
     def get(self):
         matcher = SegmentDocumentMatcher(self._basic, self._container)
-        if self._keep_source and self._includes:
-            for first, second in matcher.get():
-                for seg in first:
-                    if self._is_matched(seg, second):
-                        yield seg
-        elif not self._keep_source and self._includes:
-            for first, second in matcher.get():
-                for seg in second:
-                    if self._matches(seg, first):
-                        yield seg
-        elif self._keep_source and not self._includes:
-            for first, second in matcher.get():
-                for seg in first:
-                    if self._matches(seg, second):
-                        yield seg
-        elif not self._keep_source and not self._includes:
-            for first, second in matcher.get():
-                for seg in second:
-                    if self._is_matched(seg, first):
-                        yield seg
-    
-    def _is_matched(self, segment, collection):
-        for col_segment in collection:
-            if segment.start >= col_segment.start and segment.end <= col_segment.end:
-                return True
-        return False
-    
-    def _matches(self, segment, collection):
-        for col_segment in collection:
-            if segment.start <= col_segment.start and segment.end >= col_segment.end:
-                return True
-        return False
+        for first, second in matcher.get():
+            if self._keep_source:
+                segments, collection = first, second
+                contained = self._includes
+            else:
+                segments, collection = second, first
+                contained = not self._includes
+            if contained:
+                matched = self._is_matched
+            else:
+                matched = self._matches
+            for seg in matched(segments, collection):
+                yield seg
+    
+    def _is_matched(self, segments, collection):
+        '''Generate segments that lie within at least one segment of the collection.'''
+        index = SpanIndex(collection)
+        for segment in segments:
+            if index.any_containing(segment.start, segment.end):
+                yield segment
+    
+    def _matches(self, segments, collection):
+        '''Generate segments that cover at least one segment of the collection.'''
+        index = SpanIndex(collection)
+        for segment in segments:
+            if index.any_contained(segment.start, segment.end):
+                yield segment
+
+
+class SpanIndex(object):
+    '''Static index of the spans of the segments of a single document.
+
+    Segments are sorted by start, along with the running maximum of ends from
+    the left and the running minimum of ends from the right, so that existence
+    queries are answered with a single binary search.'''
+    
+    def __init__(self, segments):
+        segments = sorted(segments, key=lambda seg: (seg.start, seg.end))
+        self._starts = [seg.start for seg in segments]
+        self._spans = frozenset((seg.start, seg.end) for seg in segments)
+        # max_ends[idx] is the largest end among the first idx + 1 segments
+        self._max_ends = []
+        max_end = None
+        for seg in segments:
+            max_end = seg.end if max_end is None else max(max_end, seg.end)
+            self._max_ends.append(max_end)
+        # min_ends[idx] is the smallest end among the segments from idx onwards
+        self._min_ends = [None] * len(segments)
+        min_end = None
+        for idx in xrange(len(segments) - 1, -1, -1):
+            end = segments[idx].end
+            min_end = end if min_end is None else min(min_end, end)
+            self._min_ends[idx] = min_end
+    
+    def __len__(self):
+        return len(self._starts)
+    
+    def has_span(self, start, end):
+        '''Is there a segment with exactly the span [start, end).'''
+        return (start, end) in self._spans
+    
+    def any_containing(self, start, end):
+        '''Is there a segment covering the whole span [start, end).'''
+        idx = bisect_right(self._starts, start)
+        return idx > 0 and self._max_ends[idx - 1] >= end
+    
+    def any_contained(self, start, end):
+        '''Is there a segment lying within the span [start, end).'''
+        idx = bisect_left(self._starts, start)
+        return idx < len(self._starts) and self._min_ends[idx] <= end
+    
+    def any_overlapping(self, start, end):
+        '''Is there a segment sharing at least one character with the span [start, end).'''
+        idx = bisect_left(self._starts, end)
+        return idx > 0 and self._max_ends[idx - 1] > start
+    
+    def any_starting(self, min_start, max_start):
+        '''Is there a segment starting in range [min_start, max_start].'''
+        idx = bisect_left(self._starts, min_start)
+        return idx < len(self._starts) and self._starts[idx] <= max_start
+
+
+class SegmentStreamMerger(object):
+    '''Class that takes any number of iterables that return segments sorted by
+       document names and merges them into a single stream of documents.
+       Only the segments of a single document are held in memory at a time.'''
+    
+    def __init__(self, *iterators):
+        self._iterators = iterators
+    
+    def get(self, required=None):
+        '''Generate (doc_name, [segments of each iterable]) tuples in document name order.
+        Keyword arguments:
+        required - the indices of iterables, that must have segments in the document,
+                   by default documents present in any of the iterables are generated.'''
+        groups = [groupby(iterator, key=lambda seg: seg.doc_name) for iterator in self._iterators]
+        heap = []
+        for idx, group in enumerate(groups):
+            self._push(heap, group, idx)
+        while len(heap) > 0:
+            doc_name = heap[0][0]
+            segments = [[] for _ in groups]
+            while len(heap) > 0 and heap[0][0] == doc_name:
+                _, idx, segs = heapq.heappop(heap)
+                segments[idx].extend(segs)
+                self._push(heap, groups[idx], idx)
+            if required is None or all(len(segments[idx]) > 0 for idx in required):
+                yield (doc_name, segments)
+    
+    def _push(self, heap, group, idx):
+        for doc_name, segs in group:
+            heapq.heappush(heap, (doc_name, idx, list(segs)))
+            return
 
 
 class SegmentDocumentMatcher(object):
@@ -278,31 +829,68 @@ class SegmentDocumentMatcher(object):
         self._first = first_iterator
         self._second = second_iterator
     
-    def _get_single(self, iterator):
-        doc_name = None
-        segs = []
-        for seg in iterator:
-            if seg.doc_name != doc_name:
-                if doc_name is not None:
-                    yield segs
-                    segs = []
-                doc_name = seg.doc_name
-            segs.append(seg)
-        if doc_name is not None:
-            yield segs
-    
     def get(self):
-        first_iter = self._get_single(self._first)
-        second_iter = self._get_single(self._second)
-        first_segs, second_segs = first_iter.next(), second_iter.next()
-        while len(first_segs) > 0 and len(second_segs) > 0:
-            first_name = first_segs[0].doc_name
-            second_name = second_segs[0].doc_name
-            res = cmp(first_name, second_name)
-            if res < 0:  # skip first segments
-                first_segs = first_iter.next()
-            elif res > 0:  # skip second segments
-                second_segs = second_iter.next()
-            else:
-                yield (first_segs, second_segs)
-                first_segs, second_segs = first_iter.next(), second_iter.next()
+        merger = SegmentStreamMerger(self._first, self._second)
+        for _, (first_segs, second_segs) in merger.get(required=[0, 1]):
+            yield (first_segs, second_segs)
+
+
+def _index_join(first, others, predicate, required_others=True):
+    '''Generate segments of `first`, for which `predicate(segment, span indices of others)` holds.'''
+    required = [0] + range(1, len(others) + 1) if required_others else [0]
+    for _, segments in SegmentStreamMerger(first, *others).get(required=required):
+        indices = [SpanIndex(segs) for segs in segments[1:]]
+        for segment in segments[0]:
+            if predicate(segment, indices):
+                yield segment
+
+def overlapping(first, second):
+    '''Generate segments of `first` sharing at least one character with a segment of `second`.
+    Both iterables must be sorted by document names.'''
+    return _index_join(first, [second], lambda seg, idx: idx[0].any_overlapping(seg.start, seg.end))
+
+def containing(first, second):
+    '''Generate segments of `first` that cover a segment of `second`.
+    Both iterables must be sorted by document names.'''
+    return _index_join(first, [second], lambda seg, idx: idx[0].any_contained(seg.start, seg.end))
+
+def within(first, second):
+    '''Generate segments of `first` that lie within a segment of `second`.
+    Both iterables must be sorted by document names.'''
+    return _index_join(first, [second], lambda seg, idx: idx[0].any_containing(seg.start, seg.end))
+
+def followed_by(first, second, k=0):
+    '''Generate segments of `first` that are followed by a segment of `second`
+    starting at most `k` characters after the end of the segment.
+    Both iterables must be sorted by document names.'''
+    assert k >= 0
+    return _index_join(first, [second], lambda seg, idx: idx[0].any_starting(seg.end, seg.end + k))
+
+def union(*iterables):
+    '''Generate segments with distinct spans from all iterables.
+    For each span only the segment of the first iterable having it is generated.
+    All iterables must be sorted by document names, the segments of
+    a document are generated ordered by span.'''
+    for _, segments in SegmentStreamMerger(*iterables).get():
+        merged = []
+        for idx, segs in enumerate(segments):
+            merged.extend(((seg.start, seg.end), idx, pos, seg) for pos, seg in enumerate(segs))
+        merged.sort(key=lambda entry: entry[:3])
+        last_span = None
+        for span, _, _, seg in merged:
+            if span != last_span:
+                yield seg
+                last_span = span
+
+def intersection(first, *others):
+    '''Generate segments of `first` whose span occurs in every other iterable.
+    All iterables must be sorted by document names.'''
+    return _index_join(first, others,
+                       lambda seg, idx: all(index.has_span(seg.start, seg.end) for index in idx))
+
+def difference(first, *others):
+    '''Generate segments of `first` whose span occurs in none of the other iterables.
+    All iterables must be sorted by document names.'''
+    return _index_join(first, others,
+                       lambda seg, idx: not any(index.has_span(seg.start, seg.end) for index in idx),
+                       required_others=False)
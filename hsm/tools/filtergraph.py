@@ -0,0 +1,227 @@
+'''
+Dependency graph of filters.
+
+Filters are connected by the segment layers they read and write: a filter
+depends on the filters producing its basic, container and mixin layers.
+The graph applies the filters in topological order, running the filters of
+each level in parallel threads, and can restrict the run to the filters
+downstream of changed ones.
+
+Optionally, chains of filters are fused: when a layer is read by a single
+filter only, and only as its basic segment layer, the producing filter's
+output is streamed directly into the consuming filter. The intermediate layer
+is then not stored, so when only some filters are applied later, the producers
+of such missing layers are applied again along with their consumers.
+
+Filters with the `virtual` setting are not applied at all. Their outputs are
+computed on demand by a VirtualSegmentStorage, through which the other filters
+read their input layers.
+'''
+from multiprocessing.pool import ThreadPool
+
+from hsm.data.segmentwriter import SegmentWriter
+from hsm.tools.filter import FILTER_NAME, OUTPUT_NAME, SEGMENT_NAME, CONTAINER_NAME, CREATES_SEGMENT, VIRTUAL
+from hsm.tools.virtualsegmentstorage import VirtualSegmentStorage
+
+
+class FilterGraph(object):
+    '''Graph of filters connected by the segment layers they read and write.'''
+
+    def __init__(self, filters):
+        '''Construct the graph of given filters.
+        Raises ValueError, if two filters have the same name or output, or the filters form a cycle.'''
+        self._filters = dict()
+        self._producers = dict()
+        for filt in filters:
+            name = filt[FILTER_NAME]
+            if name in self._filters:
+                raise ValueError(u'Duplicate filter name ' + name)
+            output_name = filt[OUTPUT_NAME]
+            if output_name in self._producers:
+                raise ValueError(u'Layer ' + output_name + u' is written by filters ' +
+                                 self._producers[output_name] + u' and ' + name)
+            self._filters[name] = filt
+            self._producers[output_name] = name
+        self._dependencies = dict()
+        self._dependents = dict((name, set()) for name in self._filters)
+        self._consumers = dict()
+        for name, filt in self._filters.iteritems():
+            layers = filt.input_names()
+            for layer in layers:
+                self._consumers.setdefault(layer, set()).add(name)
+            self._dependencies[name] = set(self._producers[layer] for layer in layers if layer in self._producers)
+            for dependency in self._dependencies[name]:
+                self._dependents[dependency].add(name)
+        # check for cycles
+        self.levels()
+
+    def __len__(self):
+        return len(self._filters)
+
+    def __getitem__(self, name):
+        return self._filters[name]
+
+    def dependencies(self, name):
+        '''Get the names of filters producing the input layers of given filter.'''
+        return set(self._dependencies[name])
+
+    def dependents(self, name):
+        '''Get the names of filters reading the output layer of given filter.'''
+        return set(self._dependents[name])
+
+    def downstream(self, names):
+        '''Get the names of given filters and all filters depending on them, directly or indirectly.'''
+        result = set()
+        stack = list(names)
+        while len(stack) > 0:
+            name = stack.pop()
+            if name not in self._filters:
+                raise KeyError(u'Unknown filter ' + name)
+            if name not in result:
+                result.add(name)
+                stack.extend(self._dependents[name])
+        return result
+
+    def levels(self, names=None):
+        '''Sort the filters topologically into levels, so that the filters of a level
+        depend only on the filters of previous levels.
+        Keyword arguments:
+        names - if given, only these filters are sorted, dependencies outside them are ignored.'''
+        return [[group[0] for group in level] for level in self._levels(names, lambda name: (name,))]
+
+    def _levels(self, names, group_of):
+        '''Sort groups of filters topologically. `group_of` maps a filter name to the
+        tuple of filter names scheduled together with it.'''
+        if names is None:
+            names = set(self._filters)
+        names = set(names)
+        groups = set(tuple(group_of(name)) for name in names)
+        member_group = dict((name, group) for group in groups for name in group)
+        dependencies = dict()
+        for group in groups:
+            dependencies[group] = set(member_group[dependency]
+                                      for name in group
+                                      for dependency in self._dependencies[name]
+                                      if dependency in member_group and member_group[dependency] != group)
+        levels = []
+        done = set()
+        while len(done) < len(groups):
+            level = [group for group in groups if group not in done and dependencies[group] <= done]
+            if len(level) == 0:
+                cycle = sorted(name for group in groups if group not in done for name in group)
+                raise ValueError(u'Filters form a cycle: ' + u', '.join(cycle))
+            levels.append(sorted(level))
+            done.update(level)
+        return levels
+
+    def is_fusable(self, name):
+        '''Can the output of given filter be streamed into its only consumer without storing it.
+        This requires that the output layer is read by a single filter as its basic segments,
+        which must not be created from documents or filtered by containers.'''
+        consumers = self._dependents[name]
+        output_name = self._filters[name][OUTPUT_NAME]
+        if len(consumers) != 1 or len(self._consumers.get(output_name, ())) != 1 or name in consumers:
+            return False
+        consumer = self._filters[iter(consumers).next()]
+        return (consumer.get(SEGMENT_NAME) == output_name and
+                not consumer.get(CREATES_SEGMENT, False) and
+                CONTAINER_NAME not in consumer and
+                consumer.input_names().count(output_name) == 1)
+
+    def chains(self, names=None):
+        '''Get the fused chains of filters as lists of filter names in their application order.
+        Keyword arguments:
+        names - if given, only these filters are chained.'''
+        if names is None:
+            names = set(self._filters)
+        names = set(names)
+        following = dict()
+        for name in names:
+            if self.is_fusable(name):
+                consumer = iter(self._dependents[name]).next()
+                if consumer in names:
+                    following[name] = consumer
+        heads = names - set(following.values())
+        chains = []
+        for name in sorted(heads):
+            chain = [name]
+            while chain[-1] in following:
+                chain.append(following[chain[-1]])
+            chains.append(chain)
+        return chains
+
+    def unmaterialized(self, names, segstorage):
+        '''Get the names of filters outside given ones that produce the missing input layers of given filters.
+        An input layer is missing, if it was fused away in an earlier application and is therefore empty in
+        `segstorage`. The producers of the inputs of these filters are checked in turn.'''
+        names = set(names)
+        result = set()
+        stack = list(names)
+        while len(stack) > 0:
+            name = stack.pop()
+            for dependency in self._dependencies[name]:
+                filt = self._filters[dependency]
+                if (dependency in names or dependency in result or filt.get(VIRTUAL, False) or
+                        not self.is_fusable(dependency) or segstorage.count(filt[OUTPUT_NAME]) > 0):
+                    continue
+                result.add(dependency)
+                stack.append(dependency)
+        return result
+
+    def apply(self, segstorage, docstorage, changed=None, threads=None, fuse=False,
+              batch_size=100, queue_size=10, downstream=True):
+        '''Apply the filters in topological order, running each level in parallel.
+        Keyword arguments:
+        changed - if given, apply only these filters and the filters downstream of them,
+                  along with the producers of their input layers that were fused away.
+        threads - the number of threads for applying the filters of a level, by default one per filter.
+        fuse - if True, stream the outputs of fusable filters directly into their consumers.
+        batch_size - the number of segments saved at once.
+        queue_size - the maximum number of batches waiting to be saved by each filter.
+        downstream - if False, the filters depending on the `changed` filters are not applied.
+        Returns the list of levels of applied filter chains, which exclude the virtual filters.'''
+        if changed is None:
+            names = set(self._filters)
+        else:
+            names = self.downstream(changed) if downstream else set(changed)
+            names |= self.unmaterialized(names, segstorage)
+        virtual = set(name for name in names if self._filters[name].get(VIRTUAL, False))
+        # virtual layers are computed on demand, so remove their previously materialized segments
+        for name in virtual:
+            segstorage.delete(name=self._filters[name][OUTPUT_NAME])
+        names -= virtual
+        if any(filt.get(VIRTUAL, False) for filt in self._filters.itervalues()):
+            segstorage = VirtualSegmentStorage(segstorage, docstorage, self._filters.values())
+        if fuse:
+            chains = self.chains(names)
+        else:
+            chains = [[name] for name in names]
+        group_of = dict((name, tuple(chain)) for chain in chains for name in chain).get
+        levels = [[list(group) for group in level] for level in self._levels(names, group_of)]
+        for level in levels:
+            if len(level) == 1 or threads == 1:
+                for chain in level:
+                    self._apply_chain(chain, segstorage, docstorage, batch_size, queue_size)
+            else:
+                pool = ThreadPool(threads or len(level))
+                try:
+                    pool.map(lambda chain: self._apply_chain(chain, segstorage, docstorage, batch_size, queue_size),
+                             level)
+                finally:
+                    pool.close()
+                    pool.join()
+        return levels
+
+    def _apply_chain(self, chain, segstorage, docstorage, batch_size, queue_size):
+        filters = [self._filters[name] for name in chain]
+        if len(filters) == 1:
+            filters[0].apply(segstorage, docstorage, batch_size, queue_size)
+            return
+        # the intermediate layers are not stored, so remove their stale segments as well
+        for filt in filters:
+            segstorage.delete(name=filt[OUTPUT_NAME])
+        stream = None
+        for filt in filters:
+            stream = filt.filter(segstorage, docstorage, source=stream)
+        with SegmentWriter(segstorage, batch_size, queue_size) as writer:
+            writer.write_all(stream)
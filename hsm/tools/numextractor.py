@@ -13,8 +13,20 @@ except ImportError:
     except ImportError:
         import re
 
+import argparse
+from collections import deque
+from itertools import islice, izip, tee
+import json
+import logging
+import multiprocessing
+import sre_constants
+import sre_parse
 import sys
+import threading
+import time
 import codecs
+
+logger = logging.getLogger('numextractor')
 # Generic functions for working with custom matchobjects
 
 def dict_from_matchobject(matchobject):
@@ -77,33 +89,700 @@ def in_range(d, fields, low_dict, high_dict):
     return True
 
 def remove_submatches(ds):
-    '''Remove matches that are submatches by some other match.'''
-    n = len(ds)
-    ok = [True]*n
-    for i in range(n):
-        A = ds[i]
-        for j in range(i+1, n):
-            B = ds[j]
-            if A['start'] == B['start'] and A['end'] == B['end']:
-                if len(A) > len(B):
-                    ok[j] = False
-                    continue
-                elif len(A) < len(B):
-                    ok[i] = False
-                    continue
-            if A['start'] >= B['start'] and A['end'] <= B['end']:
-                ok[i] = False
-            elif A['start'] <= B['start'] and A['end'] >= B['end']:
-                ok[j] = False
-    return [ds[i] for i in range(n) if ok[i]]
+    '''Remove matches that are submatches by some other match.
+    Of the matches with equal spans, the one with most fields is kept,
+    the last one if there are several. The order of the matches is preserved.'''
+    keep = _maximal_matches([(d['start'], d['end'], len(d)) for d in ds])
+    return [d for idx, d in enumerate(ds) if idx in keep]
+
+def _maximal_matches(keys):
+    '''Get the set of indices of (start, end, size) keys, which are not submatches.'''
+    best = dict()
+    for idx, (start, end, size) in enumerate(keys):
+        span = (start, end)
+        if span not in best or size >= keys[best[span]][2]:
+            best[span] = idx
+    # spans sorted by start and longest first are contained by some previous span,
+    # if a previous span ends at or after their end
+    keep = set()
+    max_end = None
+    for span in sorted(best, key=lambda span: (span[0], -span[1])):
+        if max_end is None or span[1] > max_end:
+            keep.add(best[span])
+            max_end = span[1]
+    return keep
 
 def get_matches(document, patterns):
     '''Match all specified patterns on given documents.'''
     f = dict_from_matchobject
     return [f(m) for p in patterns for m in p.finditer(document)]
 
+################################################################################
+# match records
+################################################################################
+
+class Field(object):
+    '''Field of a match record. Computed fields have no original text and span.'''
+
+    __slots__ = ('value', 'original', 'start', 'end')
+
+    def __init__(self, value, original=None, start=None, end=None):
+        self.value = value
+        self.original = original
+        self.start = start
+        self.end = end
+
+    def as_dict(self):
+        if self.start is None:
+            return {'value': self.value}
+        return {'value': self.value, 'original': self.original, 'start': self.start, 'end': self.end}
+
+
+class Match(object):
+    '''Compact record of a pattern match, which is converted to the
+    custom match dictionary only when returned from the extractors.'''
+
+    __slots__ = ('start', 'end', 'original', 'fields', 'pattern')
+
+    def __init__(self, start, end, original, fields, pattern=None):
+        self.start = start
+        self.end = end
+        self.original = original
+        self.fields = fields
+        # index of the pattern in its pattern set, set only when profiling
+        self.pattern = pattern
+
+    @staticmethod
+    def from_matchobject(matchobject, group=0, names=None):
+        '''Create a record of the matchobject or its `group`. The fields are
+        read from the groups named in the (field, group name) pairs of `names`,
+        by default from all named groups of the matchobject.'''
+        if names is None:
+            names = [(name, name) for name in matchobject.re.groupindex]
+        fields = dict()
+        for field, name in names:
+            value = matchobject.group(name)
+            start, end = matchobject.span(name)
+            fields[field] = Field(value, value, start, end)
+        start, end = matchobject.span(group)
+        return Match(start, end, matchobject.group(group), fields)
+
+    def __len__(self):
+        '''The number of keys in the dictionary of the match.'''
+        return len(self.fields) + 3
+
+    def as_dict(self):
+        '''Convert to the same dictionary as `dict_from_matchobject`.'''
+        d = dict((name, field.as_dict()) for name, field in self.fields.iteritems())
+        d['start'] = self.start
+        d['end'] = self.end
+        d['original'] = self.original
+        return d
+
+# batch versions of the dictionary functions for match records,
+# which process all matches one field at a time
+
+_SPACE = re.compile(r'\s', re.UNICODE)
+_DECIMAL = re.compile(r'[.,]+', re.UNICODE)
+
+def cast_batch(ms, fields, cast=int):
+    '''Cast values of given fields in match records to specified function.'''
+    for field in fields:
+        for m in ms:
+            f = m.fields.get(field)
+            if f is None:
+                continue
+            value = f.value
+            if cast == float:
+                value = _DECIMAL.sub('.', _SPACE.sub('', str(value).strip()))
+            try:
+                f.value = cast(value)
+            except ValueError:
+                sys.stderr.write(str(m.as_dict()))
+                raise
+
+def avg_estimates_batch(ms, fields, low_fields, high_fields):
+    '''Compute average estimates for given fields of match records.'''
+    assert (len(fields) == len(low_fields))
+    assert (len(low_fields) == len(high_fields))
+    for field, low_field, high_field in zip(fields, low_fields, high_fields):
+        for m in ms:
+            low, high = m.fields.get(low_field), m.fields.get(high_field)
+            if low is not None and high is not None:
+                m.fields[field] = Field((low.value + high.value) / 2)
+
+def correct_low_high_batch(ms, low_fields, high_fields):
+    assert (len(low_fields) == len(high_fields))
+    for low_field, high_field in zip(low_fields, high_fields):
+        for m in ms:
+            low, high = m.fields.get(low_field), m.fields.get(high_field)
+            if low is not None and high is not None and low.value > high.value:
+                m.fields[low_field], m.fields[high_field] = high, low
+
+def in_range_batch(ms, fields, low_dict, high_dict):
+    '''Get the match records with all given fields in specified ranges.'''
+    for field in fields:
+        low, high = low_dict[field], high_dict[field]
+        ms = [m for m in ms if field not in m.fields or low <= m.fields[field].value <= high]
+    return ms
+
+def remove_submatches_batch(ms):
+    '''Remove match records that are submatches by some other match, as `remove_submatches`.'''
+    keep = _maximal_matches([(m.start, m.end, len(m)) for m in ms])
+    return [m for idx, m in enumerate(ms) if idx in keep]
+
+
+class Extractor(object):
+    '''Base class of extractors returning match records from `extract_records`.
+    The patterns of an extractor class are compiled by `compile_patterns` when
+    first used in the process and shared by all its instances, see `extractor_patterns`.'''
+
+    # keywords of the prefilter, see `Prefilter`
+    keywords = None
+
+    def __init__(self, **kwargs):
+        '''Initialize the extractor.
+        Keyword arguments:
+        engine - the name of the pattern set engine, see `PATTERN_ENGINES`.
+        prefilter - if True, match the patterns only around digits, see `Prefilter`.'''
+        self.engine = kwargs.get('engine', DEFAULT_ENGINE)
+        self.prefilter = kwargs.get('prefilter', False)
+        assert self.engine in PATTERN_ENGINES
+
+    @staticmethod
+    def compile_patterns():
+        '''Compile the list of patterns of the extractor.'''
+        raise NotImplementedError()
+
+    @property
+    def patterns(self):
+        return extractor_patterns(type(self))
+
+    @property
+    def pattern_set(self):
+        return extractor_pattern_set(type(self), self.engine, self.prefilter)
+
+    def extract(self, document, guard=None):
+        '''Given a document, return a list of dictionaries containing
+        details about each match.
+        guard - optional `MatchGuard` enforcing the time budgets of matching.'''
+        ms = self.extract_records(document, guard)
+        if guard is not None:
+            guard.survived(ms)
+        return [m.as_dict() for m in ms]
+
+    def extract_records(self, document, guard=None):
+        raise NotImplementedError()
+
+################################################################################
+# time budgets and profiling
+################################################################################
+
+class BudgetExceeded(Exception):
+    '''Raised when matching a document exceeds its time budget.'''
+    pass
+
+
+class MatchGuard(object):
+    '''Time budgets of matching the patterns on a single document.
+
+    The pattern sets iterate the matches of each pattern through `finditer` of the guard,
+    which checks the elapsed time between the matches. A pattern exceeding `pattern_budget`
+    seconds is stopped and its remaining matches are dropped, exceeding `budget` seconds
+    for the whole document raises `BudgetExceeded`. A single search of the regular
+    expression engine cannot be interrupted, so the budgets are enforced only after it returns.
+    If `profile` is given, the times and match counts of the patterns are added to it.'''
+
+    def __init__(self, budget=None, pattern_budget=None, profile=None):
+        self.budget = budget
+        self.pattern_budget = pattern_budget
+        self.profile = profile
+        # label of the extractor the patterns belong to, set by the caller
+        self.extractor = None
+        # (extractor, key) -> seconds spent matching the pattern
+        self.times = dict()
+        # (extractor, key) of the patterns stopped by `pattern_budget`
+        self.stopped = []
+        self._deadline = None if budget is None else time.time() + budget
+
+    def finditer(self, key, pattern, document, pos, endpos):
+        '''Generate the matches of `pattern`, where `key` identifies the pattern in the pattern set.
+        A stopped pattern is not matched again, for example in the later windows of a prefilter.'''
+        label = (self.extractor, key)
+        if label in self.stopped:
+            return
+        start = time.time()
+        matches = pattern.finditer(document, pos, endpos)
+        while True:
+            m = next(matches, None)
+            now = time.time()
+            elapsed = self.times.get(label, 0.0) + now - start
+            self.times[label] = elapsed
+            if self.profile is not None:
+                self.profile.times[label] = self.profile.times.get(label, 0.0) + now - start
+            if self._deadline is not None and now > self._deadline:
+                raise BudgetExceeded('Time budget of {0} s exceeded by pattern {1} of {2}'.format(self.budget, key, self.extractor))
+            if m is None:
+                return
+            if self.pattern_budget is not None and elapsed > self.pattern_budget:
+                self.stopped.append(label)
+                return
+            yield m
+            start = time.time()
+
+    def matched(self, results):
+        '''Called by the pattern sets with the list of match records of each pattern.'''
+        if self.profile is None:
+            return
+        for idx, ms in enumerate(results):
+            for m in ms:
+                m.pattern = idx
+            label = (self.extractor, idx)
+            self.profile.raw[label] = self.profile.raw.get(label, 0) + len(ms)
+
+    def survived(self, ms):
+        '''Called by the extractors with the match records they return.'''
+        if self.profile is None:
+            return
+        for m in ms:
+            label = (self.extractor, m.pattern)
+            self.profile.surviving[label] = self.profile.surviving.get(label, 0) + 1
+
+    def slowest(self):
+        '''Get the (extractor, key) of the pattern that took the most time, or None.'''
+        if len(self.times) == 0:
+            return None
+        return max(self.times, key=self.times.get)
+
+
+class PatternProfile(object):
+    '''Time, raw match count and surviving match count of the patterns of the extractors.
+
+    The patterns are keyed by (extractor, key), where the key is the index of the pattern
+    in the pattern set of the extractor. The combined engine is timed by scanner, keyed by
+    the tuple of the indices of its patterns, so timing each pattern needs the sequential engine.
+    The surviving matches are the matches left after the extractor has filtered them and
+    removed the submatches.'''
+
+    def __init__(self):
+        self.times = dict()
+        self.raw = dict()
+        self.surviving = dict()
+
+    def update(self, other):
+        '''Add the times and counts of another profile.'''
+        for mine, theirs in [(self.times, other.times), (self.raw, other.raw), (self.surviving, other.surviving)]:
+            for label, amount in theirs.iteritems():
+                mine[label] = mine.get(label, 0) + amount
+
+    def rows(self):
+        '''Get the (extractor, key, seconds, raw matches, surviving matches) of the
+        patterns in the order of decreasing time and raw match count.'''
+        labels = set(self.times) | set(self.raw)
+        rows = [label + (self.times.get(label, 0.0), self.raw.get(label, 0), self.surviving.get(label, 0)) for label in labels]
+        return sorted(rows, key=lambda row: (-row[2], -row[3], row[0], row[1]))
+
+    def summary(self):
+        '''Get the profile as lines of text.'''
+        lines = [u'{0:<22} {1:>12} {2:>10} {3:>8} {4:>10}'.format('extractor', 'pattern', 'time (ms)', 'matches', 'surviving')]
+        for extractor, key, seconds, raw, surviving in self.rows():
+            lines.append(u'{0:<22} {1:>12} {2:>10.3f} {3:>8} {4:>10}'.format(extractor, _pattern_name(key), seconds * 1000, raw, surviving))
+        return lines
+
+
+def _pattern_name(key):
+    if isinstance(key, tuple):
+        return u'{0}-{1}'.format(key[0], key[-1])
+    return unicode(key)
+
+
+def _finditer(guard, key, pattern, document, pos, endpos):
+    if guard is None:
+        return pattern.finditer(document, pos, endpos)
+    return guard.finditer(key, pattern, document, pos, endpos)
+
+
+class ExtractionReport(object):
+    '''Slow documents and patterns seen by `NumExtractor`.
+    slow_documents - list of (index, length, seconds, action, slowest pattern, text prefix) tuples,
+                     where action is one of `extracted`, `truncated` or `skipped` and the index
+                     counts the documents given to the extractor.
+    slow_patterns - dictionary mapping (extractor, key) of the patterns stopped
+                    by the pattern budget to [count, seconds].
+    profile - the `PatternProfile` of the documents, if profiling.'''
+
+    PREFIX_LENGTH = 50
+
+    def __init__(self, profile=None):
+        self.documents = 0
+        self.slow_documents = []
+        self.slow_patterns = dict()
+        self.profile = profile
+
+    def add_document(self, length, seconds, action, guard=None, text=u''):
+        slowest = None if guard is None else guard.slowest()
+        self.slow_documents.append((self.documents, length, seconds, action, slowest, text[:ExtractionReport.PREFIX_LENGTH]))
+
+    def add_patterns(self, guard):
+        for label in set(guard.stopped):
+            counts = self.slow_patterns.setdefault(label, [0, 0.0])
+            counts[0] += 1
+            counts[1] += guard.times[label]
+
+    def update(self, other):
+        '''Add the report of the documents following the documents of this report.'''
+        for entry in other.slow_documents:
+            self.slow_documents.append((self.documents + entry[0],) + entry[1:])
+        for label, (count, seconds) in other.slow_patterns.iteritems():
+            counts = self.slow_patterns.setdefault(label, [0, 0.0])
+            counts[0] += count
+            counts[1] += seconds
+        if self.profile is not None and other.profile is not None:
+            self.profile.update(other.profile)
+        self.documents += other.documents
+
+    def summary(self):
+        '''Get the report as lines of text.'''
+        lines = [u'documents: {0}, slow documents: {1}, stopped patterns: {2}'.format(self.documents,
+                                                                                      len(self.slow_documents),
+                                                                                      len(self.slow_patterns))]
+        for idx, length, seconds, action, slowest, text in self.slow_documents:
+            lines.append(u'document {0} ({1} characters) {2} in {3:.3f} s, slowest pattern {4}: {5}'.format(idx, length, action,
+                                                                                                           seconds, slowest, text))
+        for (extractor, key), (count, seconds) in sorted(self.slow_patterns.iteritems()):
+            lines.append(u'pattern {0} of {1} stopped in {2} documents, {3:.3f} s'.format(key, extractor, count, seconds))
+        if self.profile is not None:
+            lines.extend(self.profile.summary())
+        return lines
+
+################################################################################
+# pattern set engines
+################################################################################
 
-class BloodPressure(object):
+class PatternSet(object):
+    '''Set of patterns matched on documents one pattern at a time.'''
+
+    def __init__(self, patterns):
+        self.patterns = list(patterns)
+
+    def matches(self, document, guard=None):
+        '''Match all patterns on the document. Returns the records of
+        the same matches as `get_matches`.
+        guard - optional `MatchGuard` enforcing the time budgets of matching.'''
+        results = self.pattern_matches(document, guard=guard)
+        if guard is not None:
+            guard.matched(results)
+        return [d for ds in results for d in ds]
+
+    def pattern_matches(self, document, pos=0, endpos=None, guard=None):
+        '''Match all patterns on the document between `pos` and `endpos`.
+        Returns a list of match records for each pattern.'''
+        endpos = len(document) if endpos is None else endpos
+        return [[Match.from_matchobject(m) for m in _finditer(guard, idx, p, document, pos, endpos)]
+                for idx, p in enumerate(self.patterns)]
+
+
+class CombinedPatternSet(PatternSet):
+    '''Set of patterns matched on documents with a few combined scanners.
+
+    Each pattern is wrapped in an optional lookahead group, so that a single pass
+    of a combined scanner finds the match of every pattern starting at each position.
+    Named groups are renamed per pattern and mapped back, unnamed groups are made
+    non-capturing to stay within the group limit of the regular expression engine.
+    Patterns are split into several scanners, if they do not fit into one.
+    Chunks of only a few patterns are matched separately, as combining does not pay off.
+    The scanners are guarded by a digit lookahead, if every pattern requires a digit
+    within a bounded distance from the start of the match.
+    The matches are identical to running `finditer` of each pattern separately.'''
+
+    MAX_GROUPS = 99
+    MIN_PATTERNS = 8
+
+    def __init__(self, patterns):
+        PatternSet.__init__(self, patterns)
+        self._scanners = []
+        self._separate = []
+        chunk, chunk_groups = [], 0
+        for idx, pattern in enumerate(self.patterns):
+            source = _combinable_source(pattern, idx)
+            if source is None:
+                self._separate.append(idx)
+                continue
+            groups = len(pattern.groupindex) + 1
+            if len(chunk) > 0 and (chunk_groups + groups > CombinedPatternSet.MAX_GROUPS or chunk[0][0].flags != pattern.flags):
+                self._add_scanner(chunk)
+                chunk, chunk_groups = [], 0
+            chunk.append((pattern, idx, source))
+            chunk_groups += groups
+        if len(chunk) > 0:
+            self._add_scanner(chunk)
+
+    def _add_scanner(self, chunk):
+        if len(chunk) < CombinedPatternSet.MIN_PATTERNS:
+            self._separate.extend(idx for _, idx, _ in chunk)
+            return
+        reaches = [_digit_reach(pattern.pattern, pattern.flags) for pattern, _, _ in chunk]
+        guard = u''
+        if None not in reaches:
+            guard = u'(?=[\\s\\S]{{0,{0}}}?\\d)'.format(max(reaches))
+        lookaheads = u''.join(u'(?=(?P<p{0}>{1})?)'.format(idx, source) for _, idx, source in chunk)
+        # fail unless at least one of the patterns matched
+        conditions = u''.join(u'(?(p{0})|'.format(idx) for _, idx, _ in chunk) + u'(?!)' + u')' * len(chunk)
+        scanner = re.compile(guard + lookaheads + conditions, chunk[0][0].flags)
+        fields = [(idx, [(field, u'p{0}_{1}'.format(idx, field)) for field in pattern.groupindex]) for pattern, idx, _ in chunk]
+        self._scanners.append((scanner, fields))
+
+    def pattern_matches(self, document, pos=0, endpos=None, guard=None):
+        '''Same as `PatternSet.pattern_matches`. The budgets of the guard apply
+        to each scanner as a whole, keyed by the tuple of its pattern indices.'''
+        endpos = len(document) if endpos is None else endpos
+        results = dict()
+        for idx in self._separate:
+            results[idx] = [Match.from_matchobject(m) for m in _finditer(guard, idx, self.patterns[idx], document, pos, endpos)]
+        for scanner, fields in self._scanners:
+            for idx, _ in fields:
+                results[idx] = []
+            # end of the last match of each pattern, which the next match may not overlap
+            last_end = dict((idx, pos) for idx, _ in fields)
+            key = tuple(idx for idx, _ in fields)
+            for m in _finditer(guard, key, scanner, document, pos, endpos):
+                position = m.start()
+                for idx, names in fields:
+                    group = u'p{0}'.format(idx)
+                    start = m.start(group)
+                    if start < 0 or position < last_end[idx]:
+                        continue
+                    end = m.end(group)
+                    results[idx].append(Match.from_matchobject(m, group, names))
+                    last_end[idx] = end if end > start else end + 1
+        return [results[idx] for idx in xrange(len(self.patterns))]
+
+
+class Prefilter(object):
+    '''Pattern set wrapper matching the patterns only in windows around digit clusters.
+
+    All patterns of the extractors require digits, so documents without digits
+    are skipped without running any pattern. Windows extend `margin` characters
+    around each digit cluster to the token boundaries and are merged when they
+    overlap. If `keywords` are given, only windows containing a keyword are matched.
+    The patterns are matched on the whole document restricted to each window,
+    so the offsets refer to the document and lookbehinds, word boundaries and
+    `^` see the text before the window. Matches that would extend beyond the end
+    of a window, or start more than `margin` characters before the first digit,
+    can differ from matching the whole document.'''
+
+    DIGITS = re.compile(u'[0-9]+', re.UNICODE)
+    SPACE = re.compile(u'\\s', re.UNICODE)
+
+    def __init__(self, patternset, keywords=None, margin=50):
+        assert margin >= 0
+        self.patternset = patternset
+        self.patterns = patternset.patterns
+        self.margin = margin
+        self._keywords = None
+        if keywords is not None:
+            # longer keywords first, as the alternatives are tried in order
+            keywords = sorted(keywords, key=len, reverse=True)
+            self._keywords = re.compile(u'|'.join(re.escape(keyword) for keyword in keywords), re.UNICODE)
+
+    def windows(self, document):
+        '''Get the list of (start, end) windows of the document that may contain matches.'''
+        windows = []
+        for m in Prefilter.DIGITS.finditer(document):
+            start = self._token_start(document, max(0, m.start() - self.margin))
+            end = self._token_end(document, min(len(document), m.end() + self.margin))
+            if len(windows) > 0 and start <= windows[-1][1]:
+                windows[-1] = (windows[-1][0], max(end, windows[-1][1]))
+            else:
+                windows.append((start, end))
+        if self._keywords is not None:
+            windows = [(start, end) for start, end in windows
+                       if self._keywords.search(document, start, end) is not None]
+        return windows
+
+    def matches(self, document, guard=None):
+        results = self.pattern_matches(document, guard=guard)
+        if guard is not None:
+            guard.matched(results)
+        return [d for ds in results for d in ds]
+
+    def pattern_matches(self, document, pos=0, endpos=None, guard=None):
+        endpos = len(document) if endpos is None else endpos
+        results = [[] for _ in self.patterns]
+        for start, end in self.windows(document):
+            start, end = max(start, pos), min(end, endpos)
+            if start >= end:
+                continue
+            for ds, window_ds in zip(results, self.patternset.pattern_matches(document, start, end, guard)):
+                ds.extend(window_ds)
+        return results
+
+    def _token_start(self, document, pos):
+        while pos > 0 and Prefilter.SPACE.match(document, pos - 1) is None:
+            pos -= 1
+        return pos
+
+    def _token_end(self, document, pos):
+        m = Prefilter.SPACE.search(document, pos)
+        return len(document) if m is None else m.start()
+
+
+PATTERN_ENGINES = {'sequential': PatternSet,
+                   'combined': CombinedPatternSet}
+DEFAULT_ENGINE = 'combined'
+
+def pattern_set(patterns, engine=DEFAULT_ENGINE, prefilter=False, keywords=None):
+    '''Create a pattern set using the engine with given name.
+    If `prefilter` is True, the patterns are matched only in the windows of documents
+    that contain digits and given `keywords`, see `Prefilter`.'''
+    patternset = PATTERN_ENGINES[engine](patterns)
+    if prefilter:
+        return Prefilter(patternset, keywords)
+    return patternset
+
+def _combinable_source(pattern, idx):
+    '''Rewrite the pattern source for a combined scanner: prefix the named groups
+    with the pattern index and make the unnamed groups non-capturing.
+    Returns None, if the pattern uses group references and cannot be rewritten.'''
+    source = pattern.pattern
+    if u'(?P=' in source or u'(?(' in source or re.search(r'\\[1-9]', source):
+        return None
+    out = []
+    pos = 0
+    in_class = False
+    while pos < len(source):
+        c = source[pos]
+        if c == u'\\':
+            out.append(source[pos:pos+2])
+            pos += 2
+            continue
+        if in_class:
+            if c == u']':
+                in_class = False
+            out.append(c)
+            pos += 1
+        elif c == u'[':
+            # a ] right after the opening [ or [^ is a literal
+            end = pos + 1
+            if source[end:end+1] == u'^':
+                end += 1
+            if source[end:end+1] == u']':
+                end += 1
+            out.append(source[pos:end])
+            in_class = True
+            pos = end
+        elif source.startswith(u'(?P<', pos):
+            out.append(u'(?P<p{0}_'.format(idx))
+            pos += 4
+        elif c == u'(' and not source.startswith(u'(?', pos):
+            out.append(u'(?:')
+            pos += 1
+        else:
+            out.append(c)
+            pos += 1
+    return u''.join(out)
+
+def _digit_reach(source, flags=0):
+    '''Get the maximum number of characters a match of the pattern can have before
+    its first digit, or None if the pattern does not require a digit within a bounded distance.'''
+    try:
+        return _sequence_reach(sre_parse.parse(source, flags))
+    except Exception:
+        return None
+
+def _sequence_reach(items):
+    total = 0
+    for item in items:
+        reach = _item_reach(*item)
+        if reach is not None:
+            return total + reach
+        width = sre_parse.SubPattern(None, [item]).getwidth()[1]
+        if width >= sre_constants.MAXREPEAT:
+            return None
+        total += width
+    return None
+
+def _item_reach(op, av):
+    '''Get the maximum distance of the first digit an item always matches, or None.'''
+    if op == sre_constants.SUBPATTERN:
+        return _sequence_reach(av[1])
+    if op == sre_constants.BRANCH:
+        reaches = [_sequence_reach(branch) for branch in av[1]]
+        if None in reaches:
+            return None
+        return max(reaches)
+    if op in (sre_constants.MAX_REPEAT, sre_constants.MIN_REPEAT) and av[0] >= 1:
+        return _sequence_reach(av[2])
+    if _is_digit(op, av):
+        return 0
+    return None
+
+def _is_digit(op, av):
+    '''Does the single character item match only digits.'''
+    if op == sre_constants.LITERAL:
+        return ord(u'0') <= av <= ord(u'9')
+    if op == sre_constants.IN:
+        for kind, value in av:
+            if kind == sre_constants.LITERAL and ord(u'0') <= value <= ord(u'9'):
+                continue
+            if kind == sre_constants.RANGE and ord(u'0') <= value[0] <= value[1] <= ord(u'9'):
+                continue
+            if kind == sre_constants.CATEGORY and value == sre_constants.CATEGORY_DIGIT:
+                continue
+            return False
+        return len(av) > 0
+    return False
+
+
+################################################################################
+# pattern registry
+################################################################################
+
+# compiled patterns and pattern sets of the extractor classes, shared in the process
+_patterns = dict()
+_pattern_sets = dict()
+_registry_lock = threading.Lock()
+
+def extractor_patterns(cls):
+    '''Get the compiled patterns of an extractor class.
+    The patterns are compiled when first requested in the process.'''
+    patterns = _patterns.get(cls)
+    if patterns is None:
+        with _registry_lock:
+            if cls not in _patterns:
+                _patterns[cls] = cls.compile_patterns()
+            patterns = _patterns[cls]
+    return patterns
+
+def extractor_pattern_set(cls, engine=DEFAULT_ENGINE, prefilter=False):
+    '''Get the pattern set of an extractor class for given engine,
+    created when first requested in the process.'''
+    key = (cls, engine, prefilter)
+    patternset = _pattern_sets.get(key)
+    if patternset is None:
+        patterns = extractor_patterns(cls)
+        with _registry_lock:
+            if key not in _pattern_sets:
+                _pattern_sets[key] = pattern_set(patterns, engine, prefilter, cls.keywords)
+            patternset = _pattern_sets[key]
+    return patternset
+
+def clear_patterns():
+    '''Remove all compiled patterns and pattern sets from the registry.'''
+    with _registry_lock:
+        _patterns.clear()
+        _pattern_sets.clear()
+
+
+def maximal(run):
+    '''Make a whitespace run `\\s*` or `\\s+` match only the whole run of whitespace.
+    This is equivalent to the original run, if the rest of the pattern cannot continue
+    with whitespace, or continues with another whitespace run that takes the remainder,
+    but prevents trying all ways of splitting long runs between adjacent quantifiers.'''
+    return run + '(?!\\s)'
+
+
+class BloodPressure(Extractor):
     '''Class for extracting blood pressures from plain text.'''
 
     fields      = ['systolic', 'diastolic', 'pulse']
@@ -122,8 +801,9 @@ class BloodPressure(object):
                    'diastolic': 150,
                    'pulse': 200}
     
-    def __init__(self, **kwargs):
-        '''Initialize a new BloodPressure extractor.'''
+    @staticmethod
+    def compile_patterns():
+        '''Compile the patterns of the BloodPressure extractor.'''
         # define common regular expressions
         space = '\s*'
         dig = '[0-9]{2,3}'
@@ -178,45 +858,44 @@ class BloodPressure(object):
         pulses.append('(' + pulse_dist + pulse_prefix + pulse_range + pulse_suffix + ')')
         
         # create regular expressions for matching optional pulse
-        self.patterns = []
+        compiled = []
         for p in patterns:
             for pulse in pulses:
-                self.patterns.append(re.compile(pulse + p, re.UNICODE))
-                self.patterns.append(re.compile(p + pulse, re.UNICODE))
-            self.patterns.append(re.compile(p, re.UNICODE))
+                compiled.append(re.compile(pulse + p, re.UNICODE))
+                compiled.append(re.compile(p + pulse, re.UNICODE))
+            compiled.append(re.compile(p, re.UNICODE))
         # patterns for only pulse and pulse ranges
-        self.patterns.append(re.compile(pulse_prefix + pulse_single + pulse_suffix, re.UNICODE))
-        self.patterns.append(re.compile(pulse_prefix + pulse_range + pulse_suffix, re.UNICODE))
+        compiled.append(re.compile(pulse_prefix + pulse_single + pulse_suffix, re.UNICODE))
+        compiled.append(re.compile(pulse_prefix + pulse_range + pulse_suffix, re.UNICODE))
+        return compiled
 
-    def extract(self, document):
-        '''Given a document, return a list of dictionaries containing
-           details about each measurement.           
+    def extract_records(self, document, guard=None):
+        '''Given a document, return a list of match records containing
+           details about each measurement.
            '''
-        ms = get_matches(document, self.patterns)
-        ms = [cast_fields(m, BloodPressure.all_fields, int) for m in ms]
-        ms = [correct_low_high(m,
+        ms = self.pattern_set.matches(document, guard)
+        cast_batch(ms, BloodPressure.all_fields, int)
+        correct_low_high_batch(ms,
                                BloodPressure.low_fields,
                                BloodPressure.high_fields)
-                               for m in ms]
-        ms = [avg_estimates(m, 
-                            BloodPressure.fields, 
-                            BloodPressure.low_fields, 
-                            BloodPressure.high_fields) 
-                            for m in ms]
+        avg_estimates_batch(ms,
+                            BloodPressure.fields,
+                            BloodPressure.low_fields,
+                            BloodPressure.high_fields)
         # systolic value should be larger than diastolic, so check it
         def f(m):
-            if 'systolic' in m and 'diastolic' in m:
-                return m['systolic']['value'] > m['diastolic']['value']
+            if 'systolic' in m.fields and 'diastolic' in m.fields:
+                return m.fields['systolic'].value > m.fields['diastolic'].value
             return True
         ms = [m for m in ms if f(m)]
         
-        ms = [m for m in ms if in_range(m, BloodPressure.fields,
-                                           BloodPressure.low_values, 
-                                           BloodPressure.high_values)]
-        return remove_submatches(ms)
+        ms = in_range_batch(ms, BloodPressure.fields,
+                                BloodPressure.low_values,
+                                BloodPressure.high_values)
+        return remove_submatches_batch(ms)
 
 
-class Temperature(object):
+class Temperature(Extractor):
     '''Class for extracting temperatures from plain text documents.'''
 
     fields      = ['temperature']
@@ -231,7 +910,8 @@ class Temperature(object):
     low_values  = {'temperature': 15}
     high_values = {'temperature': 50}
     
-    def __init__(self, **kwargs):
+    @staticmethod
+    def compile_patterns():
         keywords  = '((^)|([^a-zA-Z]))((pal)|(t0)|(palavik(uga)?)|(t((emp)(eratuur)?)?))'
         digits    = '[1-9][0-9]([ ,.]*[0-9]{1,2})?(?![0-9])'
         guard     = '(?!\s*(mg)|(x)|(cm)|(mm)|(g)|(kg))'
@@ -239,42 +919,43 @@ class Temperature(object):
         temp_low  = '(?P<temperature_low>' + digits + ')'
         temp_high = '(?P<temperature_high>' + digits + ')'
         sep       = '[ .*-/](\D{0,35}?)'
-        self.patterns = [
+        return [
             re.compile(keywords + temp + guard, re.UNICODE),
             re.compile(keywords + sep + temp + guard, re.UNICODE),
             re.compile(keywords + temp_low + '\s*-\s*' + temp_high + guard, re.UNICODE),
             re.compile(keywords + sep + temp_low + '\s*-\s*' + temp_high + guard, re.UNICODE)
             ]
     
-    def extract(self, document):
-        ms = get_matches(document, self.patterns)
-        ms = [cast_fields(m, Temperature.all_fields, float) for m in ms]
-        ms = [correct_low_high(m,
+    def extract_records(self, document, guard=None):
+        ms = self.pattern_set.matches(document, guard)
+        cast_batch(ms, Temperature.all_fields, float)
+        correct_low_high_batch(ms,
                                Temperature.low_fields,
                                Temperature.high_fields)
-                               for m in ms]
-        ms = [avg_estimates(m, 
-                            Temperature.fields, 
-                            Temperature.low_fields, 
-                            Temperature.high_fields) 
-                            for m in ms]
-        ms = [m for m in ms if in_range(m, Temperature.fields,
-                                           Temperature.low_values, 
-                                           Temperature.high_values)]
-        return remove_submatches(ms)
+        avg_estimates_batch(ms,
+                            Temperature.fields,
+                            Temperature.low_fields,
+                            Temperature.high_fields)
+        ms = in_range_batch(ms, Temperature.fields,
+                                Temperature.low_values,
+                                Temperature.high_values)
+        return remove_submatches_batch(ms)
 
 
-class Medicine(object):
+class Medicine(Extractor):
 
-    def __init__(self, **kwargs):
-        dig       = '[0-9]+([ .,]*[0-9]*)?'
+    @staticmethod
+    def compile_patterns():
+        # runs of digits, whitespace and separators are matched as a whole (see `maximal`),
+        # as backtracking into adjacent runs can take cubic time
+        dig       = '[0-9]+(?![0-9])([ .,]*(?![ .,])[0-9]*(?![0-9]))?'
         units     = '(?P<unit>(mg)|(g)|(tbl)|(d)|(ugx))'
-        medicine  = '(?P<medicine>\\b[a-zA-Z]{3,50}\\b)[ .-]*((ravi|ret).{0,3}?)?'
-        amount    = '(?P<amount>' + dig + ')\s*'
-        frequency = '\s*[x*]\s*(?P<frequency>\d+)'
-        n         = '\s*n\s*[.*]?\s*(?P<n>\d+)'
+        medicine  = '(?P<medicine>\\b[a-zA-Z]{3,50}\\b)[ .-]*(?![ .-])((ravi|ret).{0,3}?)?'
+        amount    = '(?P<amount>' + dig + ')' + maximal('\s*')
+        frequency = maximal('\s*') + '[x*]' + maximal('\s*') + '(?P<frequency>\d+)'
+        n         = maximal('\s*') + 'n' + maximal('\s*') + '[.*]?' + maximal('\s*') + '(?P<n>\d+)'
         
-        self.patterns = [
+        return [
             re.compile(medicine + amount + units, re.UNICODE),
             re.compile(medicine + amount + units + frequency, re.UNICODE),
             re.compile(medicine + amount + units + n, re.UNICODE),
@@ -283,26 +964,27 @@ class Medicine(object):
             re.compile(medicine + amount + n, re.UNICODE)
             ]
 
-    def extract(self, document):
-        ms = get_matches(document, self.patterns)
-        ms = [cast_fields(m, ['amount'], float) for m in ms]
-        ms = [cast_fields(m, ['frequency', 'n'], int) for m in ms]
-        return remove_submatches(ms)
+    def extract_records(self, document, guard=None):
+        ms = self.pattern_set.matches(document, guard)
+        cast_batch(ms, ['amount'], float)
+        cast_batch(ms, ['frequency', 'n'], int)
+        return remove_submatches_batch(ms)
 
 
-class Date(object):
+class Date(Extractor):
 
     months = [u'ja', u've', u'mä', u'ap', u'ma', u'juun', u'juul', u'aug', u'se', u'ok', u'no', u'de']
     
-    def __init__(self, **kwargs):
+    @staticmethod
+    def compile_patterns():
         dig = '[0-9]{2,4}'
         month = u'jaanuar|veebruar|märts|aprill|mai|juuni|juuli|august|september|oktoober|november|detsember'
         month += u'|jaan|veeb|mär|apr|juun|juul|aug|sep|okt|nov|det'
         sep = '(\s*[./-]\s*| )'
-        self.patterns = []
-        self.patterns.append('(?P<day>' + dig +')' + sep + '(?P<month>' + month + '|' + dig + ').{0,2}?' + sep + '(?P<year>' + dig +')(?!' + sep + dig + sep + ')')
-        self.patterns.append('(?P<day>' + dig +')' + sep + '(?P<month>' + month + '|' + dig + ').{0,2}?')
-        self.patterns = [re.compile(p) for p in self.patterns]
+        patterns = []
+        patterns.append('(?P<day>' + dig +')' + sep + '(?P<month>' + month + '|' + dig + ').{0,2}?' + sep + '(?P<year>' + dig +')(?!' + sep + dig + sep + ')')
+        patterns.append('(?P<day>' + dig +')' + sep + '(?P<month>' + month + '|' + dig + ').{0,2}?')
+        return [re.compile(p) for p in patterns]
 
     def _fix_month(self, month):
         for idx, mo in enumerate(Date.months):
@@ -311,16 +993,16 @@ class Date(object):
         return int(month)
 
     def _valid(self, mo):
-        day = mo['day']['value']
-        month = mo['month']['value']
+        day = mo.fields['day'].value
+        month = mo.fields['month'].value
         year = None
-        if 'year' in mo:
-            year = mo['year']['value'] # some clumsy year extension
+        if 'year' in mo.fields:
+            year = mo.fields['year'].value # some clumsy year extension
             if year < 1000 and year < 80:
                 year += 2000
             elif year < 1000 and year >= 80:
                 year += 1900
-            mo['year']['value'] = year
+            mo.fields['year'].value = year
         v = day >= 1 and day <= 31 and month >= 1 and month <= 12
         if year != None:
             #sys.stderr.write('{0} {1} {2} {3}\n'.format(day,month,year,v))
@@ -328,73 +1010,192 @@ class Date(object):
         #sys.stderr.write('{0} {1} {2} {3}\n'.format(day,month,year,v))
         return v
                
-    def extract(self, document):
-        ms = get_matches(document, self.patterns)
+    def extract_records(self, document, guard=None):
+        ms = self.pattern_set.matches(document, guard)
         for mo in ms:
-            if 'month' in mo:
-                mo['month']['value'] = self._fix_month(mo['month']['value'])
-        ms = [cast_fields(m, ['day', 'year'], int) for m in ms]
+            if 'month' in mo.fields:
+                mo.fields['month'].value = self._fix_month(mo.fields['month'].value)
+        cast_batch(ms, ['day', 'year'], int)
         ms = [m for m in ms if self._valid(m)]
-        return remove_submatches(ms)
+        return remove_submatches_batch(ms)
 
-class Timex(object):
+class Timex(Extractor):
 
-    def __init__(self, **kwargs):
-        dig = '[0-9]+\s*([,.]\s*[0-9]+)?'
-        sep = '\s*[.x,/-]?\s*'
+    @staticmethod
+    def compile_patterns():
+        # see Medicine for the runs matched as a whole, a match
+        # cannot start inside a number, if it failed at the start of it
+        dig = '(?<![0-9])[0-9]+(?![0-9])' + maximal('\s*') + '([,.]' + maximal('\s*') + '[0-9]+(?![0-9]))?'
+        sep = maximal('\s*') + '[.x,/-]?' + maximal('\s*')
         times = u'(näd|kuu|päe|aast)\S*'
         
         patterns = []
         patterns.append(u'(?P<value>' + dig + ')' + sep + '(?P<expression>' + times + u')')
-        self.patterns = [re.compile(p, re.UNICODE) for p in patterns]
+        return [re.compile(p, re.UNICODE) for p in patterns]
+
+    def extract_records(self, document, guard=None):
+        ms = self.pattern_set.matches(document, guard)
+        cast_batch(ms, ['value'], float)
+        ms = in_range_batch(ms, ['value'],
+                                {'value': 0.001},
+                                {'value': 9999})
+        return remove_submatches_batch(ms)
 
-    def extract(self, document):
-        ms = get_matches(document, self.patterns)
-        ms = [cast_fields(m, ['value'], float) for m in ms]
-        ms = [m for m in ms if in_range(m, ['value'],
-                                           {'value': 0.001}, 
-                                           {'value': 9999}) ]
-        return remove_submatches(ms)
 
+class Measurements(Extractor):
 
-class Measurements(object):
+    # every pattern starts with one of the keywords
+    keywords = ['sp', 'kasv', 'pikk', u'pü', 'pea', 'sk', 'kaal']
     
-    def __init__(self, **kwargs):
-        dig = '[0-9]+\s*[,.]?\s*[0-9]+'
-        sep = '\s*[.,/-]?\s*'
+    @staticmethod
+    def compile_patterns():
+        # see Medicine for the runs matched as a whole
+        dig = '[0-9]+' + maximal('\s*') + '[,.]?' + maximal('\s*') + '[0-9]+'
+        sep = maximal('\s*') + '[.,/-]?' + maximal('\s*')
         patterns = []
         patterns.append('(sp|kasv|pikk(us)?)' + sep + '(?P<height>' + dig + ')' + sep + '(cm|m)?')
         patterns.append(u'(pü|pea(ü)?.{0,9})' + sep + '(?P<head_diameter>' + dig + ')' + sep + '(cm)?')
         patterns.append('(sk|kaal)' + sep + '(?P<weight>' + dig + ')' + sep + '(k?g)?')
         
-        self.patterns = [re.compile(p) for p in patterns]
+        return [re.compile(p) for p in patterns]
+
+    def extract_records(self, document, guard=None):
+        ms = self.pattern_set.matches(document, guard)
+        cast_batch(ms, ['height', 'weight', 'head_diameter'], float)
+        return remove_submatches_batch(ms)
 
-    def extract(self, document):
-        ms = get_matches(document, self.patterns)
-        #sys.stderr.write(str(ms) + '\n')
-        ms = [cast_fields(m, ['height', 'weight', 'head_diameter'], float) for m in ms]
-        return remove_submatches(ms)
+
+# extractors by the names of their results
+EXTRACTORS = {'record_bloodpressure': BloodPressure,
+              'record_date': Date,
+              'record_measurement': Measurements,
+              'record_medicine': Medicine,
+              'record_timex': Timex,
+              'record_temperature': Temperature}
+DEFAULT_EXTRACTORS = ['record_bloodpressure']
 
 
 class NumExtractor(object):
 
     ignore = ['start', 'end', 'original']
+    options = ['budget', 'pattern_budget', 'max_length', 'slow', 'profile']
 
     def __init__(self, **kwargs):
-        self.extractors = {
-            'record_bloodpressure': BloodPressure(**kwargs)}
-            #'record_date': Date(**kwargs),
-            #'record_measurement': Measurements(**kwargs),
-            #'record_medicine': Medicine(**kwargs),
-            #'record_timex': Timex(**kwargs),
-            #'record_temperature': Temperature(**kwargs)}
+        '''Initialize the extractor.
+        Keyword arguments:
+        extractors - the names of the enabled extractors, see `EXTRACTORS`.
+                     By default, only blood pressures are extracted.
+        budget - the seconds of matching per document, after which the document is
+                 skipped and all its values are empty. By default, the time is not limited.
+        pattern_budget - the seconds of matching per pattern and document, after which
+                         the remaining matches of the pattern are dropped, see `MatchGuard`.
+        max_length - the maximum number of characters per document, longer documents are truncated.
+        slow - the seconds per document, after which the document is added to the report.
+        profile - if True, the patterns are profiled, see `PatternProfile`.
+        The other keyword arguments are passed to the extractors.
+        Skipped, truncated and slow documents, the stopped patterns and the profile
+        are logged and collected to the `report` attribute, see `ExtractionReport`.'''
+        self._kwargs = dict(kwargs)
+        names = self._kwargs.pop('extractors', DEFAULT_EXTRACTORS)
+        self._options = dict((option, self._kwargs.pop(option, None)) for option in NumExtractor.options)
+        self.reset_report()
+        self.extractors = dict()
+        for name in names:
+            self.enable(name)
+
+    def enable(self, name):
+        '''Enable the extractor with given name. Its patterns are compiled
+        when first used in the process.'''
+        if name not in EXTRACTORS:
+            raise ValueError('Unknown extractor `' + name + '`')
+        self.extractors[name] = EXTRACTORS[name](**self._kwargs)
+
+    def disable(self, name):
+        '''Disable the extractor with given name.'''
+        del self.extractors[name]
+
+    def reset_report(self, offset=0):
+        '''Start a new report. Returns the previous report.
+        offset - the index of the first document of the new report in the log messages.'''
+        report = getattr(self, 'report', None)
+        self.report = ExtractionReport(PatternProfile() if self._options['profile'] else None)
+        self._offset = offset
+        return report
 
     def extract(self, document):
+        budget, pattern_budget, max_length, slow, profile = [self._options[option] for option in NumExtractor.options]
+        start = time.time()
+        length = len(document)
+        action = 'extracted'
+        if max_length is not None and length > max_length:
+            logger.warning(u'Truncated document {0} of {1} characters'.format(self._offset + self.report.documents, length))
+            document = document[:max_length]
+            action = 'truncated'
+        guard = None
+        if budget is not None or pattern_budget is not None or profile:
+            guard = MatchGuard(budget, pattern_budget, self.report.profile)
         values = dict()
-        for key in self.extractors:
-            values[key] = self.extractors[key].extract(document)
+        try:
+            for key in self.extractors:
+                if guard is not None:
+                    guard.extractor = key
+                values[key] = self.extractors[key].extract(document, guard)
+        except BudgetExceeded as e:
+            logger.warning(u'Skipped document {0}: {1}'.format(self._offset + self.report.documents, e))
+            values = dict((key, []) for key in self.extractors)
+            action = 'skipped'
+        seconds = time.time() - start
+        if guard is not None:
+            for extractor, key in guard.stopped:
+                logger.warning(u'Stopped pattern {0} of {1} in document {2}'.format(key, extractor,
+                                                                                    self._offset + self.report.documents))
+            self.report.add_patterns(guard)
+        if action != 'extracted' or (slow is not None and seconds >= slow):
+            self.report.add_document(length, seconds, action, guard, document)
+        self.report.documents += 1
         return values
     
+    def extract_many(self, documents, workers=None, chunksize=100, queue_size=2):
+        '''Extract the values of an iterable of documents. Yields the results
+        of `extract` for each document in the input order. The reports of
+        the workers are added to the `report` of this extractor.
+        Keyword arguments:
+        workers - the number of worker processes, each of which creates its own extractor
+                  with the same arguments. By default the documents are processed serially.
+        chunksize - the number of documents sent to a worker at once.
+        queue_size - the maximum number of chunks per worker being processed or waiting
+                     to be yielded, which bounds the number of documents held in memory.'''
+        assert chunksize > 0
+        assert queue_size > 0
+        if workers is None or workers <= 1:
+            for document in documents:
+                yield self.extract(document)
+            return
+        documents = iter(documents)
+        kwargs = dict(self._kwargs, extractors=list(self.extractors), **self._options)
+        pool = multiprocessing.Pool(workers, _init_extractor, (kwargs,))
+        try:
+            pending = deque()
+            # index of the next chunk's first document in the log messages of the workers
+            offset = self._offset + self.report.documents
+            while True:
+                while len(pending) < workers * queue_size:
+                    chunk = list(islice(documents, chunksize))
+                    if len(chunk) == 0:
+                        break
+                    pending.append(pool.apply_async(_extract_chunk, (chunk, offset)))
+                    offset += len(chunk)
+                if len(pending) == 0:
+                    break
+                chunk_values, report = pending.popleft().get()
+                self.report.update(report)
+                for values in chunk_values:
+                    yield values
+        finally:
+            # stops the workers also on errors and if the generator is closed before finishing
+            pool.terminate()
+            pool.join()
+    
     def _annots(self, title, m):
         annots = []
         for field in m:
@@ -412,35 +1213,58 @@ class NumExtractor(object):
             '<span class="{0}" title="{0}">'.format(title)))
         return annots
     
-    def annotate(self, document):
-        values = self.extract(document)
-        usable = [values[title] for title in values]
-        usable = reduce(lambda x, y: x + y, usable)
-        usable = remove_submatches(usable)
+    def annotate(self, document, values=None):
+        '''Annotate the document with HTML tags of the extracted values.
+        values - the result of `extract` for the document, extracted if not given.'''
+        return u''.join(self.annotate_chunks(document, values))
+    
+    def annotate_chunks(self, document, values=None):
+        '''Generate the annotated document in chunks of text and tags in offset order.'''
+        if values is None:
+            values = self.extract(document)
         annots = []
         for title in values:
-            ms = values[title]
-            for m in ms:
+            for m in values[title]:
                 annots.extend(self._annots(title, m))
-        # generate annotated string
-        annots.sort(key=lambda x: x[0], reverse=True)
-        annotated = list(document)
-        for _, idx, annot in annots:
-            annotated[idx:idx] = annot
-        return u''.join(annotated)
+        # tags at the same offset are ordered by their keys, the tags with
+        # equal keys in the reverse order of their creation
+        order = sorted(xrange(len(annots)), key=lambda i: (annots[i][1], annots[i][0], -i))
+        pos = 0
+        for i in order:
+            _, idx, annot = annots[i]
+            if idx > pos:
+                yield document[pos:idx]
+                pos = idx
+            yield annot
+        if pos < len(document):
+            yield document[pos:]
+
+_worker_extractor = None
+
+def _init_extractor(kwargs):
+    global _worker_extractor
+    _worker_extractor = NumExtractor(**kwargs)
+
+def _extract_chunk(documents, offset):
+    '''Extract the values of a chunk of documents in a worker process.
+    `offset` is the index of the first document of the chunk in the input.
+    Returns the values and the report of the chunk.'''
+    _worker_extractor.reset_report(offset)
+    return [_worker_extractor.extract(document) for document in documents], _worker_extractor.report
 
 ################################################################################
 # functions for creating database tables
 ################################################################################
 
-def create_bp_table(conn, data, tbl_name = 'tm_misplus_rr'):
+def create_bp_table(conn, data, tbl_name = 'tm_misplus_rr', workers=None):
     '''Create a SQLite table containing bloodpressures.
     conn - connection to SQLite3 database
     data - enumerable of tuples (vidx, text), where
         vidx - id of the text (used as foreign key in resulting table)
         text - free-text to match.
     tbl_name - specify the table name (NB! function will drop the old table,
-               if it exists).'''
+               if it exists).
+    workers - the number of processes extracting the bloodpressures, see `NumExtractor.extract_many`.'''
     cur = conn.cursor()
     # create the appropriate table
     cur.execute('drop table if exists ' + tbl_name)
@@ -454,8 +1278,8 @@ def create_bp_table(conn, data, tbl_name = 'tm_misplus_rr'):
     pid = 1L
     ne = NumExtractor()
     bloodpressures = []
-    for vid, text in data:
-        values = ne.extract(text)
+    ids, texts = tee(data)
+    for (vid, _), values in izip(ids, ne.extract_many((text for _, text in texts), workers)):
         for bp in values['record_bloodpressure']:
             t = (pid, vid,
                 bp.get('systolic', dict()).get('value', None),
@@ -507,16 +1331,54 @@ _html_header = """<!DOCTYPE html>
 
 _html_footer = """</body></html>"""
 
+def _read_lines(stream):
+    line = stream.readline()
+    while line != '':
+        yield line
+        line = stream.readline()
+
 def main():
-    extractor = NumExtractor()
+    parser = argparse.ArgumentParser(description='Extract numeric values from the lines of standard input.')
+    parser.add_argument('--format', choices=['html', 'jsonl'], default='html',
+                        help='Write the lines as annotated HTML or the values of each line as JSON.')
+    parser.add_argument('--workers', type=int, default=None, help='The number of extracting processes.')
+    parser.add_argument('--chunksize', type=int, default=100, help='The number of lines sent to a process at once.')
+    parser.add_argument('--extractors', nargs='+', choices=sorted(EXTRACTORS), default=DEFAULT_EXTRACTORS,
+                        help='The names of the enabled extractors.')
+    parser.add_argument('--budget', type=float, default=None,
+                        help='Skip the lines taking more than the given number of seconds.')
+    parser.add_argument('--pattern-budget', type=float, default=None,
+                        help='Stop the patterns taking more than the given number of seconds on a line.')
+    parser.add_argument('--max-length', type=int, default=None, help='Truncate the lines to the given number of characters.')
+    parser.add_argument('--slow', type=float, default=None,
+                        help='Report the lines taking more than the given number of seconds.')
+    parser.add_argument('--profile', action='store_true', help='Report the time and match counts of each pattern.')
+    args = parser.parse_args()
+    
+    extractor = NumExtractor(extractors=args.extractors, budget=args.budget, pattern_budget=args.pattern_budget,
+                             max_length=args.max_length, slow=args.slow, profile=args.profile)
     reader = codecs.getreader('utf-8')(sys.stdin)
     writer = codecs.getwriter('utf-8')(sys.stdout)
-    writer.write(_html_header)
-    line = reader.readline()
-    while line != '':
-        writer.write('<p>' + extractor.annotate(line) + '</p>')
-        line = reader.readline()
-    writer.write(_html_footer)
+    lines, documents = tee(_read_lines(reader))
+    results = izip(lines, extractor.extract_many(documents, args.workers, args.chunksize))
+    if args.format == 'html':
+        writer.write(_html_header)
+        for line, values in results:
+            writer.write(u'<p>')
+            for chunk in extractor.annotate_chunks(line, values):
+                writer.write(chunk)
+            writer.write(u'</p>')
+        writer.write(_html_footer)
+    else:
+        for line, values in results:
+            writer.write(json.dumps({'text': line.rstrip(u'\r\n'), 'values': values},
+                                    ensure_ascii=False, sort_keys=True))
+            writer.write(u'\n')
+    report = extractor.report
+    if len(report.slow_documents) > 0 or len(report.slow_patterns) > 0 or report.profile is not None:
+        errors = codecs.getwriter('utf-8')(sys.stderr)
+        for line in report.summary():
+            errors.write(line + u'\n')
 
 
 if __name__ == '__main__':
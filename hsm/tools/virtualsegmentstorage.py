@@ -0,0 +1,201 @@
+'''
+Segment storage with virtual layers.
+
+A virtual layer is the output of a filter that is not stored, but computed
+when the segments of the layer are loaded. The filter is evaluated separately
+for each requested document and the results of recently requested documents
+are kept in a bounded cache. All other layers are loaded from the underlying
+storage, which also receives all saves and deletes.
+'''
+from collections import OrderedDict
+from itertools import islice
+import threading
+
+from hsm.data.regexcache import compile_regex
+from hsm.tools.filter import Filter, DOCUMENT_PREFIX, OUTPUT_NAME, VIRTUAL
+
+
+class VirtualSegmentStorage(object):
+    '''Segment storage computing the segments of virtual layers with filters.'''
+
+    def __init__(self, segstorage, docstorage, filters=(), cache_size=1000):
+        '''Initialize the storage.
+        Arguments:
+        segstorage - the storage of materialized layers.
+        docstorage - the storage of documents the filters are evaluated on.
+        filters - filters to register as virtual layers, if their `virtual` setting is True.
+        cache_size - the maximum number of computed (layer, document) results kept in the cache.'''
+        assert cache_size >= 0
+        self._segstorage = segstorage
+        self._docstorage = docstorage
+        self._filters = dict()
+        self._cache = OrderedDict()
+        self._cache_size = cache_size
+        self._lock = threading.Lock()
+        for filt in filters:
+            if filt.get(VIRTUAL, False):
+                self.register(filt)
+
+    def register(self, filt):
+        '''Register the output of given filter as a virtual layer.'''
+        name = filt[OUTPUT_NAME]
+        self._filters[name] = Filter(**filt)
+        self.invalidate(name)
+
+    def unregister(self, name):
+        '''Remove the virtual layer with given name.'''
+        self.invalidate(name)
+        del self._filters[name]
+
+    def is_virtual(self, name):
+        return name in self._filters
+
+    def virtual_names(self):
+        return list(sorted(self._filters))
+
+    def invalidate(self, name):
+        '''Remove the cached segments of given layer and the virtual layers depending on it.'''
+        affected = set()
+        stack = [name]
+        while len(stack) > 0:
+            layer = stack.pop()
+            if layer in affected:
+                continue
+            affected.add(layer)
+            stack.extend(output for output, filt in self._filters.iteritems() if layer in filt.input_names())
+        with self._lock:
+            for key in [key for key in self._cache if key[0] in affected]:
+                del self._cache[key]
+
+    def load(self, **kwargs):
+        '''Load segments from the storage. Takes the same arguments as SegmentStorage.load.
+        Queries with `name_prefix` do not include the virtual layers.'''
+        if not self._is_virtual_query(kwargs):
+            return self._segstorage.load(**kwargs)
+        return frozenset(self.load_iterator(**kwargs))
+
+    def load_iterator(self, **kwargs):
+        '''Same as load, but returns the generator for the returned segments.
+        Segments of virtual layers are always generated in sorted order and only
+        for documents stored in the document storage, if `doc_prefix` is given.'''
+        if not self._is_virtual_query(kwargs):
+            return self._segstorage.load_iterator(**kwargs)
+        kwargs = dict(kwargs)
+        limit = kwargs.pop('limit', None)
+        kwargs.pop('sort', None)
+        name = kwargs.pop('name')
+        doc_name = kwargs.pop('doc_name', None)
+        doc_prefix = kwargs.pop('doc_prefix', None)
+        value_regex = kwargs.pop('value_regex', None)
+        neg_regex = kwargs.pop('neg_regex', None)
+        if len(kwargs) > 0:
+            raise Exception('Unknown keyword argument: `' + kwargs.keys()[0] + '`')
+        if doc_name is None and doc_prefix is None:
+            doc_prefix = u''
+        segments = self._virtual_iterator(name, doc_name, doc_prefix)
+        if value_regex is not None:
+            pattern = compile_regex(value_regex)
+            segments = (seg for seg in segments if pattern.search(seg.value) is not None)
+        if neg_regex is not None:
+            pattern = compile_regex(neg_regex)
+            segments = (seg for seg in segments if pattern.search(seg.value) is None)
+        if limit is not None:
+            assert limit > 0
+            segments = islice(segments, limit)
+        return segments
+
+    def load_overlapping(self, doc_name, start, end, name=None, name_prefix=None):
+        if name_prefix is not None or not self.is_virtual(name):
+            return self._segstorage.load_overlapping(doc_name, start, end, name, name_prefix)
+        return iter([seg for seg in self._document_segments(name, doc_name) if seg.start < end and start < seg.end])
+
+    def load_contained(self, doc_name, start, end, name=None, name_prefix=None):
+        if name_prefix is not None or not self.is_virtual(name):
+            return self._segstorage.load_contained(doc_name, start, end, name, name_prefix)
+        return iter([seg for seg in self._document_segments(name, doc_name) if start <= seg.start and seg.end <= end])
+
+    def load_containing(self, doc_name, start, end, name=None, name_prefix=None):
+        if name_prefix is not None or not self.is_virtual(name):
+            return self._segstorage.load_containing(doc_name, start, end, name, name_prefix)
+        return iter([seg for seg in self._document_segments(name, doc_name) if seg.start <= start and end <= seg.end])
+
+    def counts(self, **kwargs):
+        '''Get the total counts of the segments. Counting a virtual layer evaluates its filter.'''
+        if not self._is_virtual_query(kwargs):
+            return self._segstorage.counts(**kwargs)
+        count = sum(1 for _ in self.load_iterator(**kwargs))
+        if count == 0:
+            return {}
+        return {kwargs['name']: count}
+
+    def count(self, key):
+        if not self.is_virtual(key):
+            return self._segstorage.count(key)
+        return sum(1 for _ in self.load_iterator(name=key))
+
+    def value_counts(self, **kwargs):
+        if not self._is_virtual_query(kwargs):
+            return self._segstorage.value_counts(**kwargs)
+        counts = dict()
+        for segment in self.load_iterator(**kwargs):
+            counts[segment.value] = counts.get(segment.value, 0) + 1
+        return counts
+
+    def save(self, segments):
+        '''Save given segments to the underlying storage.'''
+        segments = list(segments)
+        self._segstorage.save(segments)
+        for name in set(segment.name for segment in segments):
+            self.invalidate(name)
+
+    def delete(self, **kwargs):
+        '''Delete segments from the underlying storage. Virtual layers cannot be deleted.'''
+        if 'name_prefix' in kwargs or 'name' not in kwargs:
+            with self._lock:
+                self._cache.clear()
+        else:
+            self.invalidate(kwargs['name'])
+        return self._segstorage.delete(**kwargs)
+
+    def __getattr__(self, name):
+        # other methods of the underlying storage see the materialized layers only
+        return getattr(self._segstorage, name)
+
+    def _is_virtual_query(self, kwargs):
+        return 'name_prefix' not in kwargs and self.is_virtual(kwargs.get('name'))
+
+    def _virtual_iterator(self, name, doc_name, doc_prefix):
+        if doc_prefix is None:
+            for segment in self._document_segments(name, doc_name):
+                yield segment
+            return
+        filter_prefix = self._filters[name].get(DOCUMENT_PREFIX, u'')
+        if doc_prefix.startswith(filter_prefix):
+            prefix = doc_prefix
+        elif filter_prefix.startswith(doc_prefix):
+            prefix = filter_prefix
+        else:
+            return
+        for doc_name in self._docstorage.load_names(prefix):
+            for segment in self._document_segments(name, doc_name):
+                yield segment
+
+    def _document_segments(self, name, doc_name):
+        '''Get the sorted segments of virtual layer `name` in given document.'''
+        key = (name, doc_name)
+        with self._lock:
+            segments = self._cache.pop(key, None)
+            if segments is not None:
+                self._cache[key] = segments
+                return segments
+        filt = self._filters[name]
+        if not doc_name.startswith(filt.get(DOCUMENT_PREFIX, u'')):
+            return []
+        # duplicates are removed, as they would be when saving the segments
+        segments = sorted(set(filt.compile(doc_name).filter(self, self._docstorage)))
+        if self._cache_size > 0:
+            with self._lock:
+                self._cache[key] = segments
+                while len(self._cache) > self._cache_size:
+                    self._cache.popitem(last=False)
+        return segments